@@ -0,0 +1,138 @@
+import argparse
+import os
+import time
+
+from style_engine import Stylizer, image_dims
+
+"""
+Stylize many content images with the same styles, several at a time.
+
+Content images of the same size are optimized together in batches of
+--batch_size: one compiled function evaluates the loss and gradients of the
+whole batch, each image keeping its own content and TV losses against the
+shared style targets. Results are written to <output_dir>/<content name>_at_iteration_<i>.png.
+
+    python batch_stylize.py content_images/*.jpg --style style_images/waves.jpg --output_dir output_images
+"""
+
+parser = argparse.ArgumentParser(description='Batched neural style transfer over many content images.')
+parser.add_argument('base_image_paths', metavar='base', nargs='+', type=str,
+                    help='Paths to the images to transform.')
+
+parser.add_argument('--style', dest='style_image_paths', nargs='+', type=str, required=True,
+                    help='Path to the style reference image(s).')
+
+parser.add_argument('--output_dir', type=str, default='output_images',
+                    help='Directory of the results')
+
+parser.add_argument("--batch_size", dest="batch_size", default=4, type=int,
+                    help="Number of content images optimized together")
+
+parser.add_argument("--image_size", dest="img_size", default=400, type=int,
+                    help='Output Image size')
+
+parser.add_argument("--content_weight", dest="content_weight", default=0.025, type=float,
+                    help="Weight of content")
+
+parser.add_argument("--style_weight", dest="style_weight", nargs='+', default=[1], type=float,
+                    help="Weight of style, can be multiple for multiple styles")
+
+parser.add_argument("--total_variation_weight", dest="tv_weight", default=8.5e-5, type=float,
+                    help="Total Variation in the Weights")
+
+parser.add_argument("--style_scale", dest="style_scale", default=1.0, type=float,
+                    help="Scale the weightage of the style")
+
+parser.add_argument("--num_iter", dest="num_iter", default=10, type=int,
+                    help="Number of iterations")
+
+parser.add_argument("--content_loss_type", default=0, type=int,
+                    help='Can be one of 0, 1 or 2. Readme contains the required information of each mode.')
+
+parser.add_argument("--content_layer", dest="content_layer", default="conv5_2", type=str,
+                    help="Optional 'conv4_2'")
+
+parser.add_argument("--init_image", dest="init_image", default="content", type=str,
+                    help="Initial image used to generate the final image. Options are 'content', 'noise', or 'gray'")
+
+parser.add_argument("--evals_per_iter", dest="evals_per_iter", default=20, type=int,
+                    help="Loss/gradient evaluations per iteration")
+
+parser.add_argument("--float32_optimizer", dest="float32_optimizer", default="False", type=str,
+                    help="Run L-BFGS in float32 instead of scipy's float64 L-BFGS-B")
+
+parser.add_argument("--save_every", dest="save_every", default=1, type=int,
+                    help="Save an intermediate image every this many iterations (0 saves the final image only)")
+
+parser.add_argument("--save_threads", dest="save_threads", default=1, type=int,
+                    help="Threads writing the images in the background (0 writes them synchronously)")
+
+parser.add_argument("--blend_styles", dest="blend_styles", default="False", type=str,
+                    help="Collapse the style images into one weighted mean gram matrix per layer")
+
+parser.add_argument("--model", default="vgg16", type=str,
+                    help="Choices are 'vgg16' and 'vgg19'")
+
+parser.add_argument("--pool_type", dest="pool", default="max", type=str,
+                    help='Pooling type. Can be "ave" for average pooling or "max" for max pooling')
+
+parser.add_argument("--gram_cache_dir", dest="gram_cache_dir", default=None, type=str,
+                    help="Directory of the on-disk cache of style gram matrices (disabled if not set)")
+
+parser.add_argument("--gram_cache_size", dest="gram_cache_size", default=1024, type=int,
+                    help="Maximum size of the style gram matrix cache in MB")
+
+
+def str_to_bool(v):
+    return v.lower() in ("true", "yes", "t", "1")
+
+
+def batches(paths, img_size, batch_size):
+    '''Lists of at most `batch_size` paths whose images are resized to the same size.'''
+    groups = {}
+    for path in paths:
+        img_width, img_height, _ = image_dims(path, img_size)
+        groups.setdefault((img_width, img_height), []).append(path)
+
+    for size in sorted(groups):
+        group = groups[size]
+        for i in range(0, len(group), batch_size):
+            yield group[i:i + batch_size]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    assert args.batch_size > 0, "The batch size must be positive"
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    job = {
+        'style_image_paths': args.style_image_paths,
+        'img_size': args.img_size,
+        'content_weight': args.content_weight,
+        'style_weight': args.style_weight,
+        'style_scale': args.style_scale,
+        'tv_weight': args.tv_weight,
+        'num_iter': args.num_iter,
+        'content_loss_type': args.content_loss_type,
+        'content_layer': args.content_layer,
+        'init_image': args.init_image,
+        'blend_styles': str_to_bool(args.blend_styles),
+        'evals_per_iter': args.evals_per_iter,
+        'float32_optimizer': str_to_bool(args.float32_optimizer),
+        'save_every': args.save_every,
+        'save_threads': args.save_threads,
+    }
+
+    stylizer = Stylizer(args.model, args.pool, args.gram_cache_dir, args.gram_cache_size)
+
+    start_time = time.time()
+    nb_images = 0
+    for paths in batches(args.base_image_paths, args.img_size, args.batch_size):
+        prefixes = [os.path.join(args.output_dir, os.path.splitext(os.path.basename(path))[0]) for path in paths]
+        print('Stylizing', ', '.join(paths))
+        stylizer.stylize_batch(job, paths, prefixes)
+        nb_images += len(paths)
+
+    print('Stylized %d images in %ds' % (nb_images, time.time() - start_time))
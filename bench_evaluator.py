@@ -0,0 +1,122 @@
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+from optimizer import BufferedEvaluator
+
+"""
+Memory allocated per evaluation by the old eval_loss_and_grads/Evaluator pair
+and by BufferedEvaluator, measured with tracemalloc.
+
+The backend is replaced by a function returning the same preallocated loss and
+gradient arrays on every call, so only the evaluator's own allocations are
+counted. Allocations are reported as the peak memory traced during one
+evaluation in units of one float32 image; "retained" is what is still alive
+afterwards, i.e. the gradient array handed to the optimizer.
+"""
+
+parser = argparse.ArgumentParser(description='Evaluator allocation micro-benchmark.')
+parser.add_argument("--image_size", dest="img_size", default=400, type=int,
+                    help='Width and height of the image')
+
+parser.add_argument("--nb_evals", type=int, default=50,
+                    help="Number of evaluations measured per evaluator")
+
+parser.add_argument("--output", type=str, default=None,
+                    help="Write the results as JSON to this file")
+
+
+def fake_backend(shape):
+    loss = np.array(1.0, dtype='float32')
+    grads = np.ones(shape, dtype='float32')
+
+    def f_outputs(inputs):
+        return [loss, grads]
+    return f_outputs
+
+
+# the evaluator of the scripts before BufferedEvaluator
+class LegacyEvaluator(object):
+    def __init__(self, f_outputs, shape):
+        self.f_outputs = f_outputs
+        self.shape = shape
+        self.loss_value = None
+        self.grads_values = None
+
+    def eval_loss_and_grads(self, x):
+        x = x.reshape(self.shape)
+        outs = self.f_outputs([x])
+        loss_value = outs[0]
+        if len(outs[1:]) == 1:
+            grad_values = outs[1].flatten().astype('float64')
+        else:
+            grad_values = np.array(outs[1:]).flatten().astype('float64')
+        return loss_value, grad_values
+
+    def loss(self, x):
+        assert self.loss_value is None
+        loss_value, grad_values = self.eval_loss_and_grads(x)
+        self.loss_value = loss_value
+        self.grad_values = grad_values
+        return self.loss_value
+
+    def grads(self, x):
+        assert self.loss_value is not None
+        grad_values = np.copy(self.grad_values)
+        self.loss_value = None
+        self.grad_values = None
+        return grad_values
+
+
+def measure(evaluator, x, nb_evals, image_bytes):
+    evaluator.loss(x)
+    evaluator.grads(x)  # warm up
+
+    peak = 0
+    retained = 0
+    start_time = time.time()
+    for _ in range(nb_evals):
+        tracemalloc.start()
+        evaluator.loss(x)
+        g = evaluator.grads(x)
+        current, peak_eval = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak += peak_eval
+        retained += current
+        del g
+    seconds = time.time() - start_time
+
+    return {'peak_bytes_per_eval': peak / float(nb_evals),
+            'retained_bytes_per_eval': retained / float(nb_evals),
+            'image_allocations_per_eval': peak / float(nb_evals) / image_bytes,
+            'seconds_per_eval': seconds / nb_evals}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    shape = (1, args.img_size, args.img_size, 3)
+    image_bytes = int(np.prod(shape)) * 4
+    f_outputs = fake_backend(shape)
+
+    evaluators = [('legacy', LegacyEvaluator(f_outputs, shape), 'float64'),
+                  ('buffered', BufferedEvaluator(f_outputs, shape, dtype='float64'), 'float64'),
+                  ('buffered float32', BufferedEvaluator(f_outputs, shape, dtype='float32'), 'float32')]
+
+    results = {'image_size': args.img_size, 'image_bytes': image_bytes, 'runs': []}
+    print("%-18s %14s %14s %12s" % ("evaluator", "images / eval", "retained (MB)", "ms / eval"))
+    for name, evaluator, dtype in evaluators:
+        x = np.random.uniform(-128, 128, int(np.prod(shape))).astype(dtype)
+        run = measure(evaluator, x, args.nb_evals, image_bytes)
+        run['evaluator'] = name
+        results['runs'].append(run)
+        print("%-18s %14.2f %14.2f %12.2f" % (name, run['image_allocations_per_eval'],
+                                              run['retained_bytes_per_eval'] / 1024 ** 2,
+                                              run['seconds_per_eval'] * 1000))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
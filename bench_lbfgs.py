@@ -0,0 +1,138 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from optimizer import LBFGSDriver
+
+"""
+Evaluations needed to reach a target loss with L-BFGS restarted every 20
+evaluations (the old outer loop) and with one persistent L-BFGS state.
+
+Without --content/--style the objective is a synthetic stand-in with the
+same structure as the style transfer loss (an ill-conditioned quadratic
+plus the scripts' total variation term), so it runs without Keras.
+With them, the real main.py loss from style_engine is used.
+"""
+
+parser = argparse.ArgumentParser(description='L-BFGS restart vs persistent state benchmark.')
+parser.add_argument("--content", type=str, default=None,
+                    help="Content image; uses the real style transfer loss when given with --style")
+
+parser.add_argument("--style", type=str, nargs='+', default=None,
+                    help="Style images for the real style transfer loss")
+
+parser.add_argument("--image_size", dest="img_size", default=128, type=int,
+                    help='Image size of the problem')
+
+parser.add_argument("--num_iter", dest="num_iter", default=10, type=int,
+                    help="Number of outer iterations of 20 evaluations each")
+
+parser.add_argument("--target", type=float, default=None,
+                    help="Target loss (default: the final loss of the restarted run)")
+
+parser.add_argument("--seed", type=int, default=0,
+                    help="Seed of the synthetic problem")
+
+parser.add_argument("--output", type=str, default=None,
+                    help="Write the results as JSON to this file")
+
+
+def synthetic_problem(size, seed):
+    rng = np.random.RandomState(seed)
+    shape = (size, size, 3)
+    target = rng.uniform(-128, 128, shape)
+    weights = np.exp(rng.uniform(-3, 3, shape))  # condition number ~400
+    tv_weight = 1e-2
+
+    def loss_and_grads(x):
+        x = x.reshape(shape)
+        diff = x - target
+        loss = 0.5 * np.sum(weights * diff ** 2)
+        grads = weights * diff
+
+        da = x[:-1, :-1, :] - x[1:, :-1, :]
+        db = x[:-1, :-1, :] - x[:-1, 1:, :]
+        s = da ** 2 + db ** 2
+        loss += tv_weight * np.sum(s ** 1.25)
+        ds = tv_weight * 1.25 * s ** 0.25
+        grads[:-1, :-1, :] += ds * 2 * (da + db)
+        grads[1:, :-1, :] -= ds * 2 * da
+        grads[:-1, 1:, :] -= ds * 2 * db
+        return loss, grads.flatten()
+
+    x0 = rng.uniform(-128, 128, shape).flatten()
+    return loss_and_grads, x0
+
+
+def style_transfer_problem(content, styles, img_size):
+    from style_engine import Stylizer, image_dims, preprocess_image, style_weights_for, DEFAULT_JOB, FEATURE_LAYERS
+
+    job = dict(DEFAULT_JOB)
+    job.update({'base_image_path': content, 'style_image_paths': styles, 'img_size': img_size})
+
+    stylizer = Stylizer()
+    img_width, img_height, _ = image_dims(content, img_size)
+    style_weights = style_weights_for(job)
+    f = stylizer.loss_function(img_width, img_height, job['content_layer'], FEATURE_LAYERS,
+                               job['content_loss_type'], len(style_weights))
+
+    base_image = preprocess_image(content, img_width, img_height)
+    content_target = f.content_features(base_image)
+    style_targets = stylizer.style_targets(f, styles)
+
+    def loss_and_grads(x):
+        return f(x, content_target, style_targets, job['content_weight'], style_weights, job['tv_weight'])
+
+    return loss_and_grads, base_image.flatten().astype('float64')
+
+
+def run(loss_and_grads, x0, max_evals, restart_every):
+    cache = {}
+
+    def loss(x):
+        cache['loss'], cache['grads'] = loss_and_grads(x)
+        return cache['loss']
+
+    def grads(x):
+        return cache['grads']
+
+    driver = LBFGSDriver(loss, grads, max_evals, save_every=20, restart_every=restart_every)
+    start_time = time.time()
+    driver.run(x0.copy())
+    return driver.loss_history, time.time() - start_time
+
+
+def evals_to_target(history, target):
+    best = np.minimum.accumulate(history)
+    reached = np.nonzero(best <= target)[0]
+    return int(reached[0]) + 1 if len(reached) else None
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.content is not None and args.style is not None:
+        loss_and_grads, x0 = style_transfer_problem(args.content, args.style, args.img_size)
+    else:
+        loss_and_grads, x0 = synthetic_problem(args.img_size, args.seed)
+
+    max_evals = args.num_iter * 20
+    restarted, restarted_time = run(loss_and_grads, x0, max_evals, restart_every=20)
+    persistent, persistent_time = run(loss_and_grads, x0, max_evals, restart_every=None)
+
+    target = args.target if args.target is not None else min(restarted)
+
+    results = {'target_loss': target, 'max_evals': max_evals, 'runs': []}
+    print("%-12s %12s %16s %10s" % ("mode", "final loss", "evals to target", "seconds"))
+    for name, history, seconds in [("restarted", restarted, restarted_time),
+                                   ("persistent", persistent, persistent_time)]:
+        evals = evals_to_target(history, target)
+        results['runs'].append({'mode': name, 'final_loss': min(history), 'evals_to_target': evals,
+                                'nb_evals': len(history), 'seconds': seconds})
+        print("%-12s %12.5g %16s %10.2f" % (name, min(history), evals, seconds))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
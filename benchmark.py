@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Benchmark suite of the stylization entry points.
+
+Runs every entry point on the bundled content_images/ and style_images/ at
+each --image_sizes value, one process per run, with --profile turned on.
+For every run it records
+    time_to_first_iteration  seconds from the process launch to the end of iteration 1
+    seconds_per_evaluation   median duration of the loss/gradient evaluations after the first
+    peak_rss_mb              peak resident memory of the process
+    final_loss               loss at the last iteration
+in a JSON results file. With --baseline, the results are compared against
+an earlier results file and regressions beyond --tolerance are reported.
+A failed run, or a metric the baseline has that a run lacks, is a
+regression too; the exit status is 1 if there are any regressions or
+failed runs.
+
+    python benchmark.py --image_sizes 128 256 --output bench_results.json
+    python benchmark.py --image_sizes 128 256 --baseline bench_results.json
+"""
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (script, extra arguments); "{mask}" is replaced by a generated style mask
+ENTRY_POINTS = [
+    ('main', 'main.py', []),
+    ('main_mrf', 'main_mrf.py', []),
+    ('mrf_th', 'mrf_th.py', []),
+    ('original_vgg16', 'original.py', []),
+    ('original_vgg19', 'original.py', ['--model', 'vgg19']),
+    ('original_masked', 'original.py', ['--style_masks', '{mask}']),
+]
+
+METRICS = ['time_to_first_iteration', 'seconds_per_evaluation', 'peak_rss_mb', 'final_loss']
+
+parser = argparse.ArgumentParser(description='Benchmark suite of the stylization entry points.')
+parser.add_argument("--entry_points", nargs='+', default=[name for name, _, _ in ENTRY_POINTS],
+                    help="Entry points to run, out of %s" % ", ".join(name for name, _, _ in ENTRY_POINTS))
+
+parser.add_argument("--image_sizes", nargs='+', type=int, default=[128, 256],
+                    help="Values of --image_size to run every entry point at")
+
+parser.add_argument("--content", type=str, default=os.path.join(ROOT, 'content_images', 'dog.jpg'),
+                    help="Content image")
+
+parser.add_argument("--style", type=str, default=os.path.join(ROOT, 'style_images', 'waves.jpg'),
+                    help="Style image")
+
+parser.add_argument("--num_iter", type=int, default=2,
+                    help="Iterations of every run")
+
+parser.add_argument("--repeats", type=int, default=1,
+                    help="Runs of every configuration; the median of each metric is reported")
+
+parser.add_argument("--output", type=str, default="bench_results.json",
+                    help="Results file")
+
+parser.add_argument("--baseline", type=str, default=None,
+                    help="Results file to compare against")
+
+parser.add_argument("--tolerance", type=float, default=0.1,
+                    help="Relative slowdown (or memory / loss increase) reported as a regression")
+
+
+def write_mask(path, width=256, height=256):
+    '''Binary PGM mask covering the left half of the image.'''
+    row = bytearray([255] * (width // 2) + [0] * (width - width // 2))
+    with open(path, 'wb') as f:
+        f.write(('P5\n%d %d\n255\n' % (width, height)).encode('ascii'))
+        for _ in range(height):
+            f.write(row)
+
+
+def read_profile(path):
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                events.append(json.loads(line))
+    return events
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.
+
+
+def run_once(script, extra_args, image_size, args, work_dir):
+    profile_path = os.path.join(work_dir, 'profile.jsonl')
+    command = [sys.executable, os.path.join(ROOT, script), args.content, args.style,
+               os.path.join(work_dir, 'out'), '--image_size', str(image_size), '--num_iter', str(args.num_iter),
+               '--save_every', '0', '--profile', profile_path] + extra_args
+
+    launch_time = time.time()
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)  # the rusage of this child alone
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+    result = {'returncode': process.returncode,
+              'peak_rss_mb': usage.ru_maxrss / 1024.,  # kilobytes on Linux
+              'wall_seconds': time.time() - launch_time}
+    if result['returncode'] != 0 or not os.path.exists(profile_path):
+        result['output'] = output.decode('utf-8', 'replace')[-4000:]
+        return result
+
+    events = read_profile(profile_path)
+    origin = events[0]['unix_time']
+    iterations = [event for event in events if event['phase'] == 'iteration']
+    evaluations = [event['seconds'] for event in events if event['phase'] == 'evaluate'][1:]
+
+    if iterations:
+        first = iterations[0]
+        result['time_to_first_iteration'] = origin + first['start'] + first['seconds'] - launch_time
+        result['final_loss'] = iterations[-1]['loss']
+    result['seconds_per_evaluation'] = median(evaluations)
+    result['nb_evaluations'] = len(evaluations) + 1
+    return result
+
+
+def run_config(name, script, extra_args, image_size, args, mask_path):
+    extra_args = [arg.replace('{mask}', mask_path) for arg in extra_args]
+    runs = []
+    for _ in range(args.repeats):
+        work_dir = tempfile.mkdtemp(prefix='bench_')
+        try:
+            runs.append(run_once(script, extra_args, image_size, args, work_dir))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    result = {'name': name, 'script': script, 'args': extra_args, 'image_size': image_size,
+              'returncode': max(run['returncode'] for run in runs)}
+    for metric in METRICS + ['wall_seconds', 'nb_evaluations']:
+        values = [run[metric] for run in runs if run.get(metric) is not None]
+        result[metric] = median(values)
+    failed = [run for run in runs if 'output' in run]
+    if failed:
+        result['output'] = failed[-1]['output']
+    return result
+
+
+def environment():
+    env = {'python': platform.python_version(), 'platform': platform.platform(),
+           'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+           'keras_backend': os.environ.get('KERAS_BACKEND')}
+    try:
+        env['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        env['commit'] = None
+    return env
+
+
+def compare(results, baseline, tolerance):
+    '''Print each metric against the baseline; returns the number of regressions.
+
+    A run that failed, or lacks a metric the baseline has, counts as a regression.
+    '''
+    baseline_runs = dict(((run['name'], run['image_size']), run) for run in baseline['results'])
+    nb_regressions = 0
+
+    print("\n%-18s %6s %-24s %12s %12s %8s" % ("entry point", "size", "metric", "baseline", "current", "change"))
+    for run in results:
+        base = baseline_runs.get((run['name'], run['image_size']))
+        if base is None:
+            continue
+        if run['returncode'] != 0:
+            print("%-18s %6d %-24s %12s %12s %8s  REGRESSION" % (run['name'], run['image_size'], "returncode",
+                                                                base['returncode'], run['returncode'], ""))
+            nb_regressions += 1
+            continue
+        for metric in METRICS:
+            old, new = base.get(metric), run.get(metric)
+            if old is None:
+                continue
+            if new is None:
+                print("%-18s %6d %-24s %12.4g %12s %8s  REGRESSION" % (run['name'], run['image_size'], metric,
+                                                                      old, "missing", ""))
+                nb_regressions += 1
+                continue
+            if old == 0:
+                continue
+            change = (new - old) / abs(old)
+            flag = ""
+            if change > tolerance:
+                flag = "  REGRESSION"
+                nb_regressions += 1
+            print("%-18s %6d %-24s %12.4g %12.4g %+7.1f%%%s" % (run['name'], run['image_size'], metric,
+                                                              old, new, change * 100, flag))
+    return nb_regressions
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    entry_points = [entry for entry in ENTRY_POINTS if entry[0] in args.entry_points]
+    unknown = set(args.entry_points) - set(name for name, _, _ in ENTRY_POINTS)
+    assert not unknown, "Unknown entry points: %s" % ", ".join(sorted(unknown))
+
+    mask_dir = tempfile.mkdtemp(prefix='bench_mask_')
+    mask_path = os.path.join(mask_dir, 'left_half.pgm')
+    write_mask(mask_path)
+
+    results = []
+    try:
+        for name, script, extra_args in entry_points:
+            for image_size in args.image_sizes:
+                print("Running %s at --image_size %d" % (name, image_size))
+                result = run_config(name, script, extra_args, image_size, args, mask_path)
+                results.append(result)
+                if result['returncode'] != 0:
+                    print("  failed with exit status %d:\n%s" % (result['returncode'], result.get('output', '')))
+                else:
+                    print("  first iteration %.1fs, %.3fs per evaluation, %.0f MB peak, final loss %.5g" % (
+                        result['time_to_first_iteration'] or 0, result['seconds_per_evaluation'] or 0,
+                        result['peak_rss_mb'], result['final_loss'] or 0))
+    finally:
+        shutil.rmtree(mask_dir, ignore_errors=True)
+
+    report = {'environment': environment(), 'num_iter': args.num_iter, 'content': args.content,
+              'style': args.style, 'results': results}
+
+    nb_regressions = 0
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            nb_regressions = compare(results, json.load(f), args.tolerance)
+        print("%d regression(s) beyond %.0f%%" % (nb_regressions, args.tolerance * 100))
+
+    # a crashed entry point fails the suite, with or without a baseline
+    nb_failed = len([result for result in results if result['returncode'] != 0])
+    if nb_failed:
+        print("%d run(s) failed" % nb_failed)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", args.output)
+
+    sys.exit(1 if nb_regressions or nb_failed else 0)
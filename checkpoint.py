@@ -0,0 +1,125 @@
+import json
+import os
+import tempfile
+import threading
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+
+class AsyncImageWriter(object):
+    '''Writes intermediate images on background threads.
+
+    `save(x, i)` deprocesses, resizes and encodes the image of iteration `i`.
+    `submit` hands it a private copy of `x` and returns at once, so the
+    optimizer goes on with the next evaluations meanwhile. At most
+    `max_pending` snapshots wait in the queue; past that `submit` blocks, so
+    a slow disk throttles the optimization instead of piling up copies of
+    the image in memory. With `nb_threads=0` images are saved synchronously.
+    '''
+    def __init__(self, save, nb_threads=1, max_pending=2):
+        self.save = save
+        self.nb_failed = 0
+        self.queue = queue.Queue(max(max_pending, 1))
+
+        self.threads = []
+        for _ in range(nb_threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _save(self, x, i):
+        try:
+            self.save(x, i)
+        except Exception:
+            traceback.print_exc()
+            self.nb_failed += 1
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._save(*item)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, x, i):
+        if not self.threads:
+            self._save(np.array(x, copy=True), i)
+        else:
+            self.queue.put((np.array(x, copy=True), i))
+
+    def flush(self):
+        '''Wait until every submitted image is written.'''
+        self.queue.join()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class Checkpoint(object):
+    '''Resumable optimization state in a directory of memory-mapped .npy files.
+
+    `save(arrays, meta)` copies every array into a preallocated memmap and
+    writes the scalars and the loss history to meta.json. The arrays go to
+    two alternating slots and meta.json, renamed into place last, names the
+    complete one, so a run killed while saving still has the previous
+    checkpoint. Saving costs a copy of the arrays and no extra allocation.
+    '''
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        self.meta_path = os.path.join(checkpoint_dir, 'meta.json')
+        self.slot = 0
+        self._memmaps = {}
+
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+    def _path(self, slot, name):
+        return os.path.join(self.checkpoint_dir, '%s.%d.npy' % (name, slot))
+
+    def _memmap(self, slot, name, value):
+        mm = self._memmaps.get((slot, name))
+        if mm is None or mm.shape != value.shape or mm.dtype != value.dtype:
+            mm = np.lib.format.open_memmap(self._path(slot, name), mode='w+', dtype=value.dtype,
+                                           shape=value.shape)
+            self._memmaps[(slot, name)] = mm
+        return mm
+
+    def save(self, arrays, meta):
+        slot = 1 - self.slot
+        for name, value in arrays.items():
+            value = np.asarray(value)
+            mm = self._memmap(slot, name, value)
+            mm[...] = value
+            mm.flush()
+
+        meta = dict(meta, slot=slot, arrays=sorted(arrays))
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.checkpoint_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_path, self.meta_path)
+        self.slot = slot
+
+    def load(self):
+        '''(arrays, meta) of the last complete checkpoint, or None. The arrays are read-only memmaps.'''
+        if not os.path.exists(self.meta_path):
+            return None
+
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        self.slot = meta['slot']
+        arrays = dict((name, np.load(self._path(self.slot, name), mmap_mode='r')) for name in meta['arrays'])
+        return arrays, meta
@@ -0,0 +1,74 @@
+import hashlib
+import os
+
+"""
+Pieces shared by the on-disk caches (gram_cache.GramCache and
+result_cache.ResultCache): content digests of input files, and a directory
+of entries trimmed to a size budget in least recently used order.
+"""
+
+# path -> ((mtime, size), sha1 hex digest)
+_digests = {}
+
+
+def file_digest(path):
+    '''sha1 of the bytes of `path`, computed again only when its mtime or size changes.'''
+    stat = os.stat(path)
+    signature = (stat.st_mtime, stat.st_size)
+    cached = _digests.get(path)
+    if cached is None or cached[0] != signature:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        cached = _digests[path] = (signature, sha.hexdigest())
+    return cached[1]
+
+
+class DiskCache(object):
+    '''A directory of cache entries named `<key><extension>`.
+
+    Once the entries grow past `max_bytes` the least recently used ones are
+    deleted, together with their files of the same key and any of
+    `companion_extensions`. Subclasses mark an entry as used by touching it.
+    '''
+    extension = ''
+    companion_extensions = ()
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def file_digest(self, path):
+        return file_digest(path)
+
+    def _path(self, key, extension=None):
+        return os.path.join(self.cache_dir, key + (self.extension if extension is None else extension))
+
+    def evict(self):
+        '''Delete least recently used entries until the cache fits in `max_bytes`.'''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.extension):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            key_path = path[:-len(self.extension)] if self.extension else path
+            for entry_path in [path] + [key_path + extension for extension in self.companion_extensions]:
+                try:
+                    os.remove(entry_path)
+                except OSError:
+                    pass
+            total -= size
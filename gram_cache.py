@@ -0,0 +1,56 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from disk_cache import DiskCache
+
+
+class GramCache(DiskCache):
+    '''Content-addressed on-disk cache of style gram matrices.
+
+    Every entry is a .npy file named after a hash of the style image bytes and
+    of everything that changes its features (image size, model, pooling type,
+    layer, mask). Entries are loaded memory-mapped, and once the cache grows
+    past `max_bytes` the least recently used ones are deleted.
+    '''
+    extension = '.npy'
+
+    def key(self, image_path, layer_name, mask_path=None, **params):
+        '''Cache key of the gram matrix of `image_path` at `layer_name`.
+
+        `params` holds the settings the features depend on, such as
+        size=(width, height), model='vgg16' and pool='max'.
+        '''
+        sha = hashlib.sha1()
+        sha.update(self.file_digest(image_path).encode('utf-8'))
+        if mask_path is not None:
+            sha.update(self.file_digest(mask_path).encode('utf-8'))
+        sha.update(layer_name.encode('utf-8'))
+        sha.update(repr(sorted(params.items())).encode('utf-8'))
+        return sha.hexdigest()
+
+    def get(self, key):
+        '''Return the cached gram matrix as a read-only memmap, or None.'''
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            gram = np.load(path, mmap_mode='r')
+        except (IOError, ValueError):
+            # partially written or corrupted entry
+            os.remove(path)
+            return None
+
+        os.utime(path, None)  # mark as recently used
+        return gram
+
+    def put(self, key, gram):
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.ascontiguousarray(gram))
+        os.rename(tmp_path, self._path(key))
+
+        self.evict()
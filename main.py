@@ -1,21 +1,24 @@
 from scipy.misc import imread, imresize, imsave, fromimage, toimage
-from scipy.optimize import fmin_l_bfgs_b
 import scipy.interpolate
 import scipy.ndimage
 import numpy as np
 import time
 import argparse
+import sys
 import warnings
 from sklearn.feature_extraction.image import reconstruct_from_patches_2d, extract_patches_2d
 
 from keras.models import Model
 from keras.layers import Input
-from keras.layers.convolutional import Convolution2D, AveragePooling2D, MaxPooling2D
 from keras import backend as K
-from keras.utils.data_utils import get_file
-from keras.utils.layer_utils import convert_all_kernels_in_model
 
-TF_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5'
+from gram_cache import GramCache
+from checkpoint import AsyncImageWriter, Checkpoint
+from optimizer import BufferedEvaluator, LBFGSDriver
+from profiling import Profiler, profile_forward
+from result_cache import ResultCache
+from stopping import StoppingPolicy
+from style_engine import vgg_layers, load_vgg_weights, blend_style_targets
 
 parser = argparse.ArgumentParser(description='Neural style transfer with Keras.')
 parser.add_argument('base_image_path', metavar='base', type=str,
@@ -54,8 +57,68 @@ parser.add_argument("--content_layer", dest="content_layer", default="conv5_2",
 parser.add_argument("--init_image", dest="init_image", default="content", type=str,
                     help="Initial image used to generate the final image. Options are 'content', 'noise', or 'gray'")
 
+parser.add_argument("--precompute_targets", dest="precompute_targets", default="True", type=str,
+                    help="Run the content and style images through VGG once and keep their features as constants")
 
+parser.add_argument("--evals_per_iter", dest="evals_per_iter", default=20, type=int,
+                    help="Function evaluations per iteration. L-BFGS keeps its state across iterations "
+                         "and an image is saved after each one")
 
+parser.add_argument("--float32_optimizer", dest="float32_optimizer", default="False", type=str,
+                    help="Run L-BFGS in float32 instead of scipy's float64 L-BFGS-B, halving its memory")
+
+parser.add_argument("--save_every", dest="save_every", default=1, type=int,
+                    help="Save an image every this many iterations. 0 saves only the final image")
+
+parser.add_argument("--save_threads", dest="save_threads", default=1, type=int,
+                    help="Threads writing the images in the background. 0 writes them on the main thread")
+
+parser.add_argument('--min_improvement', default=0.0, type=float,
+                    help='Stop once the loss improves by less than this many percent over --improvement_window '
+                         'iterations (0 never stops)')
+
+parser.add_argument('--improvement_window', default=1, type=int,
+                    help='Number of iterations the improvement is measured over')
+
+parser.add_argument('--target_loss', default=None, type=float,
+                    help='Stop once the loss reaches this value')
+
+parser.add_argument('--max_seconds', default=None, type=float,
+                    help='Wall-clock budget of the run in seconds, after which the best image so far is written')
+
+parser.add_argument("--profile", dest="profile", default=None, type=str,
+                    help="Write the time spent in each phase of the run to this file")
+
+parser.add_argument("--profile_format", dest="profile_format", default="jsonl", type=str,
+                    help="Format of the --profile file: 'jsonl' (one JSON object per line) or 'chrome' (Chrome trace)")
+
+parser.add_argument("--checkpoint_dir", dest="checkpoint_dir", default=None, type=str,
+                    help="Save the optimization state to this directory after every iteration")
+
+parser.add_argument("--resume", dest="resume", default="False", type=str,
+                    help="Continue from the state in --checkpoint_dir, if there is one")
+
+parser.add_argument("--blend_styles", dest="blend_styles", default="False", type=str,
+                    help="Replace the per style losses with one loss against the weighted mean gram matrix")
+
+parser.add_argument("--gram_cache_dir", dest="gram_cache_dir", default=None, type=str,
+                    help="Directory of the on-disk cache of style gram matrices (disabled if not set)")
+
+parser.add_argument("--gram_cache_size", dest="gram_cache_size", default=1024, type=int,
+                    help="Maximum size of the style gram matrix cache in MB")
+
+parser.add_argument("--result_cache_dir", dest="result_cache_dir", default=None, type=str,
+                    help="Directory of the on-disk cache of final images; identical requests are served from it")
+
+parser.add_argument("--result_cache_size", dest="result_cache_size", default=4096, type=int,
+                    help="Maximum size of the result cache in MB")
+
+parser.add_argument("--import_result", dest="import_result", default=None, type=str,
+                    help="Add this image, made earlier with the same arguments, to --result_cache_dir and exit")
+
+
+def str_to_bool(v):
+    return v.lower() in ("true", "yes", "t", "1")
 
 args = parser.parse_args()
 base_image_path = args.base_image_path
@@ -64,6 +127,34 @@ style_image_paths = [path for path in args.style_image_paths]
 result_prefix = args.result_prefix
 content_weight = args.content_weight
 total_variation_weight = args.tv_weight
+precompute_targets = str_to_bool(args.precompute_targets)
+float32_optimizer = str_to_bool(args.float32_optimizer)
+optimizer_dtype = 'float32' if float32_optimizer else 'float64'
+stopping = StoppingPolicy(args.min_improvement, args.improvement_window, args.target_loss, args.max_seconds)
+profiler = Profiler(args.profile, args.profile_format)
+resume = str_to_bool(args.resume)
+assert args.checkpoint_dir is not None or not resume, "Resuming requires --checkpoint_dir"
+blend_styles = str_to_bool(args.blend_styles)
+assert precompute_targets or not blend_styles, "Blending styles requires precomputed targets"
+
+gram_cache = None
+if args.gram_cache_dir is not None:
+    gram_cache = GramCache(args.gram_cache_dir, args.gram_cache_size * 1024 ** 2)
+
+result_cache = None
+if args.result_cache_dir is not None:
+    result_cache = ResultCache(args.result_cache_dir, args.result_cache_size * 1024 ** 2)
+    result_key = result_cache.key(args, 'main.py')
+
+    if args.import_result is not None:
+        result_cache.import_result(result_key, args.import_result, args.num_iter)
+        print('Imported %s into the result cache' % args.import_result)
+        sys.exit(0)
+
+    cached_path = result_cache.restore(result_key, result_prefix, '_final.png')
+    if cached_path is not None:
+        print('Identical request found in the result cache, image saved as', cached_path)
+        sys.exit(0)
 
 img_width = img_height = 0
 
@@ -81,10 +172,6 @@ if len(style_image_paths) != len(args.style_weight):
 else:
     style_weights = [weight*args.style_scale for weight in args.style_weight]
 
-def pooling_func(x):
-    # return AveragePooling2D((2, 2), strides=(2, 2))(x)
-    return MaxPooling2D((2, 2), strides=(2, 2))(x)
-
 #start proc_img
 
 def preprocess_image(image_path, load_dims=False):
@@ -92,8 +179,10 @@ def preprocess_image(image_path, load_dims=False):
 
     mode = "RGB"
     # mode = "RGB" if read_mode == "color" else "L"
-    img = imread(image_path, mode=mode)  # Prevents crashes due to PNG images (ARGB)
+    with profiler.phase('decode', path=image_path):
+        img = imread(image_path, mode=mode)  # Prevents crashes due to PNG images (ARGB)
 
+    phase_start = time.time()
     if load_dims:
         img_WIDTH = img.shape[0]
         img_HEIGHT = img.shape[1]
@@ -113,6 +202,7 @@ def preprocess_image(image_path, load_dims=False):
 
 
     img = np.expand_dims(img, axis=0)
+    profiler.record('preprocess', phase_start, time.time() - phase_start, path=image_path)
     return img
 
 
@@ -132,20 +222,25 @@ def deprocess_image(x):
 
 
 
-base_image = K.variable(preprocess_image(base_image_path, True))
+base_image = preprocess_image(base_image_path, True)
 
-style_reference_images = [K.variable(preprocess_image(path)) for path in style_image_paths]
+style_reference_images = [preprocess_image(path) for path in style_image_paths]
 
 # this will contain our generated image
 combination_image = K.placeholder((1, img_width, img_height, 3)) # tensorflow
 
-image_tensors = [base_image]
-for style_image_tensor in style_reference_images:
-    image_tensors.append(style_image_tensor)
-image_tensors.append(combination_image)
+if precompute_targets:
+    # Only the generated image goes through the network on every evaluation.
+    # The content and style targets are computed once after the model is built.
+    image_tensors = [combination_image]
+else:
+    image_tensors = [K.variable(base_image)]
+    for style_image in style_reference_images:
+        image_tensors.append(K.variable(style_image))
+    image_tensors.append(combination_image)
 
 nb_tensors = len(image_tensors)
-nb_style_images = nb_tensors - 2 # Content and Output image not considered
+nb_style_images = len(style_reference_images)
 
 # combine the various images into a single Keras tensor
 input_tensor = K.concatenate(image_tensors, axis=0)
@@ -156,37 +251,19 @@ shape = (nb_tensors, img_width, img_height, 3) #tensorflow
 #build the model
 model_input = Input(tensor=input_tensor, shape=shape)
 
-# build the VGG16 network with our 3 images as input
-x = Convolution2D(64, 3, 3, activation='relu', name='conv1_1', border_mode='same')(model_input)
-x = Convolution2D(64, 3, 3, activation='relu', name='conv1_2', border_mode='same')(x)
-x = pooling_func(x)
-
-x = Convolution2D(128, 3, 3, activation='relu', name='conv2_1', border_mode='same')(x)
-x = Convolution2D(128, 3, 3, activation='relu', name='conv2_2', border_mode='same')(x)
-x = pooling_func(x)
-
-x = Convolution2D(256, 3, 3, activation='relu', name='conv3_1', border_mode='same')(x)
-x = Convolution2D(256, 3, 3, activation='relu', name='conv3_2', border_mode='same')(x)
-x = Convolution2D(256, 3, 3, activation='relu', name='conv3_3', border_mode='same')(x)
-x = pooling_func(x)
-
-x = Convolution2D(512, 3, 3, activation='relu', name='conv4_1', border_mode='same')(x)
-x = Convolution2D(512, 3, 3, activation='relu', name='conv4_2', border_mode='same')(x)
-x = Convolution2D(512, 3, 3, activation='relu', name='conv4_3', border_mode='same')(x)
-x = pooling_func(x)
+feature_layers = ['conv1_1', 'conv2_1', 'conv3_1', 'conv4_1', 'conv5_1']
 
-x = Convolution2D(512, 3, 3, activation='relu', name='conv5_1', border_mode='same')(x)
-x = Convolution2D(512, 3, 3, activation='relu', name='conv5_2', border_mode='same')(x)
-x = Convolution2D(512, 3, 3, activation='relu', name='conv5_3', border_mode='same')(x)
-x = pooling_func(x)
+# build the network only up to the deepest layer the losses read from
+phase_start = time.time()
+x = model_input
+for layer in vgg_layers('vgg16', 'max', [args.content_layer] + feature_layers):
+    x = layer(x)
 
 model = Model(model_input, x)
+profiler.record('build_model', phase_start, time.time() - phase_start)
 
-weights = get_file('vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5', TF_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
-
-print("Weights Path: ", weights)
-
-model.load_weights(weights)
+with profiler.phase('load_weights'):
+    load_vgg_weights(model, 'vgg16')
 
 print('Model loaded.')
 
@@ -226,13 +303,18 @@ def gram_matrix(x):
     return gram
 
 
+# numpy version of gram_matrix, used for the precomputed style targets
+def gram_matrix_value(x):
+    features = x.reshape((-1, x.shape[-1]))
+    return features.T.dot(features)
+
+
 # the "style loss" is designed to maintain
 # the style of the reference image in the generated image.
 # It is based on the gram matrices (which capture style) of
 # feature maps from the style reference image
 # and from the generated image
-def style_loss(style, combination):
-    style_gram = gram_matrix(style)
+def style_loss(style_gram, combination):
     combo_gram = gram_matrix(combination)
     channels = 3
     size = img_width * img_height
@@ -265,27 +347,71 @@ def total_variation_loss(x):
     return K.sum(K.pow(a + b, 1.25))
 
 
+combination_index = nb_tensors - 1
+
+# content features and style gram matrices the generated image is pulled towards
+phase_start = time.time()
+if precompute_targets:
+    content_fn = K.function([combination_image], [outputs_dict[args.content_layer]])
+    content_target = K.variable(content_fn([base_image])[0][0])
+
+    style_fn = K.function([combination_image], [outputs_dict[layer_name] for layer_name in feature_layers])
+    style_grams = dict([(layer_name, []) for layer_name in feature_layers])
+    for j, style_image in enumerate(style_reference_images):
+        grams = None
+        if gram_cache is not None:
+            cache_keys = [gram_cache.key(style_image_paths[j], layer_name, size=(img_width, img_height),
+                                         model='vgg16', pool='max')
+                          for layer_name in feature_layers]
+            grams = [gram_cache.get(key) for key in cache_keys]
+            if any(gram is None for gram in grams):
+                grams = None
+
+        if grams is None:
+            style_outputs = style_fn([style_image])
+            grams = [gram_matrix_value(style_features[0]) for style_features in style_outputs]
+            if gram_cache is not None:
+                for key, gram in zip(cache_keys, grams):
+                    gram_cache.put(key, gram)
+
+        for layer_name, gram in zip(feature_layers, grams):
+            style_grams[layer_name].append(gram)
+
+    if blend_styles:
+        blended, style_weights = blend_style_targets([style_grams[layer_name] for layer_name in feature_layers],
+                                                     style_weights)
+        style_grams = dict(zip(feature_layers, blended))
+        nb_style_images = 1
+
+    style_targets = dict([(layer_name, [K.variable(gram) for gram in style_grams[layer_name]])
+                          for layer_name in feature_layers])
+
+    print('Style and content targets precomputed.')
+else:
+    content_target = outputs_dict[args.content_layer][0, :, :, :]
+    style_targets = dict([(layer_name, [gram_matrix(outputs_dict[layer_name][j + 1, :, :, :])
+                                        for j in range(nb_style_images)])
+                          for layer_name in feature_layers])
+profiler.record('targets', phase_start, time.time() - phase_start)
+
 # combine these loss functions into a single scalar
+phase_start = time.time()
 loss = K.variable(0.)
 layer_features = outputs_dict[args.content_layer]  # 'conv5_2' or 'conv4_2'
-base_image_features = layer_features[0, :, :, :]
-combination_features = layer_features[nb_tensors - 1, :, :, :]
-loss += content_weight * content_loss(base_image_features,
+combination_features = layer_features[combination_index, :, :, :]
+loss += content_weight * content_loss(content_target,
                                       combination_features)
 
 channel_index = -1
 
 #Style Loss calculation
-feature_layers = ['conv1_1', 'conv2_1', 'conv3_1', 'conv4_1', 'conv5_1']
 for layer_name in feature_layers:
     output_features = outputs_dict[layer_name]
-    shape = shape_dict[layer_name]
-    combination_features = output_features[nb_tensors - 1, :, :, :]
+    combination_features = output_features[combination_index, :, :, :]
 
-    style_features = output_features[1:nb_tensors - 1, :, :, :]
     sl = []
     for j in range(nb_style_images):
-        sl.append(style_loss(style_features[j], combination_features))
+        sl.append(style_loss(style_targets[layer_name][j], combination_features))
 
     for j in range(nb_style_images):
         loss += (style_weights[j] / len(feature_layers)) * sl[j]
@@ -300,48 +426,16 @@ if type(grads) in {list, tuple}:
     outputs += grads
 else:
     outputs.append(grads)
+profiler.record('build_loss', phase_start, time.time() - phase_start)
 
-f_outputs = K.function([combination_image], outputs)
+with profiler.phase('compile'):
+    f_outputs = K.function([combination_image], outputs)
+f_outputs = profiler.wrap('evaluate', f_outputs)  # the first call includes the backend's lazy setup
 
 
-def eval_loss_and_grads(x):
-    x = x.reshape((1, img_width, img_height, 3))
-    outs = f_outputs([x])
-    loss_value = outs[0]
-    if len(outs[1:]) == 1:
-        grad_values = outs[1].flatten().astype('float64')
-    else:
-        grad_values = np.array(outs[1:]).flatten().astype('float64')
-    return loss_value, grad_values
-
-
-# # this Evaluator class makes it possible
-# # to compute loss and gradients in one pass
-# # while retrieving them via two separate functions,
-# # "loss" and "grads". This is done because scipy.optimize
-# # requires separate functions for loss and gradients,
-# # but computing them separately would be inefficient.
-class Evaluator(object):
-    def __init__(self):
-        self.loss_value = None
-        self.grads_values = None
-
-    def loss(self, x):
-        assert self.loss_value is None
-        loss_value, grad_values = eval_loss_and_grads(x)
-        self.loss_value = loss_value
-        self.grad_values = grad_values
-        return self.loss_value
-
-    def grads(self, x):
-        assert self.loss_value is not None
-        grad_values = np.copy(self.grad_values)
-        self.loss_value = None
-        self.grad_values = None
-        return grad_values
-
-
-evaluator = Evaluator()
+# computes loss and gradients in one pass and hands them to the optimizer
+# through "loss" and "grads", reusing the same buffers on every evaluation
+evaluator = BufferedEvaluator(f_outputs, K.int_shape(combination_image), dtype=optimizer_dtype)
 
 # run scipy-based optimization (L-BFGS) over the pixels of the generated image
 # so as to minimize the neural style loss
@@ -358,15 +452,38 @@ else:
     print("Using initial image : ", args.init_image)
     x = preprocess_image(args.init_image)
 
+profile_forward(profiler, [combination_image], loss, [x])
+
 num_iter = args.num_iter
 prev_min_val = -1
+start_time = time.time()
+
+
+# deprocesses, rescales and writes the generated image of iteration i (None for the best image),
+# run by the image writer on a copy of x
+def save_image(x, i):
+    phase_start = time.time()
+    img = deprocess_image(x)
+
+    img_ht = int(img_width * aspect_ratio)
+    img = imresize(img, (img_width, img_ht), interp="bilinear")
+    profiler.record('postprocess', phase_start, time.time() - phase_start, n=i)
+
+    if i is None:
+        fname = result_prefix + '_final.png'  # the best image of the run
+    else:
+        fname = result_prefix + '_at_iteration_%d.png' % i
+    with profiler.phase('encode', n=i):
+        imsave(fname, img)
+    print('Image saved as', fname)
+
 
+writer = AsyncImageWriter(save_image, nb_threads=args.save_threads)
 
-for i in range(num_iter):
-    print("Starting iteration %d of %d" % ((i + 1), num_iter))
-    start_time = time.time()
 
-    x, min_val, info = fmin_l_bfgs_b(evaluator.loss, x.flatten(), fprime=evaluator.grads, maxfun=20)
+# called by the optimizer after each iteration of `evals_per_iter` evaluations
+def save_iteration(x, min_val, i):
+    global prev_min_val, start_time
 
     if prev_min_val == -1:
         prev_min_val = min_val
@@ -375,15 +492,27 @@ for i in range(num_iter):
 
     print('Current loss value:', min_val, " Improvement : %0.3f" % improvement, "%")
     prev_min_val = min_val
-    # save current generated image
-    img = deprocess_image(x.copy())
 
-    img_ht = int(img_width * aspect_ratio)
-    print("Rescaling Image to (%d, %d)" % (img_width, img_ht))
-    img = imresize(img, (img_width, img_ht), interp="bilinear")
+    if args.save_every > 0 and i % args.save_every == 0:
+        writer.submit(x, i)
 
-    fname = result_prefix + '_at_iteration_%d.png' % (i + 1)
-    imsave(fname, img)
     end_time = time.time()
-    print('Image saved as', fname)
-    print('Iteration %d completed in %ds' % (i + 1, end_time - start_time))
+    print('Iteration %d completed in %ds' % (i, end_time - start_time))
+    profiler.record('iteration', start_time, end_time - start_time, n=i, loss=float(min_val))
+    start_time = end_time
+
+
+print("Starting %d iterations of %d evaluations" % (num_iter, args.evals_per_iter))
+checkpoint = Checkpoint(args.checkpoint_dir) if args.checkpoint_dir is not None else None
+driver = LBFGSDriver(evaluator.loss, evaluator.grads, num_iter * args.evals_per_iter, save_every=args.evals_per_iter,
+                     dtype=optimizer_dtype, checkpoint=checkpoint, stopping=stopping)
+x, min_val, nb_evals = driver.run(x, callback=save_iteration, resume=resume)
+
+if x is not None:
+    # the best checkpoint, which need not be the last iterate saved under _at_iteration_<i>.png
+    writer.submit(x, None)
+writer.close()
+
+if result_cache is not None and x is not None and writer.nb_failed == 0:
+    result_cache.put(result_key, result_prefix + '_final.png', driver.nb_checkpoints)
+profiler.close()
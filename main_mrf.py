@@ -1,5 +1,4 @@
 from scipy.misc import imread, imresize, imsave, fromimage, toimage
-from scipy.optimize import fmin_l_bfgs_b
 import scipy.interpolate
 import scipy.ndimage
 import numpy as np
@@ -8,14 +7,13 @@ import argparse
 import warnings
 from sklearn.feature_extraction.image import reconstruct_from_patches_2d, extract_patches_2d
 
-from keras.models import Model
-from keras.layers import Input
-from keras.layers.convolutional import Convolution2D, AveragePooling2D, MaxPooling2D
 from keras import backend as K
-from keras.utils.data_utils import get_file
-from keras.utils.layer_utils import convert_all_kernels_in_model
 
-TF_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5'
+from checkpoint import AsyncImageWriter
+from optimizer import BufferedEvaluator, LBFGSDriver
+from profiling import Profiler, profile_forward
+from stopping import StoppingPolicy
+from style_engine import VGGFeatures, pyramid_sizes, resize_image
 
 parser = argparse.ArgumentParser(description='Neural style transfer with Keras.')
 parser.add_argument('base_image_path', metavar='base', type=str,
@@ -28,7 +26,10 @@ parser.add_argument('result_prefix', metavar='res_prefix', type=str,
                     help='Prefix for the saved results.')
 
 parser.add_argument("--image_size", dest="img_size", default=400, type=int,
-                    help='Minimum image size')
+                    help='Output image size, the finest scale of the pyramid')
+
+parser.add_argument("--min_scale_size", dest="min_scale_size", default=64, type=int,
+                    help='Size of the coarsest scale; the sizes double from there up to --image_size')
 
 parser.add_argument("--content_weight", dest="content_weight", default=0.025, type=float,
                     help="Weight of content")
@@ -43,7 +44,7 @@ parser.add_argument("--style_scale", dest="style_scale", default=1.0, type=float
                     help="Scale the weighing of the style")
 
 parser.add_argument("--num_iter", dest="num_iter", default=10, type=int,
-                    help="Number of iterations")
+                    help="Number of iterations over all scales, coarse scales getting more of them")
 
 parser.add_argument("--content_loss_type", default=0, type=int,
                     help='Can be one of 0, 1 or 2. Readme contains the required information of each mode.')
@@ -54,6 +55,45 @@ parser.add_argument("--content_layer", dest="content_layer", default="conv5_2",
 parser.add_argument("--init_image", dest="init_image", default="content", type=str,
                     help="Initial image used to generate the final image. Options are 'content', 'noise', or 'gray'")
 
+parser.add_argument("--precompute_targets", dest="precompute_targets", default="True", type=str,
+                    help="Run the content and style images through VGG once and keep their features as constants")
+
+parser.add_argument("--evals_per_iter", dest="evals_per_iter", default=20, type=int,
+                    help="Function evaluations per iteration. L-BFGS keeps its state across iterations "
+                         "and an image is saved after each one")
+
+parser.add_argument("--float32_optimizer", dest="float32_optimizer", default="False", type=str,
+                    help="Run L-BFGS in float32 instead of scipy's float64 L-BFGS-B, halving its memory")
+
+parser.add_argument("--save_every", dest="save_every", default=1, type=int,
+                    help="Save an image every this many iterations. 0 saves only the final image")
+
+parser.add_argument("--save_threads", dest="save_threads", default=1, type=int,
+                    help="Threads writing the images in the background. 0 writes them on the main thread")
+
+parser.add_argument('--min_improvement', default=0.0, type=float,
+                    help='Stop once the loss improves by less than this many percent over --improvement_window '
+                         'iterations (0 never stops)')
+
+parser.add_argument('--improvement_window', default=1, type=int,
+                    help='Number of iterations the improvement is measured over')
+
+parser.add_argument('--target_loss', default=None, type=float,
+                    help='Stop once the loss of the final scale reaches this value')
+
+parser.add_argument('--max_seconds', default=None, type=float,
+                    help='Wall-clock budget of the run in seconds, after which the best image so far is written')
+
+parser.add_argument("--profile", dest="profile", default=None, type=str,
+                    help="Write the time spent in each phase of the run to this file")
+
+parser.add_argument("--profile_format", dest="profile_format", default="jsonl", type=str,
+                    help="Format of the --profile file: 'jsonl' (one JSON object per line) or 'chrome' (Chrome trace)")
+
+
+def str_to_bool(v):
+    return v.lower() in ("true", "yes", "t", "1")
+
 
 args = parser.parse_args()
 base_image_path = args.base_image_path
@@ -62,17 +102,16 @@ style_image_paths = [path for path in args.style_image_paths]
 result_prefix = args.result_prefix
 content_weight = args.content_weight
 total_variation_weight = args.tv_weight
+precompute_targets = str_to_bool(args.precompute_targets)
+float32_optimizer = str_to_bool(args.float32_optimizer)
+optimizer_dtype = 'float32' if float32_optimizer else 'float64'
+stopping = StoppingPolicy(args.min_improvement, args.improvement_window, args.target_loss, args.max_seconds)
+profiler = Profiler(args.profile, args.profile_format)
 
-scale_sizes = []
-size = args.img_size
-while size > 64:
-    scale_sizes.append(size/2)
-    size /= 2
-
-img_width = img_height = 0
-
-img_WIDTH = img_HEIGHT = 0
-aspect_ratio = 0
+# the pyramid, coarse to fine; the iterations halve from one scale to the next
+scale_sizes = pyramid_sizes(args.img_size, min(args.min_scale_size, args.img_size))
+scale_weights = [2 ** (len(scale_sizes) - 1 - level) for level in range(len(scale_sizes))]
+scale_iters = [max(int(round(args.num_iter * weight / float(sum(scale_weights)))), 1) for weight in scale_weights]
 
 read_mode = "color"
 style_weights = []
@@ -85,27 +124,18 @@ if len(style_image_paths) != len(args.style_weight):
 else:
     style_weights = [weight*args.style_scale for weight in args.style_weight]
 
-def pooling_func(x):
-    # return AveragePooling2D((2, 2), strides=(2, 2))(x)
-    return MaxPooling2D((2, 2), strides=(2, 2))(x)
-
 #start proc_img
 
-def preprocess_image(image_path, sc_size=args.img_size, load_dims=False):
-    global img_width, img_height, img_WIDTH, img_HEIGHT, aspect_ratio
-
+def decode_image(image_path):
     mode = "RGB"
     # mode = "RGB" if read_mode == "color" else "L"
-    img = imread(image_path, mode=mode)  # Prevents crashes due to PNG images (ARGB)
+    with profiler.phase('decode', path=image_path):
+        return imread(image_path, mode=mode)  # Prevents crashes due to PNG images (ARGB)
 
-    if load_dims:
-        img_WIDTH = img.shape[0]
-        img_HEIGHT = img.shape[1]
-        aspect_ratio = float(img_HEIGHT) / img_WIDTH
-
-        img_width = sc_size
-        img_height = int(img_width * aspect_ratio)
 
+# util function to resize and format a decoded picture into the appropriate tensor
+def preprocess_image(img, img_width, img_height):
+    phase_start = time.time()
     img = imresize(img, (img_width, img_height)).astype('float32')
 
     # RGB -> BGR
@@ -117,11 +147,12 @@ def preprocess_image(image_path, sc_size=args.img_size, load_dims=False):
 
 
     img = np.expand_dims(img, axis=0)
+    profiler.record('preprocess', phase_start, time.time() - phase_start, size=img_width)
     return img
 
 
 # util function to convert a tensor into a valid image
-def deprocess_image(x):
+def deprocess_image(x, img_width, img_height):
     x = x.reshape((img_width, img_height, 3))
 
     x[:, :, 0] += 103.939
@@ -134,170 +165,151 @@ def deprocess_image(x):
     x = np.clip(x, 0, 255).astype('uint8')
     return x
 
-combination_prev = ""
 
-for scale_size in scale_sizes:
-    base_image = K.variable(preprocess_image(base_image_path, scale_size, True))
+# every input is decoded once; each scale resizes the decoded images
+base_img = decode_image(base_image_path)
+style_imgs = [decode_image(path) for path in style_image_paths]
+aspect_ratio = float(base_img.shape[1]) / base_img.shape[0]
+
+mrf_layers = ['conv3_1', 'conv4_1']
+# feature_layers = ['conv1_1', 'conv2_1', 'conv3_1', 'conv4_1', 'conv5_1']
+
+# one fully convolutional VGG, up to the deepest layer the losses read from,
+# with its weights loaded once and shared by the graphs of every scale
+with profiler.phase('load_weights'):
+    features = VGGFeatures('vgg16', 'max', [args.content_layer] + mrf_layers)
+
+if precompute_targets:
+    # Only the generated image goes through the network on every evaluation.
+    # The content and style features of every scale come from one function
+    # compiled for images of any size.
+    target_image = K.placeholder((1, None, None, 3))
+    target_outputs = features(target_image, batch_shape=(1, None, None, 3))
+    with profiler.phase('compile', function='targets'):
+        content_fn = K.function([target_image], [target_outputs[args.content_layer]])
+        style_fn = K.function([target_image], [target_outputs[layer_name] for layer_name in mrf_layers])
+
+
+# compute the neural style loss
+# first we need to define 4 util functions
+
+# the 3rd loss function, total variation loss,
+# designed to keep the generated image locally coherent
+def total_variation_loss(x, img_width, img_height):
+    assert K.ndim(x) == 4
+    a = K.square(x[:, :img_width - 1, :img_height - 1, :] - x[:, 1:, :img_height - 1, :])
+    b = K.square(x[:, :img_width - 1, :img_height - 1, :] - x[:, :img_width - 1, 1:, :])
+    return K.sum(K.pow(a + b, 1.25))
+
+
+def make_patches(x, feature_shape, patch_size, patch_stride):
+    '''Break the feature map `x` of shape `feature_shape` (rows, cols, channels) up into patches,
+    one per row of a matrix.'''
+    rows, cols, channels = feature_shape
+    slices = [x[i:i + rows - patch_size + 1:patch_stride, j:j + cols - patch_size + 1:patch_stride, :]
+              for i in range(patch_size) for j in range(patch_size)]
+    patches = K.concatenate(slices, axis=-1)
+    return K.reshape(patches, (-1, patch_size * patch_size * channels))
+
+
+def find_patch_matches(comb, ref, ref_norm):
+    '''For each patch in combination, find the best matching patch in reference'''
+    # normalized cross-correlation; the norm of the combination patch does not change the argmax
+    similarity = K.dot(comb, K.transpose(ref / ref_norm))
+    return K.argmax(similarity, axis=1)
+
+
+def mrf_loss(source, combination, feature_shape, patch_size=3, patch_stride=1):
+    '''CNNMRF http://arxiv.org/pdf/1601.04589v1.pdf'''
+    # extract patches from style and combination feature maps
+    combination_patches = make_patches(combination, feature_shape, patch_size, patch_stride)
+    source_patches = make_patches(source, feature_shape, patch_size, patch_stride)
+    source_patches_norm = K.sqrt(K.sum(K.square(source_patches), axis=1, keepdims=True)) + K.epsilon()
+    # find best patches and calculate loss
+    patch_ids = find_patch_matches(combination_patches, source_patches, source_patches_norm)
+    best_source_patches = K.stop_gradient(K.gather(source_patches, patch_ids))
+    loss = K.sum(K.square(best_source_patches - combination_patches)) / patch_size ** 2
+    return loss
+
+# an auxiliary loss function
+# designed to maintain the "content" of the
+# base image in the generated image
+def content_loss(base, combination, img_width, img_height):
+    channels = K.cast(K.shape(base)[-1], K.floatx())
+    size = img_width * img_height
+
+    if args.content_loss_type == 1:
+        multiplier = 1 / (2. * K.sqrt(channels) * size ** 0.5)
+    elif args.content_loss_type == 2:
+        multiplier = 1 / (channels * size)
+    else:
+        multiplier = 1.
+
+    return multiplier * K.sum(K.square(combination - base))
+
 
-    style_reference_images = [K.variable(preprocess_image(path)) for path in style_image_paths]
+def build_scale(img_width, img_height):
+    '''Loss of the scale img_width x img_height and the compiled function of its value and gradients.'''
+    base_image = preprocess_image(base_img, img_width, img_height)
+    # the style images are resized to the size of the scale like the content image
+    style_reference_images = [preprocess_image(img, img_width, img_height) for img in style_imgs]
 
     # this will contain our generated image
-    if combination_prev != "":
-        combination_image = imresize(combination_prev, (img_width, img_height), interp="bilinear").astype('float32')
-    else:
-        combination_image = K.placeholder((1, img_width, img_height, 3)) # tensorflow
+    combination_image = K.placeholder((1, img_width, img_height, 3)) # tensorflow
 
-    image_tensors = [base_image]
-    for style_image_tensor in style_reference_images:
-        image_tensors.append(style_image_tensor)
-    image_tensors.append(combination_image)
+    if precompute_targets:
+        image_tensors = [combination_image]
+    else:
+        image_tensors = [K.variable(base_image)]
+        for style_image in style_reference_images:
+            image_tensors.append(K.variable(style_image))
+        image_tensors.append(combination_image)
 
     nb_tensors = len(image_tensors)
-    nb_style_images = nb_tensors - 2 # Content and Output image not considered
+    nb_style_images = len(style_reference_images)
+    combination_index = nb_tensors - 1
 
     # combine the various images into a single Keras tensor
     input_tensor = K.concatenate(image_tensors, axis=0)
-
     shape = (nb_tensors, img_width, img_height, 3) #tensorflow
 
+    with profiler.phase('build_model', size=img_width):
+        outputs_dict = features(input_tensor, batch_shape=shape)
 
-    #build the model
-    model_input = Input(tensor=input_tensor, shape=shape)
-
-    # build the VGG16 network with our 3 images as input
-    x = Convolution2D(64, 3, 3, activation='relu', name='conv1_1', border_mode='same')(model_input)
-    x = Convolution2D(64, 3, 3, activation='relu', name='conv1_2', border_mode='same')(x)
-    x = pooling_func(x)
-
-    x = Convolution2D(128, 3, 3, activation='relu', name='conv2_1', border_mode='same')(x)
-    x = Convolution2D(128, 3, 3, activation='relu', name='conv2_2', border_mode='same')(x)
-    x = pooling_func(x)
-
-    x = Convolution2D(256, 3, 3, activation='relu', name='conv3_1', border_mode='same')(x)
-    x = Convolution2D(256, 3, 3, activation='relu', name='conv3_2', border_mode='same')(x)
-    x = Convolution2D(256, 3, 3, activation='relu', name='conv3_3', border_mode='same')(x)
-    x = pooling_func(x)
-
-    x = Convolution2D(512, 3, 3, activation='relu', name='conv4_1', border_mode='same')(x)
-    x = Convolution2D(512, 3, 3, activation='relu', name='conv4_2', border_mode='same')(x)
-    x = Convolution2D(512, 3, 3, activation='relu', name='conv4_3', border_mode='same')(x)
-    x = pooling_func(x)
-
-    x = Convolution2D(512, 3, 3, activation='relu', name='conv5_1', border_mode='same')(x)
-    x = Convolution2D(512, 3, 3, activation='relu', name='conv5_2', border_mode='same')(x)
-    x = Convolution2D(512, 3, 3, activation='relu', name='conv5_3', border_mode='same')(x)
-    x = pooling_func(x)
-
-    model = Model(model_input, x)
-
-    weights = get_file('vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5', TF_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
-
-    print("Weights Path: ", weights)
-
-    model.load_weights(weights)
-
-    print('Model loaded.')
-
-    # get the symbolic outputs of each "key" layer (we gave them unique names).
-    outputs_dict = dict([(layer.name, layer.output) for layer in model.layers])
-    shape_dict = dict([(layer.name, layer.output_shape) for layer in model.layers])
-
-
-    # compute the neural style loss
-    # first we need to define 4 util functions
-
-    # the gram matrix of an image tensor (feature-wise outer product)
-    def gram_matrix(x):
-        features = K.batch_flatten(K.permute_dimensions(x, (2, 0, 1)))
-        gram = K.dot(features, K.transpose(features))
-        return gram
-
-
-    # the 3rd loss function, total variation loss,
-    # designed to keep the generated image locally coherent
-    def total_variation_loss(x):
-        assert K.ndim(x) == 4
-        a = K.square(x[:, :img_width - 1, :img_height - 1, :] - x[:, 1:, :img_height - 1, :])
-        b = K.square(x[:, :img_width - 1, :img_height - 1, :] - x[:, :img_width - 1, 1:, :])
-        return K.sum(K.pow(a + b, 1.25))
-
-
-    def make_patches(x, patch_size, patch_stride):
-        from theano.tensor.nnet.neighbours import images2neibs
-        '''Break image `x` up into a bunch of patches.'''
-        patches = images2neibs(x,
-            (patch_size, patch_size), (patch_stride, patch_stride),
-            mode='valid')
-        # neibs are sorted per-channel
-        patches = K.reshape(patches, (K.shape(x)[1], K.shape(patches)[0] // K.shape(x)[1], patch_size, patch_size))
-        patches = K.permute_dimensions(patches, (1, 0, 2, 3))
-        patches_norm = K.sqrt(K.sum(K.square(patches), axis=(1,2,3), keepdims=True))
-
-        return patches, patches_norm
-
-
-    def find_patch_matches(comb, comb_norm, ref):
-        '''For each patch in combination, find the best matching patch in reference'''
-        # we want cross-correlation here so flip the kernels
-        convs = K.conv2d(comb, ref[:, :, ::-1, ::-1], border_mode='valid')
-        argmax = K.argmax(convs / comb_norm, axis=1)
-        return argmax
-
-    def mrf_loss(source, combination, patch_size=3, patch_stride=1):
-        '''CNNMRF http://arxiv.org/pdf/1601.04589v1.pdf'''
-        # extract patches from style and combination feature maps
-        source = K.expand_dims(source, 0).eval(session=K.get_session())
-        combination = K.expand_dims(combination, 0).eval(session=K.get_session())
-        combination_patches, combination_patches_norm = make_patches(combination, patch_size, patch_stride)
-        source_patches, source_patches_norm = make_patches(source, patch_size, patch_stride)
-        # find best patches and calculate loss
-        patch_ids = find_patch_matches(combination_patches, combination_patches_norm, source_patches / source_patches_norm)
-        best_source_patches = K.reshape(source_patches[patch_ids], K.shape(combination_patches))
-        loss = K.sum(K.square(best_source_patches - combination_patches)) / patch_size ** 2
-        return loss
-
-    # an auxiliary loss function
-    # designed to maintain the "content" of the
-    # base image in the generated image
-    def content_loss(base, combination):
-        channels = K.shape(base)[-1]
-        size = img_width * img_height
-
-        if args.content_loss_type == 1:
-            multiplier = 1 / (2. * channels ** 0.5 * size ** 0.5)
-        elif args.content_loss_type == 2:
-            multiplier = 1 / (channels * size)
-        else:
-            multiplier = 1.
+    # content features and style feature maps the generated image is pulled towards
+    phase_start = time.time()
+    if precompute_targets:
+        content_target = K.variable(content_fn([base_image])[0][0])
 
-        return multiplier * K.sum(K.square(combination - base))
+        style_targets = dict([(layer_name, []) for layer_name in mrf_layers])
+        for style_image in style_reference_images:
+            style_outputs = style_fn([style_image])
+            for layer_name, style_features in zip(mrf_layers, style_outputs):
+                style_targets[layer_name].append(K.variable(style_features[0]))
+    else:
+        content_target = outputs_dict[args.content_layer][0, :, :, :]
+        style_targets = dict([(layer_name, [outputs_dict[layer_name][j + 1, :, :, :]
+                                            for j in range(nb_style_images)])
+                              for layer_name in mrf_layers])
+    profiler.record('targets', phase_start, time.time() - phase_start, size=img_width)
 
     # combine these loss functions into a single scalar
-    loss = K.variable(0.)
+    phase_start = time.time()
     layer_features = outputs_dict[args.content_layer]  # 'conv5_2' or 'conv4_2'
-    base_image_features = layer_features[0, :, :, :]
-    combination_features = layer_features[nb_tensors - 1, :, :, :]
-    loss += content_weight * content_loss(base_image_features,
-                                          combination_features)
-
-    channel_index = -1
+    combination_features = layer_features[combination_index, :, :, :]
+    loss = content_weight * content_loss(content_target, combination_features, img_width, img_height)
 
     #Style Loss calculation
-    mrf_layers = ['conv3_1', 'conv4_1']
-    # feature_layers = ['conv1_1', 'conv2_1', 'conv3_1', 'conv4_1', 'conv5_1']
     for layer_name in mrf_layers:
         output_features = outputs_dict[layer_name]
-        shape = shape_dict[layer_name]
-        combination_features = output_features[nb_tensors - 1, :, :, :]
+        feature_shape = K.int_shape(output_features)[1:]
+        combination_features = output_features[combination_index, :, :, :]
 
-        style_features = output_features[1:nb_tensors - 1, :, :, :]
-        sl = []
-        for j in range(nb_style_images):
-            sl.append(mrf_loss(style_features[j], combination_features))
         for j in range(nb_style_images):
-            loss += (style_weights[j] / len(mrf_layers)) * sl[j]
+            sl = mrf_loss(style_targets[layer_name][j], combination_features, feature_shape)
+            loss += (style_weights[j] / len(mrf_layers)) * sl
 
-    loss += total_variation_weight * total_variation_loss(combination_image)
+    loss += total_variation_weight * total_variation_loss(combination_image, img_width, img_height)
 
     # get the gradients of the generated image wrt the loss
     grads = K.gradients(loss, combination_image)
@@ -307,53 +319,39 @@ for scale_size in scale_sizes:
         outputs += grads
     else:
         outputs.append(grads)
+    profiler.record('build_loss', phase_start, time.time() - phase_start, size=img_width)
 
-    f_outputs = K.function([combination_image], outputs)
+    with profiler.phase('compile', size=img_width):
+        f_outputs = K.function([combination_image], outputs)
+    f_outputs = profiler.wrap('evaluate', f_outputs)  # the first call includes the backend's lazy setup
+    return base_image, combination_image, loss, f_outputs
 
 
-    def eval_loss_and_grads(x):
-        x = x.reshape((1, img_width, img_height, 3))
-        outs = f_outputs([x])
-        loss_value = outs[0]
-        if len(outs[1:]) == 1:
-            grad_values = outs[1].flatten().astype('float64')
-        else:
-            grad_values = np.array(outs[1:]).flatten().astype('float64')
-        return loss_value, grad_values
-
-
-    # # this Evaluator class makes it possible
-    # # to compute loss and gradients in one pass
-    # # while retrieving them via two separate functions,
-    # # "loss" and "grads". This is done because scipy.optimize
-    # # requires separate functions for loss and gradients,
-    # # but computing them separately would be inefficient.
-    class Evaluator(object):
-        def __init__(self):
-            self.loss_value = None
-            self.grads_values = None
-
-        def loss(self, x):
-            assert self.loss_value is None
-            loss_value, grad_values = eval_loss_and_grads(x)
-            self.loss_value = loss_value
-            self.grad_values = grad_values
-            return self.loss_value
-
-        def grads(self, x):
-            assert self.loss_value is not None
-            grad_values = np.copy(self.grad_values)
-            self.loss_value = None
-            self.grad_values = None
-            return grad_values
-
-
-    evaluator = Evaluator()
+x = None
+prev_width = prev_height = 0
+# the last result, kept in case the budget runs out before the final scale produces one
+best_x, best_width, best_height = None, 0, 0
+nb_iterations = 0
+
+for level, (scale_size, num_iter) in enumerate(zip(scale_sizes, scale_iters)):
+    img_width = scale_size
+    img_height = int(img_width * aspect_ratio)
+    final_scale = level == len(scale_sizes) - 1
+    print("Scale %d/%d: %dx%d" % (level + 1, len(scale_sizes), img_width, img_height))
+
+    base_image, combination_image, loss, f_outputs = build_scale(img_width, img_height)
+
+    # computes loss and gradients in one pass and hands them to the optimizer
+    # through "loss" and "grads", reusing the same buffers on every evaluation
+    evaluator = BufferedEvaluator(f_outputs, K.int_shape(combination_image), dtype=optimizer_dtype)
 
     # (L-BFGS)
 
-    if "content" in args.init_image or "gray" in args.init_image:
-        x = preprocess_image(base_image_path, True)
+    if x is not None:
+        # warm start from the result of the previous scale
+        x = resize_image(x, prev_width, prev_height, img_width, img_height)
+    elif "content" in args.init_image or "gray" in args.init_image:
+        x = base_image.copy()
     elif "noise" in args.init_image:
         x = np.random.uniform(0, 255, (1, img_width, img_height, 3)) - 128.
 
@@ -361,17 +359,39 @@ for scale_size in scale_sizes:
             x = x.transpose((0, 3, 1, 2))
     else:
         print("Using initial image : ", args.init_image)
-        x = preprocess_image(args.init_image)
+        x = preprocess_image(decode_image(args.init_image), img_width, img_height)
+
+    profile_forward(profiler, [combination_image], loss, [x])
 
-    num_iter = args.num_iter
     prev_min_val = -1
+    start_time = time.time()
+
 
-    for i in range(num_iter):
-        print("Starting iteration %d of %d" % ((i + 1), num_iter))
-        start_time = time.time()
+    # deprocesses, rescales and writes the generated image of iteration i,
+    # run by the image writer on a copy of x
+    def save_image(x, i):
+        phase_start = time.time()
+        img = deprocess_image(x, img_width, img_height)
+
+        img_ht = int(img_width * aspect_ratio)
+        img = imresize(img, (img_width, img_ht), interp="bilinear")
+        profiler.record('postprocess', phase_start, time.time() - phase_start, n=i)
+
+        if final_scale:
+            fname = result_prefix + '_at_iteration_%d.png' % i
+        else:
+            fname = result_prefix + '_scale_%d_at_iteration_%d.png' % (img_width, i)
+        with profiler.phase('encode', n=i):
+            imsave(fname, img)
+        print('Image saved as', fname)
 
-        x, min_val, info = fmin_l_bfgs_b(evaluator.loss, x.flatten(), fprime=evaluator.grads, maxfun=20)
-        combination_prev = x
+
+    writer = AsyncImageWriter(save_image, nb_threads=args.save_threads)
+
+
+    # called by the optimizer after each iteration of `evals_per_iter` evaluations
+    def save_iteration(x, min_val, i):
+        global prev_min_val, start_time
 
         if prev_min_val == -1:
             prev_min_val = min_val
@@ -380,15 +400,42 @@ for scale_size in scale_sizes:
 
         print('Current loss value:', min_val, " Improvement : %0.3f" % improvement, "%")
         prev_min_val = min_val
-        # save current generated image
-        img = deprocess_image(x.copy())
 
-        img_ht = int(img_width * aspect_ratio)
-        print("Rescaling Image to (%d, %d)" % (img_width, img_ht))
-        img = imresize(img, (img_width, img_ht), interp="bilinear")
+        if args.save_every > 0 and i % args.save_every == 0:
+            writer.submit(x, i)
 
-        fname = result_prefix + '_at_iteration_%d.png' % (i + 1)
-        imsave(fname, img)
         end_time = time.time()
-        print('Image saved as', fname)
-        print('Iteration %d completed in %ds' % (i + 1, end_time - start_time))
+        print('Iteration %d completed in %ds' % (i, end_time - start_time))
+        profiler.record('iteration', start_time, end_time - start_time, n=i, loss=float(min_val))
+        start_time = end_time
+
+
+    print("Starting %d iterations of %d evaluations" % (num_iter, args.evals_per_iter))
+    stopping.reset()  # the loss of every scale is on its own scale
+    # coarse scales have much smaller losses, so the target is only meaningful at the final one
+    stopping.target_loss = args.target_loss if final_scale else None
+    driver = LBFGSDriver(evaluator.loss, evaluator.grads, num_iter * args.evals_per_iter, save_every=args.evals_per_iter,
+                         dtype=optimizer_dtype, stopping=stopping)
+    x, min_val, nb_evals = driver.run(x, callback=save_iteration)
+    prev_width, prev_height = img_width, img_height
+    nb_iterations += driver.nb_checkpoints
+
+    if x is not None:
+        best_x, best_width, best_height = x, img_width, img_height
+        if args.save_every <= 0 or driver.nb_checkpoints % args.save_every != 0:
+            writer.submit(x, driver.nb_checkpoints)  # the best image
+    writer.close()  # save_image reads this scale's image size
+
+    # a plateau only ends this scale; the pyramid stops early only when the budget is used up
+    if x is None or stopping.expired():
+        break
+
+if best_x is not None and (x is None or best_width != scale_sizes[-1]):
+    # stopped before the final scale: the last result is upscaled and saved as the final image
+    img = deprocess_image(best_x.copy(), best_width, best_height)
+    img = imresize(img, (scale_sizes[-1], int(scale_sizes[-1] * aspect_ratio)), interp="bilinear")
+    fname = result_prefix + '_at_iteration_%d.png' % nb_iterations
+    imsave(fname, img)
+    print('Image saved as', fname)
+
+profiler.close()
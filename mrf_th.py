@@ -1,25 +1,18 @@
 from scipy.misc import imread, imresize, imsave, fromimage, toimage
-from scipy.optimize import fmin_l_bfgs_b
-import scipy.interpolate
-import scipy.ndimage
 import numpy as np
 import time
 import argparse
 import warnings
-from sklearn.feature_extraction.image import reconstruct_from_patches_2d, extract_patches_2d
 
 from keras.models import Model
 from keras.layers import Input
-from keras.layers.convolutional import Conv2D, AveragePooling2D, MaxPooling2D
 from keras import backend as K
-from keras.utils.data_utils import get_file
-from keras.utils.layer_utils import convert_all_kernels_in_model
 
-THEANO_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg16_weights_th_dim_ordering_th_kernels_notop.h5'
-TF_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5'
-
-TH_19_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg19_weights_th_dim_ordering_th_kernels_notop.h5'
-TF_19_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg19_weights_tf_dim_ordering_tf_kernels_notop.h5'
+from checkpoint import AsyncImageWriter
+from optimizer import BufferedEvaluator, LBFGSDriver
+from profiling import Profiler, profile_forward
+from stopping import StoppingPolicy
+from style_engine import vgg_layers, load_vgg_weights
 
 parser = argparse.ArgumentParser(description='Neural style transfer with Keras.')
 parser.add_argument('base_image_path', metavar='base', type=str,
@@ -58,258 +51,44 @@ parser.add_argument("--content_layer", dest="content_layer", default="conv5_2",
 parser.add_argument("--init_image", dest="init_image", default="content", type=str,
                     help="Initial image used to generate the final image. Options are 'content', 'noise', or 'gray'")
 
+parser.add_argument("--precompute_targets", dest="precompute_targets", default="True", type=str,
+                    help="Run the content and style images through VGG once and keep their features as constants")
 
+parser.add_argument("--evals_per_iter", dest="evals_per_iter", default=20, type=int,
+                    help="Function evaluations per iteration. L-BFGS keeps its state across iterations "
+                         "and an image is saved after each one")
 
+parser.add_argument("--float32_optimizer", dest="float32_optimizer", default="False", type=str,
+                    help="Run L-BFGS in float32 instead of scipy's float64 L-BFGS-B, halving its memory")
 
+parser.add_argument("--save_every", dest="save_every", default=1, type=int,
+                    help="Save an image every this many iterations. 0 saves only the final image")
 
+parser.add_argument("--save_threads", dest="save_threads", default=1, type=int,
+                    help="Threads writing the images in the background. 0 writes them on the main thread")
 
-def _calc_patch_grid_dims(shape, patch_size, patch_stride):
-    x_w, x_h, x_c = shape
-    num_rows = 1 + (x_h - patch_size) // patch_stride
-    num_cols = 1 + (x_w - patch_size) // patch_stride
-    return num_rows, num_cols
-
-
-def make_patch_grid(x, patch_size, patch_stride=1):
-    '''x shape: (num_channels, rows, cols)'''
-    x = x.transpose(2, 1, 0)
-    patches = extract_patches_2d(x, (patch_size, patch_size))
-    x_w, x_h, x_c  = x.shape
-    num_rows, num_cols = _calc_patch_grid_dims(x.shape, patch_size, patch_stride)
-    patches = patches.reshape((num_rows, num_cols, patch_size, patch_size, x_c))
-    patches = patches.transpose((0, 1, 4, 2, 3))
-    #patches = np.rollaxis(patches, -1, 2)
-    return patches
-
-
-def combine_patches_grid(in_patches, out_shape):
-    '''Reconstruct an image from these `patches`
-    input shape: (rows, cols, channels, patch_row, patch_col)
-    '''
-    num_rows, num_cols = in_patches.shape[:2]
-    num_channels = in_patches.shape[-3]
-    patch_size = in_patches.shape[-1]
-    num_patches = num_rows * num_cols
-    in_patches = np.reshape(in_patches, (num_patches, num_channels, patch_size, patch_size))  # (patches, channels, pr, pc)
-    in_patches = np.transpose(in_patches, (0, 2, 3, 1)) # (patches, p, p, channels)
-    recon = reconstruct_from_patches_2d(in_patches, out_shape)
-    return recon.transpose(2, 1, 0)
-
-
-class PatchMatcher(object):
-    '''A matcher of image patches inspired by the PatchMatch algorithm.
-    image shape: (width, height, channels)
-    '''
-    def __init__(self, input_shape, target_img, patch_size=1, patch_stride=1, jump_size=0.5,
-            num_propagation_steps=5, num_random_steps=5, random_max_radius=1.0, random_scale=0.5):
-        self.input_shape = input_shape
-        self.patch_size = patch_size
-        self.patch_stride = patch_stride
-        self.jump_size = jump_size
-        self.num_propagation_steps = num_propagation_steps
-        self.num_random_steps = num_random_steps
-        self.random_max_radius = random_max_radius
-        self.random_scale = random_scale
-        self.num_input_rows, self.num_input_cols = _calc_patch_grid_dims(input_shape, patch_size, patch_stride)
-        self.target_patches = make_patch_grid(target_img, patch_size)
-        self.target_patches_normed = self.normalize_patches(self.target_patches)
-        self.coords = np.random.uniform(0.0, 1.0,  # TODO: switch to pixels
-            (2, self.num_input_rows, self.num_input_cols))# * [[[self.num_input_rows]],[[self.num_input_cols]]]
-        self.similarity = np.zeros(input_shape[:2:-1], dtype ='float32')
-        self.min_propagration_row = 1.0 / self.num_input_rows
-        self.min_propagration_col = 1.0 / self.num_input_cols
-        self.delta_row = np.array([[[self.min_propagration_row]], [[0.0]]])
-        self.delta_col = np.array([[[0.0]], [[self.min_propagration_col]]])
-
-    def update(self, input_img, reverse_propagation=False):
-        input_patches = self.get_patches_for(input_img)
-        self.update_with_patches(self.normalize_patches(input_patches), reverse_propagation=reverse_propagation)
-
-    def update_with_patches(self, input_patches, reverse_propagation=False):
-        self._propagate(input_patches, reverse_propagation=reverse_propagation)
-        self._random_update(input_patches)
-
-    def get_patches_for(self, img):
-        return make_patch_grid(img, self.patch_size)
-
-    def normalize_patches(self, patches):
-        norm = np.sqrt(np.sum(np.square(patches), axis=(2, 3, 4), keepdims=True))
-        return patches / norm
-
-    def _propagate(self, input_patches, reverse_propagation=False):
-        if reverse_propagation:
-            roll_direction = 1
-        else:
-            roll_direction = -1
-        sign = float(roll_direction)
-        for step_i in range(self.num_propagation_steps):
-            new_coords = self.clip_coords(np.roll(self.coords, roll_direction, 1) + self.delta_row * sign)
-            coords_row, similarity_row = self.eval_state(new_coords, input_patches)
-            new_coords = self.clip_coords(np.roll(self.coords, roll_direction, 2) + self.delta_col * sign)
-            coords_col, similarity_col = self.eval_state(new_coords, input_patches)
-            self.coords, self.similarity = self.take_best(coords_row, similarity_row, coords_col, similarity_col)
-
-    def _random_update(self, input_patches):
-        for alpha in range(1, self.num_random_steps + 1):  # NOTE this should actually stop when the move is < 1
-            new_coords = self.clip_coords(self.coords + np.random.uniform(-self.random_max_radius, self.random_max_radius, self.coords.shape) * self.random_scale ** alpha)
-            self.coords, self.similarity = self.eval_state(new_coords, input_patches)
-
-    def eval_state(self, new_coords, input_patches):
-        new_similarity = self.patch_similarity(input_patches, new_coords)
-        delta_similarity = new_similarity - self.similarity
-        coords = np.where(delta_similarity > 0, new_coords, self.coords)
-        best_similarity = np.where(delta_similarity > 0, new_similarity, self.similarity)
-        return coords, best_similarity
-
-    def take_best(self, coords_a, similarity_a, coords_b, similarity_b):
-        delta_similarity = similarity_a - similarity_b
-        best_coords = np.where(delta_similarity > 0, coords_a, coords_b)
-        best_similarity = np.where(delta_similarity > 0, similarity_a, similarity_b)
-        return best_coords, best_similarity
-
-    def patch_similarity(self, source, coords):
-        '''Check the similarity of the patches specified in coords.'''
-        target_vals = self.lookup_coords(self.target_patches_normed, coords)
-        err = source * target_vals
-        return np.sum(err, axis=(2, 3, 4))
-
-    def clip_coords(self, coords):
-        # TODO: should this all be in pixel space?
-        coords = np.clip(coords, 0.0, 1.0)
-        return coords
-
-    def lookup_coords(self, x, coords):
-        x_shape = np.expand_dims(np.expand_dims(x.shape, -1), -1)
-        i_coords = np.round(coords * (x_shape[:2] - 1)).astype('int32')
-        return x[i_coords[0], i_coords[1]]
-
-    def get_reconstruction(self, patches=None, combined=None):
-        if combined is not None:
-            patches = make_patch_grid(combined, self.patch_size)
-        if patches is None:
-            patches = self.target_patches
-        patches = self.lookup_coords(patches, self.coords)
-        recon = combine_patches_grid(patches, self.input_shape)
-        return recon
-
-    def scale(self, new_shape, new_target_img):
-        '''Create a new matcher of the given shape and replace its
-        state with a scaled up version of the current matcher's state.
-        '''
-        new_matcher = PatchMatcher(new_shape, new_target_img, patch_size=self.patch_size,
-                patch_stride=self.patch_stride, jump_size=self.jump_size,
-                num_propagation_steps=self.num_propagation_steps,
-                num_random_steps=self.num_random_steps,
-                random_max_radius=self.random_max_radius,
-                random_scale=self.random_scale)
-        new_matcher.coords = congrid(self.coords, new_matcher.coords.shape, method='neighbour')
-        new_matcher.similarity = congrid(self.similarity, new_matcher.coords.shape, method='neighbour')
-        return new_matcher
-
-
-def congrid(a, newdims, method='linear', centre=False, minusone=False):
-    '''Arbitrary resampling of source array to new dimension sizes.
-    Currently only supports maintaining the same number of dimensions.
-    To use 1-D arrays, first promote them to shape (x,1).
-    Uses the same parameters and creates the same co-ordinate lookup points
-    as IDL''s congrid routine, which apparently originally came from a VAX/VMS
-    routine of the same name.
-    method:
-    neighbour - closest value from original data
-    nearest and linear - uses n x 1-D interpolations using
-                         scipy.interpolate.interp1d
-    (see Numerical Recipes for validity of use of n 1-D interpolations)
-    spline - uses ndimage.map_coordinates
-    centre:
-    True - interpolation points are at the centres of the bins
-    False - points are at the front edge of the bin
-    minusone:
-    For example- inarray.shape = (i,j) & new dimensions = (x,y)
-    False - inarray is resampled by factors of (i/x) * (j/y)
-    True - inarray is resampled by(i-1)/(x-1) * (j-1)/(y-1)
-    This prevents extrapolation one element beyond bounds of input array.
-    '''
-    if not a.dtype in [np.float64, np.float32]:
-        a = np.cast[float](a)
-
-    m1 = np.cast[int](minusone)
-    ofs = np.cast[int](centre) * 0.5
-    old = np.array( a.shape )
-    ndims = len( a.shape )
-    if len( newdims ) != ndims:
-        print ("[congrid] dimensions error. "
-              "This routine currently only support "
-              "rebinning to the same number of dimensions.")
-        return None
-    newdims = np.asarray( newdims, dtype=float )
-    dimlist = []
-
-    if method == 'neighbour':
-        for i in range( ndims ):
-            base = np.indices(newdims)[i]
-            dimlist.append( (old[i] - m1) / (newdims[i] - m1) \
-                            * (base + ofs) - ofs )
-        cd = np.array( dimlist ).round().astype(int)
-        newa = a[list( cd )]
-        return newa
-
-    elif method in ['nearest','linear']:
-        # calculate new dims
-        for i in range( ndims ):
-            base = np.arange( newdims[i] )
-            dimlist.append( (old[i] - m1) / (newdims[i] - m1) \
-                            * (base + ofs) - ofs )
-        # specify old dims
-        olddims = [np.arange(i, dtype = np.float) for i in list( a.shape )]
-
-        # first interpolation - for ndims = any
-        mint = scipy.interpolate.interp1d( olddims[-1], a, kind=method )
-        newa = mint( dimlist[-1] )
-
-        trorder = [ndims - 1] + range( ndims - 1 )
-        for i in range( ndims - 2, -1, -1 ):
-            newa = newa.transpose( trorder )
-
-            mint = scipy.interpolate.interp1d( olddims[i], newa, kind=method )
-            newa = mint( dimlist[i] )
-
-        if ndims > 1:
-            # need one more transpose to return to original dimensions
-            newa = newa.transpose( trorder )
-
-        return newa
-    elif method in ['spline']:
-        oslices = [ slice(0,j) for j in old ]
-        oldcoords = np.ogrid[oslices]
-        nslices = [ slice(0,j) for j in list(newdims) ]
-        newcoords = np.mgrid[nslices]
-
-        newcoords_dims = [i for i in range(np.rank(newcoords))]
-        #make first index last
-        newcoords_dims.append(newcoords_dims.pop(0))
-        newcoords_tr = newcoords.transpose(newcoords_dims)
-        # makes a view that affects newcoords
-
-        newcoords_tr += ofs
-
-        deltas = (np.asarray(old) - m1) / (newdims - m1)
-        newcoords_tr *= deltas
-
-        newcoords_tr -= ofs
-
-        newa = scipy.ndimage.map_coordinates(a, newcoords)
-        return newa
-    else:
-        print("Congrid error: Unrecognized interpolation type.\n",
-              "Currently only \'neighbour\', \'nearest\',\'linear\',",
-              "and \'spline\' are supported.")
-        return None
+parser.add_argument('--min_improvement', default=0.0, type=float,
+                    help='Stop once the loss improves by less than this many percent over --improvement_window '
+                         'iterations (0 never stops)')
+
+parser.add_argument('--improvement_window', default=1, type=int,
+                    help='Number of iterations the improvement is measured over')
 
+parser.add_argument('--target_loss', default=None, type=float,
+                    help='Stop once the loss reaches this value')
 
+parser.add_argument('--max_seconds', default=None, type=float,
+                    help='Wall-clock budget of the run in seconds, after which the best image so far is written')
 
+parser.add_argument("--profile", dest="profile", default=None, type=str,
+                    help="Write the time spent in each phase of the run to this file")
 
+parser.add_argument("--profile_format", dest="profile_format", default="jsonl", type=str,
+                    help="Format of the --profile file: 'jsonl' (one JSON object per line) or 'chrome' (Chrome trace)")
 
 
+def str_to_bool(v):
+    return v.lower() in ("true", "yes", "t", "1")
 
 
 args = parser.parse_args()
@@ -319,6 +98,11 @@ style_image_paths = [path for path in args.style_image_paths]
 result_prefix = args.result_prefix
 content_weight = args.content_weight
 total_variation_weight = args.tv_weight
+precompute_targets = str_to_bool(args.precompute_targets)
+float32_optimizer = str_to_bool(args.float32_optimizer)
+optimizer_dtype = 'float32' if float32_optimizer else 'float64'
+stopping = StoppingPolicy(args.min_improvement, args.improvement_window, args.target_loss, args.max_seconds)
+profiler = Profiler(args.profile, args.profile_format)
 
 img_width = img_height = 0
 
@@ -336,10 +120,6 @@ if len(style_image_paths) != len(args.style_weight):
 else:
     style_weights = [weight*args.style_scale for weight in args.style_weight]
 
-def pooling_func(x):
-    # return AveragePooling2D((2, 2), strides=(2, 2))(x)
-    return MaxPooling2D((2, 2), strides=(2, 2))(x)
-
 #start proc_img
 
 def preprocess_image(image_path, load_dims=False):
@@ -347,8 +127,10 @@ def preprocess_image(image_path, load_dims=False):
 
     mode = "RGB"
     # mode = "RGB" if read_mode == "color" else "L"
-    img = imread(image_path, mode=mode)  # Prevents crashes due to PNG images (ARGB)
+    with profiler.phase('decode', path=image_path):
+        img = imread(image_path, mode=mode)  # Prevents crashes due to PNG images (ARGB)
 
+    phase_start = time.time()
     if load_dims:
         img_WIDTH = img.shape[0]
         img_HEIGHT = img.shape[1]
@@ -371,6 +153,7 @@ def preprocess_image(image_path, load_dims=False):
 
 
     img = np.expand_dims(img, axis=0)
+    profiler.record('preprocess', phase_start, time.time() - phase_start, path=image_path)
     return img
 
 
@@ -394,20 +177,25 @@ def deprocess_image(x):
 
 
 
-base_image = K.variable(preprocess_image(base_image_path, True))
+base_image = preprocess_image(base_image_path, True)
 
-style_reference_images = [K.variable(preprocess_image(path)) for path in style_image_paths]
+style_reference_images = [preprocess_image(path) for path in style_image_paths]
 
 # this will contain our generated image
 combination_image = K.placeholder((1, img_width, img_height, 3)) # tensorflow
 
-image_tensors = [base_image]
-for style_image_tensor in style_reference_images:
-    image_tensors.append(style_image_tensor)
-image_tensors.append(combination_image)
+if precompute_targets:
+    # Only the generated image goes through the network on every evaluation.
+    # The content and style features are computed once after the model is built.
+    image_tensors = [combination_image]
+else:
+    image_tensors = [K.variable(base_image)]
+    for style_image in style_reference_images:
+        image_tensors.append(K.variable(style_image))
+    image_tensors.append(combination_image)
 
 nb_tensors = len(image_tensors)
-nb_style_images = nb_tensors - 2 # Content and Output image not considered
+nb_style_images = len(style_reference_images)
 
 # combine the various images into a single Keras tensor
 input_tensor = K.concatenate(image_tensors, axis=0)
@@ -421,40 +209,20 @@ else:
 #build the model
 model_input = Input(tensor=input_tensor, shape=shape)
 
-# build the VGG16 network with our 3 images as input
-x = Conv2D(filters=64, kernel_size=(3, 3), activation='relu', name='conv1_1', padding='same')(model_input)
-x = Conv2D(64, (3, 3), activation='relu', name='conv1_2', padding='same')(x)
-x = pooling_func(x)
-
-x = Conv2D(128, (3, 3), activation='relu', name='conv2_1', padding='same')(x)
-x = Convolution2D(128, (3, 3), activation='relu', name='conv2_2', padding='same')(x)
-x = pooling_func(x)
-
-x = Conv2D(256, (3, 3), activation='relu', name='conv3_1', padding='same')(x)
-x = Conv2D(256, (3, 3), activation='relu', name='conv3_2', padding='same')(x)
-x = Conv2D(256, (3, 3), activation='relu', name='conv3_3', padding='same')(x)
-x = pooling_func(x)
-
-x = Conv2D(512, (3, 3), activation='relu', name='conv4_1', padding='same')(x)
-x = Conv2D(512, (3, 3), activation='relu', name='conv4_2', padding='same')(x)
-x = Conv2D(512, (3, 3), activation='relu', name='conv4_3', padding='same')(x)
-x = pooling_func(x)
+mrf_layers = ['conv3_1', 'conv4_1']
+# feature_layers = ['conv1_1', 'conv2_1', 'conv3_1', 'conv4_1', 'conv5_1']
 
-x = Conv2D(512, (3, 3), activation='relu', name='conv5_1', padding='same')(x)
-x = Conv2D(512, (3, 3), activation='relu', name='conv5_2', padding='same')(x)
-x = Conv2D(512, (3, 3), activation='relu', name='conv5_3', padding='same')(x)
-x = pooling_func(x)
+# build the network only up to the deepest layer the losses read from
+phase_start = time.time()
+x = model_input
+for layer in vgg_layers('vgg16', 'max', [args.content_layer] + mrf_layers):
+    x = layer(x)
 
 model = Model(model_input, x)
+profiler.record('build_model', phase_start, time.time() - phase_start)
 
-if K.image_dim_ordering() == "th":
-    weights = get_file('vgg16_weights_th_dim_ordering_th_kernels_notop.h5', THEANO_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
-else:
-    weights = get_file('vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5', TF_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
-
-print("Weights Path: ", weights)
-
-model.load_weights(weights)
+with profiler.phase('load_weights'):
+    load_vgg_weights(model, 'vgg16')
 
 print('Model loaded.')
 
@@ -472,37 +240,32 @@ def total_variation_loss(x):
     return K.sum(K.pow(a + b, 1.25))
 
 
-def make_patches(x, patch_size, patch_stride):
-    from theano.tensor.nnet.neighbours import images2neibs
-    '''Break image `x` up into a bunch of patches.'''
-    patches = images2neibs(x,
-        (patch_size, patch_size), (patch_stride, patch_stride),
-        mode='valid')
-    # neibs are sorted per-channel
-    patches = K.reshape(patches, (K.shape(x)[1], K.shape(patches)[0] // K.shape(x)[1], patch_size, patch_size))
-    patches = K.permute_dimensions(patches, (1, 0, 2, 3))
-    patches_norm = K.sqrt(K.sum(K.square(patches), axis=(1,2,3), keepdims=True))
-
-    return patches, patches_norm
+def make_patches(x, feature_shape, patch_size, patch_stride):
+    '''Break the feature map `x` of shape `feature_shape` (rows, cols, channels) up into patches,
+    one per row of a matrix.'''
+    rows, cols, channels = feature_shape
+    slices = [x[i:i + rows - patch_size + 1:patch_stride, j:j + cols - patch_size + 1:patch_stride, :]
+              for i in range(patch_size) for j in range(patch_size)]
+    patches = K.concatenate(slices, axis=-1)
+    return K.reshape(patches, (-1, patch_size * patch_size * channels))
 
 
-def find_patch_matches(comb, comb_norm, ref):
+def find_patch_matches(comb, ref, ref_norm):
     '''For each patch in combination, find the best matching patch in reference'''
-    # we want cross-correlation here so flip the kernels
-    convs = K.conv2d(comb, ref[:, :, ::-1, ::-1], border_mode='valid')
-    argmax = K.argmax(convs / comb_norm, axis=1)
-    return argmax
+    # normalized cross-correlation; the norm of the combination patch does not change the argmax
+    similarity = K.dot(comb, K.transpose(ref / ref_norm))
+    return K.argmax(similarity, axis=1)
 
-def mrf_loss(source, combination, patch_size=3, patch_stride=1):
+
+def mrf_loss(source, combination, feature_shape, patch_size=3, patch_stride=1):
     '''CNNMRF http://arxiv.org/pdf/1601.04589v1.pdf'''
-    # extract patches from feature maps
-    source = K.expand_dims(source, 0)
-    combination = K.expand_dims(combination, 0)
-    combination_patches, combination_patches_norm = make_patches(K.variable(combination).eval, patch_size, patch_stride)
-    source_patches, source_patches_norm = make_patches(K.variable(source).eval, patch_size, patch_stride)
+    # extract patches from style and combination feature maps
+    combination_patches = make_patches(combination, feature_shape, patch_size, patch_stride)
+    source_patches = make_patches(source, feature_shape, patch_size, patch_stride)
+    source_patches_norm = K.sqrt(K.sum(K.square(source_patches), axis=1, keepdims=True)) + K.epsilon()
     # find best patches and calculate loss
-    patch_ids = find_patch_matches(combination_patches, combination_patches_norm, source_patches / source_patches_norm)
-    best_source_patches = K.reshape(source_patches[patch_ids], K.shape(combination_patches))
+    patch_ids = find_patch_matches(combination_patches, source_patches, source_patches_norm)
+    best_source_patches = K.stop_gradient(K.gather(source_patches, patch_ids))
     loss = K.sum(K.square(best_source_patches - combination_patches)) / patch_size ** 2
     return loss
 
@@ -510,12 +273,11 @@ def mrf_loss(source, combination, patch_size=3, patch_stride=1):
 # designed to maintain the "content" of the
 # base image in the generated image
 def content_loss(base, combination):
-    channel_dim = 0 if K.image_dim_ordering() == "th" else -1
-    channels = K.shape(base)[channel_dim]
+    channels = K.cast(K.shape(base)[-1], K.floatx())
     size = img_width * img_height
 
     if args.content_loss_type == 1:
-        multiplier = 1 / (2. * channels ** 0.5 * size ** 0.5)
+        multiplier = 1 / (2. * K.sqrt(channels) * size ** 0.5)
     elif args.content_loss_type == 2:
         multiplier = 1 / (channels * size)
     else:
@@ -523,28 +285,48 @@ def content_loss(base, combination):
 
     return multiplier * K.sum(K.square(combination - base))
 
+combination_index = nb_tensors - 1
+
+# content features and style feature maps the generated image is pulled towards
+phase_start = time.time()
+if precompute_targets:
+    content_fn = K.function([combination_image], [outputs_dict[args.content_layer]])
+    content_target = K.variable(content_fn([base_image])[0][0])
+
+    style_fn = K.function([combination_image], [outputs_dict[layer_name] for layer_name in mrf_layers])
+    style_targets = dict([(layer_name, []) for layer_name in mrf_layers])
+    for style_image in style_reference_images:
+        style_outputs = style_fn([style_image])
+        for layer_name, style_features in zip(mrf_layers, style_outputs):
+            style_targets[layer_name].append(K.variable(style_features[0]))
+
+    print('Style and content targets precomputed.')
+else:
+    content_target = outputs_dict[args.content_layer][0, :, :, :]
+    style_targets = dict([(layer_name, [outputs_dict[layer_name][j + 1, :, :, :]
+                                        for j in range(nb_style_images)])
+                          for layer_name in mrf_layers])
+profiler.record('targets', phase_start, time.time() - phase_start)
+
 # combine these loss functions into a single scalar
+phase_start = time.time()
 loss = K.variable(0.)
 layer_features = outputs_dict[args.content_layer]  # 'conv5_2' or 'conv4_2'
-base_image_features = layer_features[0, :, :, :]
-combination_features = layer_features[nb_tensors - 1, :, :, :]
-loss += content_weight * content_loss(base_image_features,
+combination_features = layer_features[combination_index, :, :, :]
+loss += content_weight * content_loss(content_target,
                                       combination_features)
 
 channel_index = -1
 
 #Style Loss calculation
-mrf_layers = ['conv3_1', 'conv4_1']
-# feature_layers = ['conv1_1', 'conv2_1', 'conv3_1', 'conv4_1', 'conv5_1']
 for layer_name in mrf_layers:
     output_features = outputs_dict[layer_name]
-    shape = shape_dict[layer_name]
-    combination_features = output_features[nb_tensors - 1, :, :, :]
+    feature_shape = K.int_shape(output_features)[1:]
+    combination_features = output_features[combination_index, :, :, :]
 
-    style_features = output_features[1:nb_tensors - 1, :, :, :]
     sl = []
     for j in range(nb_style_images):
-        sl.append(mrf_loss(style_features[j], combination_features))
+        sl.append(mrf_loss(style_targets[layer_name][j], combination_features, feature_shape))
     for j in range(nb_style_images):
         loss += (style_weights[j] / len(mrf_layers)) * sl[j]
 
@@ -558,48 +340,16 @@ if type(grads) in {list, tuple}:
     outputs += grads
 else:
     outputs.append(grads)
+profiler.record('build_loss', phase_start, time.time() - phase_start)
 
-f_outputs = K.function([combination_image], outputs)
+with profiler.phase('compile'):
+    f_outputs = K.function([combination_image], outputs)
+f_outputs = profiler.wrap('evaluate', f_outputs)  # the first call includes the backend's lazy setup
 
 
-def eval_loss_and_grads(x):
-    x = x.reshape((1, img_width, img_height, 3))
-    outs = f_outputs([x])
-    loss_value = outs[0]
-    if len(outs[1:]) == 1:
-        grad_values = outs[1].flatten().astype('float64')
-    else:
-        grad_values = np.array(outs[1:]).flatten().astype('float64')
-    return loss_value, grad_values
-
-
-# # this Evaluator class makes it possible
-# # to compute loss and gradients in one pass
-# # while retrieving them via two separate functions,
-# # "loss" and "grads". This is done because scipy.optimize
-# # requires separate functions for loss and gradients,
-# # but computing them separately would be inefficient.
-class Evaluator(object):
-    def __init__(self):
-        self.loss_value = None
-        self.grads_values = None
-
-    def loss(self, x):
-        assert self.loss_value is None
-        loss_value, grad_values = eval_loss_and_grads(x)
-        self.loss_value = loss_value
-        self.grad_values = grad_values
-        return self.loss_value
-
-    def grads(self, x):
-        assert self.loss_value is not None
-        grad_values = np.copy(self.grad_values)
-        self.loss_value = None
-        self.grad_values = None
-        return grad_values
-
-
-evaluator = Evaluator()
+# computes loss and gradients in one pass and hands them to the optimizer
+# through "loss" and "grads", reusing the same buffers on every evaluation
+evaluator = BufferedEvaluator(f_outputs, K.int_shape(combination_image), dtype=optimizer_dtype)
 
 # run scipy-based optimization (L-BFGS) over the pixels of the generated image
 # so as to minimize the neural style loss
@@ -617,50 +367,59 @@ else:
     print("Using initial image : ", args.init_image)
     x = preprocess_image(args.init_image)
 
+profile_forward(profiler, [combination_image], loss, [x])
+
 num_iter = args.num_iter
 prev_min_val = -1
+start_time = time.time()
 
-# for scaled_img in img_pyramid:
-#     image_tensors = [base_image]
-#     for style_image_tensor in style_reference_images:
-#         image_tensors.append(style_image_tensor)
-#     image_tensors.append(combination_image)
-#     input_tensor = K.concatenate(image_tensors, axis=0)
-#     model_input = Input(tensor=input_tensor, shape=shape)
 
-for img_scale in scaled_imgs:
+# deprocesses, rescales and writes the generated image of iteration i,
+# run by the image writer on a copy of x
+def save_image(x, i):
+    phase_start = time.time()
+    img = deprocess_image(x)
 
-    image_tensors = [base_image]
-    for style_image_tensor in style_reference_images:
-        image_tensors.append(style_image_tensor)
-    image_tensors.append(combination_image)
-    # combine the various images into a single Keras tensor
-    input_tensor = K.concatenate(image_tensors, axis=0)
-    # build the model
-    model_input = Input(tensor=input_tensor, shape=shape)
+    img_ht = int(img_width * aspect_ratio)
+    img = imresize(img, (img_width, img_ht), interp="bilinear")
+    profiler.record('postprocess', phase_start, time.time() - phase_start, n=i)
+
+    fname = result_prefix + '_at_iteration_%d.png' % i
+    with profiler.phase('encode', n=i):
+        imsave(fname, img)
+    print('Image saved as', fname)
 
-    for i in range(num_iter):
-        print("Starting iteration %d of %d" % ((i + 1), num_iter))
-        start_time = time.time()
 
-        x, min_val, info = fmin_l_bfgs_b(evaluator.loss, x.flatten(), fprime=evaluator.grads, maxfun=20)
+writer = AsyncImageWriter(save_image, nb_threads=args.save_threads)
 
-        if prev_min_val == -1:
-            prev_min_val = min_val
 
-        improvement = (prev_min_val - min_val) / prev_min_val * 100
+# called by the optimizer after each iteration of `evals_per_iter` evaluations
+def save_iteration(x, min_val, i):
+    global prev_min_val, start_time
 
-        print('Current loss value:', min_val, " Improvement : %0.3f" % improvement, "%")
+    if prev_min_val == -1:
         prev_min_val = min_val
-        # save current generated image
-        img = deprocess_image(x.copy())
 
-        img_ht = int(img_width * aspect_ratio)
-        print("Rescaling Image to (%d, %d)" % (img_width, img_ht))
-        img = imresize(img, (img_width, img_ht), interp="bilinear")
+    improvement = (prev_min_val - min_val) / prev_min_val * 100
 
-        fname = result_prefix + '_at_iteration_%d.png' % (i + 1)
-        imsave(fname, img)
-        end_time = time.time()
-        print('Image saved as', fname)
-        print('Iteration %d completed in %ds' % (i + 1, end_time - start_time))
+    print('Current loss value:', min_val, " Improvement : %0.3f" % improvement, "%")
+    prev_min_val = min_val
+
+    if args.save_every > 0 and i % args.save_every == 0:
+        writer.submit(x, i)
+
+    end_time = time.time()
+    print('Iteration %d completed in %ds' % (i, end_time - start_time))
+    profiler.record('iteration', start_time, end_time - start_time, n=i, loss=float(min_val))
+    start_time = end_time
+
+
+print("Starting %d iterations of %d evaluations" % (num_iter, args.evals_per_iter))
+driver = LBFGSDriver(evaluator.loss, evaluator.grads, num_iter * args.evals_per_iter, save_every=args.evals_per_iter,
+                     dtype=optimizer_dtype, stopping=stopping)
+x, min_val, nb_evals = driver.run(x, callback=save_iteration)
+
+if x is not None and (args.save_every <= 0 or driver.nb_checkpoints % args.save_every != 0):
+    writer.submit(x, driver.nb_checkpoints)  # the best image
+writer.close()
+profiler.close()
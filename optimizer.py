@@ -0,0 +1,423 @@
+from scipy.optimize import fmin_l_bfgs_b
+from scipy.linalg import blas
+import numpy as np
+import threading
+
+
+class _StopOptimization(Exception):
+    pass
+
+
+class _DeadlineReached(Exception):
+    pass
+
+
+class BufferedEvaluator(object):
+    '''Evaluator that reuses preallocated buffers across calls.
+
+    `f_outputs` is a compiled K.function returning [loss, grads] for an input
+    of `shape`. The optimizer's x is converted into a float32 input buffer in
+    place and the gradients are written into one flat buffer of `dtype`,
+    which is handed to the optimizer as is instead of a fresh
+    `.flatten().astype('float64')` and `np.copy` per evaluation.
+
+    `extra_inputs` are fed to `f_outputs` after the image, unchanged.
+    '''
+    def __init__(self, f_outputs, shape, dtype='float64', extra_inputs=()):
+        self.f_outputs = f_outputs
+        self.x_buffer = np.empty(shape, dtype='float32')
+        self.grad_buffer = np.empty(int(np.prod(shape)), dtype=dtype)
+        self._grad_view = self.grad_buffer.reshape(shape)
+        self._inputs = [self.x_buffer] + list(extra_inputs)
+        self.loss_value = None
+
+    def loss(self, x):
+        assert self.loss_value is None
+        np.copyto(self.x_buffer, x.reshape(self.x_buffer.shape))
+        outs = self.f_outputs(self._inputs)
+        np.copyto(self._grad_view, outs[1].reshape(self._grad_view.shape))
+        self.loss_value = float(outs[0])
+        return self.loss_value
+
+    def grads(self, x):
+        assert self.loss_value is not None
+        self.loss_value = None
+        return self.grad_buffer
+
+
+class BatchEvaluator(object):
+    '''Evaluates N images in one call while N optimizers run side by side.
+
+    `f_outputs` takes a batch of `shape` = (N, ...) and returns the loss of
+    every image and the gradients of their sum, which are the per-image
+    gradients since the losses are independent. Each optimizer runs in its
+    own thread with `evaluator(i)` as its Evaluator; a call to `loss` blocks
+    until every optimizer still running has asked for an evaluation, then
+    the last one in evaluates them all with one call. An optimizer that is
+    done must call `finish(i)` so the others stop waiting for it.
+    '''
+    def __init__(self, f_outputs, shape, dtype='float64', extra_inputs=()):
+        self.f_outputs = f_outputs
+        self.nb_images = shape[0]
+        self.x_buffer = np.empty(shape, dtype='float32')
+        self.grad_buffer = np.empty((shape[0], int(np.prod(shape[1:]))), dtype=dtype)
+        self._grad_view = self.grad_buffer.reshape(shape)
+        self._inputs = [self.x_buffer] + list(extra_inputs)
+        self.losses = np.zeros(shape[0])
+        self.nb_calls = 0
+
+        self._condition = threading.Condition()
+        self._active = set(range(shape[0]))
+        self._waiting = set()
+        self._generation = 0
+        self._error = None
+
+    def _evaluate_all(self):
+        # called with the condition held, once every active optimizer is waiting
+        try:
+            outs = self.f_outputs(self._inputs)
+            self.losses[:] = outs[0]
+            np.copyto(self._grad_view, outs[1])
+            self.nb_calls += 1
+        except Exception as e:
+            self._error = e
+        self._waiting.clear()
+        self._generation += 1
+        self._condition.notify_all()
+
+    def _loss(self, i, x):
+        with self._condition:
+            np.copyto(self.x_buffer[i], x.reshape(self.x_buffer.shape[1:]))
+            self._waiting.add(i)
+            generation = self._generation
+            if self._waiting >= self._active:
+                self._evaluate_all()
+            while self._generation == generation:
+                self._condition.wait()
+            if self._error is not None:
+                raise self._error
+            return float(self.losses[i])
+
+    def finish(self, i):
+        with self._condition:
+            self._active.discard(i)
+            if self._waiting and self._waiting >= self._active:
+                self._evaluate_all()
+
+    def __call__(self, i):
+        '''Evaluator (`loss`/`grads`) of image `i`.'''
+        return _ImageEvaluator(self, i)
+
+
+class _ImageEvaluator(object):
+    def __init__(self, batch, i):
+        self.batch = batch
+        self.i = i
+
+    def loss(self, x):
+        return self.batch._loss(self.i, x)
+
+    def grads(self, x):
+        return self.batch.grad_buffer[self.i]
+
+
+class Float32LBFGS(object):
+    '''L-BFGS entirely in float32 with preallocated history buffers.
+
+    scipy's L-BFGS-B works in float64, which doubles the size of every
+    vector it keeps. This two-loop recursion with a backtracking Armijo line
+    search keeps x, the gradients and the last `m` (s, y) pairs in float32.
+    All of its state is in numpy arrays, so `state`/`load_state` can save and
+    restore it exactly.
+    '''
+    def __init__(self, n, m=10, c1=1e-4):
+        self.m = m
+        self.c1 = c1
+
+        self.x = np.zeros(n, dtype='float32')
+        self.g = np.zeros(n, dtype='float32')
+        self.f = None
+        self.s_hist = np.zeros((m, n), dtype='float32')
+        self.y_hist = np.zeros((m, n), dtype='float32')
+        self.rho = np.zeros(m, dtype='float64')
+        self.newest = -1
+        self.nb_pairs = 0
+
+        self._x_new = np.empty_like(self.x)
+        self._g_new = np.empty_like(self.x)
+        self._d = np.empty_like(self.x)
+        self._alpha = np.zeros(m, dtype='float64')
+        self._axpy = blas.get_blas_funcs('axpy', (self.x,))
+
+    def state(self):
+        arrays = {'lbfgs_x': self.x, 'lbfgs_g': self.g, 'lbfgs_s': self.s_hist, 'lbfgs_y': self.y_hist,
+                  'lbfgs_rho': self.rho}
+        meta = {'lbfgs_f': self.f, 'lbfgs_newest': self.newest, 'lbfgs_nb_pairs': self.nb_pairs}
+        return arrays, meta
+
+    def load_state(self, arrays, meta):
+        np.copyto(self.x, arrays['lbfgs_x'])
+        np.copyto(self.g, arrays['lbfgs_g'])
+        np.copyto(self.s_hist, arrays['lbfgs_s'])
+        np.copyto(self.y_hist, arrays['lbfgs_y'])
+        np.copyto(self.rho, arrays['lbfgs_rho'])
+        self.f = meta['lbfgs_f']
+        self.newest = meta['lbfgs_newest']
+        self.nb_pairs = meta['lbfgs_nb_pairs']
+
+    def _direction(self):
+        # two-loop recursion: d = -H g
+        d, s_hist, y_hist, m = self._d, self.s_hist, self.y_hist, self.m
+        np.copyto(d, self.g)
+        order = [(self.newest - i) % m for i in range(self.nb_pairs)]
+        for i in order:
+            self._alpha[i] = self.rho[i] * np.dot(s_hist[i], d)
+            d = self._axpy(y_hist[i], d, a=-self._alpha[i])  # in place
+        if self.nb_pairs:
+            d *= np.dot(s_hist[self.newest], y_hist[self.newest]) / np.dot(y_hist[self.newest], y_hist[self.newest])
+        else:
+            d *= 1. / max(np.sqrt(np.dot(self.g, self.g)), 1e-8)
+        for i in reversed(order):
+            beta = self.rho[i] * np.dot(y_hist[i], d)
+            d = self._axpy(s_hist[i], d, a=self._alpha[i] - beta)
+        d *= -1.
+
+        slope = np.dot(self.g, d)
+        if slope >= 0:
+            # not a descent direction, restart from steepest descent
+            np.negative(self.g, out=d)
+            slope = np.dot(self.g, d)
+            self.nb_pairs = 0
+        return d, slope
+
+    def minimize(self, loss, grads, x, max_evals, callback=None):
+        '''Run at most `max_evals` evaluations, from `x` or, if x is None, from the loaded state.
+
+        `loss`/`grads` follow the Evaluator protocol and `callback(x)` runs
+        after every step. Returns the final x and its loss.
+        '''
+        nb_evals = 0
+        if x is not None:
+            np.copyto(self.x, x.reshape(-1))
+            self.f = loss(self.x)
+            np.copyto(self.g, grads(self.x))
+            self.newest = -1
+            self.nb_pairs = 0
+            nb_evals += 1
+
+        while nb_evals < max_evals:
+            d, slope = self._direction()
+
+            step = 1.
+            while True:
+                np.copyto(self._x_new, self.x)
+                self._x_new = self._axpy(d, self._x_new, a=step)
+                f_new = loss(self._x_new)
+                np.copyto(self._g_new, grads(self._x_new))
+                nb_evals += 1
+                if f_new <= self.f + self.c1 * step * slope or nb_evals >= max_evals:
+                    break
+                step *= 0.5
+
+            if f_new > self.f:
+                break  # line search failed within the budget
+
+            newest = (self.newest + 1) % self.m
+            np.subtract(self._x_new, self.x, out=self.s_hist[newest])
+            np.subtract(self._g_new, self.g, out=self.y_hist[newest])
+            sy = np.dot(self.s_hist[newest], self.y_hist[newest])
+            if sy > 1e-10:  # otherwise skip the update, keeping the curvature pairs positive
+                self.rho[newest] = 1. / sy
+                self.newest = newest
+                self.nb_pairs = min(self.nb_pairs + 1, self.m)
+
+            self.x, self._x_new = self._x_new, self.x
+            self.g, self._g_new = self._g_new, self.g
+            self.f = f_new
+
+            if callback is not None:
+                callback(self.x)
+
+        return self.x, self.f
+
+
+class LBFGSDriver(object):
+    '''Runs L-BFGS over the whole evaluation budget with a single state.
+
+    The scripts used to call fmin_l_bfgs_b(..., maxfun=20) once per iteration,
+    which throws the curvature history away every 20 evaluations. The driver
+    keeps one optimization going and calls `callback(x, loss, i)` after the
+    first L-BFGS step past every `save_every` evaluations, where `i` counts
+    the checkpoints from 1. A callback returning True stops the optimization.
+
+    `restart_every` reproduces the old behaviour (a fresh L-BFGS every that
+    many evaluations) for comparisons. A window that converges ends the run,
+    unless `restart_converged`: for objectives the callback changes between
+    windows, the restarts then go on until the evaluation budget is used, the
+    stopping policy ends the run or the callback returns True (`converged`
+    tells it whether the last window converged).
+
+    With dtype='float32' the optimization runs in Float32LBFGS instead of
+    scipy's float64 L-BFGS-B.
+
+    With a `checkpoint` (see checkpoint.Checkpoint) the state is saved at
+    every checkpoint and `run(..., resume=True)` continues from the last one.
+    scipy's L-BFGS-B does not expose its curvature history, so it restarts
+    with an empty one on resume; the float32 optimizer resumes exactly.
+
+    A `stopping` policy (see stopping.StoppingPolicy) is consulted at every
+    checkpoint. Once its wall-clock budget runs out the driver stops before
+    the next evaluation and checkpoints the last L-BFGS iterate.
+    '''
+    def __init__(self, loss, grads, max_evals, save_every=20, restart_every=None, m=10, dtype='float64',
+                 checkpoint=None, stopping=None, restart_converged=False):
+        self.loss = loss
+        self.grads = grads
+        self.max_evals = max_evals
+        self.save_every = save_every
+        self.restart_every = restart_every
+        self.restart_converged = restart_converged
+        self.converged = False
+        self.m = m
+        self.dtype = dtype
+        self.checkpoint = checkpoint
+        self.stopping = stopping
+        self.stop_reason = None
+        self.lbfgs = None
+
+        self.nb_evals = 0
+        self.nb_checkpoints = 0
+        self.loss_history = []
+        self.last_loss = None
+        self.best_loss = None
+        self.best_x = None
+
+    def _loss(self, x):
+        if self.stopping is not None and self.stopping.expired():
+            raise _DeadlineReached()
+        self.nb_evals += 1
+        self.last_loss = self.loss(x)
+        self.loss_history.append(float(self.last_loss))
+        return self.last_loss
+
+    def _checkpoint(self, x):
+        if self.best_loss is None or self.last_loss < self.best_loss:
+            self.best_loss = self.last_loss
+            self.best_x = np.copy(x)
+
+        self.nb_checkpoints += 1
+        self._checkpoint_evals = self.nb_evals
+        self._next_checkpoint = (self.nb_evals // self.save_every + 1) * self.save_every
+        if self.checkpoint is not None:
+            self.checkpoint.save(*self.state(x))
+        if self._callback is not None and self._callback(x, self.last_loss, self.nb_checkpoints):
+            self.stop_reason = "Stopped by the callback"
+            raise _StopOptimization()
+        if self.stopping is not None:
+            self.stop_reason = self.stopping.update(self.last_loss)
+            if self.stop_reason is not None:
+                raise _StopOptimization()
+
+    def _on_iteration(self, x):
+        # called by L-BFGS after each step, once `x` is the last evaluated point
+        if self.stopping is not None and self.stopping.deadline is not None:
+            # kept for the final checkpoint when the deadline interrupts the next step
+            if self._last_iterate is None:
+                self._last_iterate = np.empty_like(x)
+            np.copyto(self._last_iterate, x)
+            self._last_iterate_loss = self.last_loss
+            self._last_iterate_evals = self.nb_evals
+
+        if self.nb_evals >= self._next_checkpoint:
+            self._checkpoint(x)
+
+    def state(self, x):
+        '''(arrays, meta) of the optimization at the checkpoint `x`.'''
+        arrays = {'x': x, 'best_x': self.best_x}
+        meta = {'nb_evals': self.nb_evals, 'nb_checkpoints': self.nb_checkpoints,
+                'loss_history': self.loss_history, 'last_loss': float(self.last_loss),
+                'best_loss': float(self.best_loss)}
+        if self.lbfgs is not None:
+            lbfgs_arrays, lbfgs_meta = self.lbfgs.state()
+            arrays.update(lbfgs_arrays)
+            meta.update(lbfgs_meta)
+        return arrays, meta
+
+    def load_state(self, arrays, meta):
+        '''Restore the counters, loss history and best image of a checkpoint; returns its x.'''
+        self.nb_evals = meta['nb_evals']
+        self.nb_checkpoints = meta['nb_checkpoints']
+        self.loss_history = list(meta['loss_history'])
+        self.last_loss = meta['last_loss']
+        self.best_loss = meta['best_loss']
+        self.best_x = np.array(arrays['best_x'])
+
+        if self.dtype == 'float32' and 'lbfgs_x' in arrays:
+            self.lbfgs = Float32LBFGS(arrays['lbfgs_x'].shape[0], m=arrays['lbfgs_s'].shape[0])
+            self.lbfgs.load_state(arrays, meta)
+        return np.array(arrays['x'])
+
+    def run(self, x, callback=None, resume=False):
+        '''Minimize from `x`, or from the last checkpoint if `resume`.
+
+        Returns the best checkpointed x, its loss and the evaluation count.
+        '''
+        self._callback = callback
+        self._checkpoint_evals = -1
+        self._last_iterate = None
+
+        saved = self.checkpoint.load() if resume and self.checkpoint is not None else None
+        if saved is not None:
+            assert saved[0]['x'].size == x.size, "The checkpoint is of an image of a different size"
+            x = self.load_state(*saved)
+            self._checkpoint_evals = self.nb_evals
+            print('Resuming after %d evaluations (%d iterations), loss %g' % (self.nb_evals, self.nb_checkpoints,
+                                                                              self.last_loss))
+        self._next_checkpoint = (self.nb_evals // self.save_every + 1) * self.save_every
+        remaining = self.max_evals - self.nb_evals
+        if remaining <= 0:
+            return self.best_x, self.best_loss, self.nb_evals
+
+        try:
+            if self.dtype == 'float32':
+                assert self.restart_every is None, "The float32 L-BFGS does not support restarts"
+                if self.lbfgs is None:
+                    self.lbfgs = Float32LBFGS(x.size, m=self.m)
+                    start = x
+                else:
+                    start = None  # resumed
+                x, min_val = self.lbfgs.minimize(self._loss, self.grads, start, remaining,
+                                                 callback=self._on_iteration)
+            elif self.restart_every is None:
+                x, min_val, info = fmin_l_bfgs_b(self._loss, x.flatten(), fprime=self.grads, m=self.m,
+                                                 maxfun=remaining, maxiter=remaining,
+                                                 callback=self._on_iteration)
+            else:
+                while self.nb_evals < self.max_evals:
+                    maxfun = min(self.restart_every, self.max_evals - self.nb_evals)
+                    x, min_val, info = fmin_l_bfgs_b(self._loss, x.flatten(), fprime=self.grads, m=self.m,
+                                                     maxfun=maxfun)
+                    self.converged = info['warnflag'] == 0
+                    if self.converged and not self.restart_converged:
+                        break
+                    self.last_loss = min_val
+                    self._checkpoint(x)
+
+            if self._checkpoint_evals != self.nb_evals:
+                # converged, or stopped between two checkpoints
+                self.last_loss = min_val
+                self._checkpoint(x)
+        except _StopOptimization:
+            pass
+        except _DeadlineReached:
+            self.stop_reason = "Wall-clock budget used up"
+            if self._last_iterate is not None and self._last_iterate_evals != self._checkpoint_evals:
+                self.last_loss = self._last_iterate_loss
+                try:
+                    self._checkpoint(self._last_iterate)
+                except _StopOptimization:
+                    pass
+
+        if self.stop_reason is not None:
+            print("%s after %d evaluations. Stopping early." % (self.stop_reason, self.nb_evals))
+        return self.best_x, self.best_loss, self.nb_evals
@@ -1,17 +1,22 @@
 
-from scipy.misc import imread, imresize, imsave, fromimage, toimage
-from scipy.optimize import fmin_l_bfgs_b
+from scipy.misc import imread, imresize, imsave
 import numpy as np
 import time
 import argparse
+import sys
 import warnings
 
 from keras.models import Model
 from keras.layers import Input
-from keras.layers.convolutional import Convolution2D, AveragePooling2D, MaxPooling2D
 from keras import backend as K
-from keras.utils.data_utils import get_file
-from keras.utils.layer_utils import convert_all_kernels_in_model
+
+from gram_cache import GramCache
+from checkpoint import AsyncImageWriter, Checkpoint
+from optimizer import BufferedEvaluator, LBFGSDriver
+from profiling import Profiler, profile_forward
+from result_cache import ResultCache
+from stopping import StoppingPolicy
+from style_engine import vgg_layers, load_vgg_weights, blend_style_targets
 
 """
 Neural Style Transfer with Keras 1.2.2
@@ -20,12 +25,6 @@ https://github.com/fchollet/keras/blob/master/examples/neural_style_transfer.py
 -----------------------------------------------------------------------------------------------------------------------
 """
 
-THEANO_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg16_weights_th_dim_ordering_th_kernels_notop.h5'
-TF_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5'
-
-TH_19_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg19_weights_th_dim_ordering_th_kernels_notop.h5'
-TF_19_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg19_weights_tf_dim_ordering_tf_kernels_notop.h5'
-
 
 parser = argparse.ArgumentParser(description='Neural style transfer with Keras.')
 parser.add_argument('base_image_path', metavar='base', type=str,
@@ -88,8 +87,64 @@ parser.add_argument("--pool_type", dest="pool", default="max", type=str,
 parser.add_argument('--preserve_color', dest='color', default="False", type=str,
                     help='Preserve original color in image')
 
+parser.add_argument("--precompute_targets", dest="precompute_targets", default="True", type=str,
+                    help="Run the content and style images through VGG once and keep their features as constants")
+
+parser.add_argument("--evals_per_iter", dest="evals_per_iter", default=20, type=int,
+                    help="Function evaluations per iteration. L-BFGS keeps its state across iterations "
+                         "and an image is saved after each one")
+
+parser.add_argument("--float32_optimizer", dest="float32_optimizer", default="False", type=str,
+                    help="Run L-BFGS in float32 instead of scipy's float64 L-BFGS-B, halving its memory")
+
+parser.add_argument("--save_every", dest="save_every", default=1, type=int,
+                    help="Save an image every this many iterations. 0 saves only the final image")
+
+parser.add_argument("--save_threads", dest="save_threads", default=1, type=int,
+                    help="Threads writing the images in the background. 0 writes them on the main thread")
+
 parser.add_argument('--min_improvement', default=0.0, type=float,
-                    help='Defines minimum improvement required to continue script')
+                    help='Stop once the loss improves by less than this many percent over --improvement_window '
+                         'iterations (0 never stops)')
+
+parser.add_argument('--improvement_window', default=1, type=int,
+                    help='Number of iterations the improvement is measured over')
+
+parser.add_argument('--target_loss', default=None, type=float,
+                    help='Stop once the loss reaches this value')
+
+parser.add_argument('--max_seconds', default=None, type=float,
+                    help='Wall-clock budget of the run in seconds, after which the best image so far is written')
+
+parser.add_argument("--profile", dest="profile", default=None, type=str,
+                    help="Write the time spent in each phase of the run to this file")
+
+parser.add_argument("--profile_format", dest="profile_format", default="jsonl", type=str,
+                    help="Format of the --profile file: 'jsonl' (one JSON object per line) or 'chrome' (Chrome trace)")
+
+parser.add_argument("--checkpoint_dir", dest="checkpoint_dir", default=None, type=str,
+                    help="Save the optimization state to this directory after every iteration")
+
+parser.add_argument("--resume", dest="resume", default="False", type=str,
+                    help="Continue from the state in --checkpoint_dir, if there is one")
+
+parser.add_argument("--blend_styles", dest="blend_styles", default="False", type=str,
+                    help="Replace the per style losses with one loss against the weighted mean gram matrix")
+
+parser.add_argument("--gram_cache_dir", dest="gram_cache_dir", default=None, type=str,
+                    help="Directory of the on-disk cache of style gram matrices (disabled if not set)")
+
+parser.add_argument("--gram_cache_size", dest="gram_cache_size", default=1024, type=int,
+                    help="Maximum size of the style gram matrix cache in MB")
+
+parser.add_argument("--result_cache_dir", dest="result_cache_dir", default=None, type=str,
+                    help="Directory of the on-disk cache of final images; identical requests are served from it")
+
+parser.add_argument("--result_cache_size", dest="result_cache_size", default=4096, type=int,
+                    help="Maximum size of the result cache in MB")
+
+parser.add_argument("--import_result", dest="import_result", default=None, type=str,
+                    help="Add this image, made earlier with the same arguments, to --result_cache_dir and exit")
 
 
 def str_to_bool(v):
@@ -125,6 +180,35 @@ color_mask_present = args.color_mask is not None
 rescale_image = str_to_bool(args.rescale_image)
 maintain_aspect_ratio = str_to_bool(args.maintain_aspect_ratio)
 preserve_color = str_to_bool(args.color)
+precompute_targets = str_to_bool(args.precompute_targets)
+float32_optimizer = str_to_bool(args.float32_optimizer)
+optimizer_dtype = 'float32' if float32_optimizer else 'float64'
+stopping = StoppingPolicy(args.min_improvement, args.improvement_window, args.target_loss, args.max_seconds)
+profiler = Profiler(args.profile, args.profile_format)
+resume = str_to_bool(args.resume)
+assert args.checkpoint_dir is not None or not resume, "Resuming requires --checkpoint_dir"
+blend_styles = str_to_bool(args.blend_styles)
+assert precompute_targets or not blend_styles, "Blending styles requires precomputed targets"
+assert not (blend_styles and style_masks_present), "Masked styles cannot be blended"
+
+gram_cache = None
+if args.gram_cache_dir is not None:
+    gram_cache = GramCache(args.gram_cache_dir, args.gram_cache_size * 1024 ** 2)
+
+result_cache = None
+if args.result_cache_dir is not None:
+    result_cache = ResultCache(args.result_cache_dir, args.result_cache_size * 1024 ** 2)
+    result_key = result_cache.key(args, 'original.py')
+
+    if args.import_result is not None:
+        result_cache.import_result(result_key, args.import_result, args.num_iter)
+        print('Imported %s into the result cache' % args.import_result)
+        sys.exit(0)
+
+    cached_path = result_cache.restore(result_key, result_prefix, '_final.png')
+    if cached_path is not None:
+        print('Identical request found in the result cache, image saved as', cached_path)
+        sys.exit(0)
 
 # these are the weights of the different loss components
 content_weight = args.content_weight
@@ -149,10 +233,8 @@ else:
 
 
 # Decide pooling function
-pooltype = str(args.pool).lower()
-assert pooltype in ["ave", "max"], 'Pooling argument is wrong. Needs to be either "ave" or "max".'
-
-pooltype = 1 if pooltype == "ave" else 0
+pool_type = str(args.pool).lower()
+assert pool_type in ["ave", "max"], 'Pooling argument is wrong. Needs to be either "ave" or "max".'
 
 read_mode = "gray" if args.init_image == "gray" else "color"
 
@@ -170,8 +252,10 @@ def preprocess_image(image_path, load_dims=False, read_mode="color"):
     global img_width, img_height, img_WIDTH, img_HEIGHT, aspect_ratio
 
     mode = "RGB" if read_mode == "color" else "L"
-    img = imread(image_path, mode=mode)  # Prevents crashes due to PNG images (ARGB)
+    with profiler.phase('decode', path=image_path):
+        img = imread(image_path, mode=mode)  # Prevents crashes due to PNG images (ARGB)
 
+    phase_start = time.time()
     if mode == "L":
         # Expand the 1 channel grayscale to 3 channel grayscale image
         temp = np.zeros(img.shape + (3,), dtype=np.uint8)
@@ -205,6 +289,7 @@ def preprocess_image(image_path, load_dims=False, read_mode="color"):
         img = img.transpose((2, 0, 1)).astype('float32')
 
     img = np.expand_dims(img, axis=0)
+    profiler.record('preprocess', phase_start, time.time() - phase_start, path=image_path)
     return img
 
 
@@ -227,68 +312,77 @@ def deprocess_image(x):
     return x
 
 
-# util function to preserve image color
-def original_color_transform(content, generated, mask=None):
-    generated = fromimage(toimage(generated, mode='RGB'), mode='YCbCr')  # Convert to YCbCr color space
-
-    if mask is None:
-        generated[:, :, 1:] = content[:, :, 1:]  # Generated CbCr = Content CbCr
-    else:
-        width, height, channels = generated.shape
+# RGB <-> YCbCr (ITU-R BT.601, full range, as in PIL) with the chroma offset of 128 left out
+RGB_TO_YCBCR = np.array([[0.299, 0.587, 0.114],
+                         [-0.168736, -0.331264, 0.5],
+                         [0.5, -0.418688, -0.081312]], dtype='float32')
+YCBCR_TO_RGB = np.array([[1., 0., 1.402],
+                         [1., -0.344136, -0.714136],
+                         [1., 1.772, 0.]], dtype='float32')
 
-        for i in range(width):
-            for j in range(height):
-                if mask[i, j] == 1:
-                    generated[i, j, 1:] = content[i, j, 1:]
 
-    generated = fromimage(toimage(generated, mode='YCbCr'), mode='RGB')  # Convert to RGB color space
-    return generated
+# util function to preserve image color: keeps the luminance of the generated
+# RGB image and takes the chroma of the YCbCr content image (where mask == 1)
+def original_color_transform(content, generated, mask=None):
+    rgb = generated.astype('float32')
+    luminance = np.dot(rgb, RGB_TO_YCBCR[0])
 
+    chroma = content[:, :, 1:].astype('float32')
+    chroma -= 128.
+    if mask is not None:
+        keep = mask != 1
+        chroma[keep] = np.dot(rgb[keep], RGB_TO_YCBCR[1:].T)  # generated CbCr outside the mask
 
-def load_mask(mask_path, shape, return_mask_img=False):
-    if K.image_dim_ordering() == "th":
-        _, channels, width, height = shape
-    else:
-        _, width, height, channels = shape
+    rgb = np.dot(chroma, YCBCR_TO_RGB[:, 1:].T)
+    rgb += luminance[:, :, np.newaxis]
+    np.clip(rgb, 0, 255, out=rgb)
+    np.rint(rgb, out=rgb)
+    return rgb.astype('uint8')
 
-    mask = imread(mask_path, mode="L") # Grayscale mask load
-    mask = imresize(mask, (width, height)).astype('float32')
 
-    # Perform binarization of mask
-    mask[mask <= 127] = 0
-    mask[mask > 128] = 255
+# binarized (0 / 1) mask of size (width, height) from a decoded grayscale mask
+def binarize_mask(mask, width, height):
+    mask = imresize(mask, (width, height))
+    return (mask > 127).astype('float32')
 
-    max = np.amax(mask)
-    mask /= max
 
-    if return_mask_img: return mask
+def load_mask(mask_path, width, height):
+    with profiler.phase('decode', path=mask_path):
+        mask = imread(mask_path, mode="L")  # Grayscale mask load
+    return binarize_mask(mask, width, height)
 
-    mask_shape = shape[1:]
 
-    mask_tensor = np.empty(mask_shape)
+# decodes the mask once and downsamples it to the spatial size of every layer,
+# returns {layer_name: 2D mask}; see expand_mask for the channel axis
+def mask_pyramid(mask_path, layer_names):
+    with profiler.phase('decode', path=mask_path):
+        mask = imread(mask_path, mode="L")
 
-    for i in range(channels):
+    levels = {}
+    pyramid = {}
+    for layer_name in layer_names:
         if K.image_dim_ordering() == "th":
-            mask_tensor[i, :, :] = mask
+            _, _, width, height = shape_dict[layer_name]
         else:
-            mask_tensor[:, :, i] = mask
+            _, width, height, _ = shape_dict[layer_name]
 
-    return mask_tensor
+        if (width, height) not in levels:
+            levels[(width, height)] = binarize_mask(mask, width, height)
+        pyramid[layer_name] = levels[(width, height)]
+    return pyramid
 
 
-def pooling_func(x):
-    if pooltype == 1:
-        return AveragePooling2D((2, 2), strides=(2, 2))(x)
-    else:
-        return MaxPooling2D((2, 2), strides=(2, 2))(x)
+# view of a 2D mask with a channel axis of size 1, which broadcasts over the features
+def expand_mask(mask):
+    return np.expand_dims(mask, 0 if K.image_dim_ordering() == "th" else -1)
 
 
 # get tensor representations of our images
-base_image = K.variable(preprocess_image(base_image_path, True, read_mode=read_mode))
+base_image = preprocess_image(base_image_path, True, read_mode=read_mode)
 
 style_reference_images = []
 for style_path in style_image_paths:
-    style_reference_images.append(K.variable(preprocess_image(style_path)))
+    style_reference_images.append(preprocess_image(style_path))
 
 # this will contain our generated image
 if K.image_dim_ordering() == 'th':
@@ -296,13 +390,18 @@ if K.image_dim_ordering() == 'th':
 else:
     combination_image = K.placeholder((1, img_width, img_height, 3))
 
-image_tensors = [base_image]
-for style_image_tensor in style_reference_images:
-    image_tensors.append(style_image_tensor)
-image_tensors.append(combination_image)
+if precompute_targets:
+    # Only the generated image goes through the network on every evaluation.
+    # The content and style targets are computed once after the model is built.
+    image_tensors = [combination_image]
+else:
+    image_tensors = [K.variable(base_image)]
+    for style_image in style_reference_images:
+        image_tensors.append(K.variable(style_image))
+    image_tensors.append(combination_image)
 
 nb_tensors = len(image_tensors)
-nb_style_images = nb_tensors - 2 # Content and Output image not considered
+nb_style_images = len(style_reference_images)
 
 # combine the various images into a single Keras tensor
 input_tensor = K.concatenate(image_tensors, axis=0)
@@ -314,63 +413,19 @@ else:
 
 ip = Input(tensor=input_tensor, shape=shape)
 
-# build the VGG16 network with our 3 images as input
-x = Convolution2D(64, 3, 3, activation='relu', name='conv1_1', border_mode='same')(ip)
-x = Convolution2D(64, 3, 3, activation='relu', name='conv1_2', border_mode='same')(x)
-x = pooling_func(x)
-
-x = Convolution2D(128, 3, 3, activation='relu', name='conv2_1', border_mode='same')(x)
-x = Convolution2D(128, 3, 3, activation='relu', name='conv2_2', border_mode='same')(x)
-x = pooling_func(x)
-
-x = Convolution2D(256, 3, 3, activation='relu', name='conv3_1', border_mode='same')(x)
-x = Convolution2D(256, 3, 3, activation='relu', name='conv3_2', border_mode='same')(x)
-x = Convolution2D(256, 3, 3, activation='relu', name='conv3_3', border_mode='same')(x)
-if args.model == "vgg19":
-    x = Convolution2D(256, 3, 3, activation='relu', name='conv3_4', border_mode='same')(x)
-x = pooling_func(x)
-
-x = Convolution2D(512, 3, 3, activation='relu', name='conv4_1', border_mode='same')(x)
-x = Convolution2D(512, 3, 3, activation='relu', name='conv4_2', border_mode='same')(x)
-x = Convolution2D(512, 3, 3, activation='relu', name='conv4_3', border_mode='same')(x)
-if args.model == "vgg19":
-    x = Convolution2D(512, 3, 3, activation='relu', name='conv4_4', border_mode='same')(x)
-x = pooling_func(x)
-
-x = Convolution2D(512, 3, 3, activation='relu', name='conv5_1', border_mode='same')(x)
-x = Convolution2D(512, 3, 3, activation='relu', name='conv5_2', border_mode='same')(x)
-x = Convolution2D(512, 3, 3, activation='relu', name='conv5_3', border_mode='same')(x)
-if args.model == "vgg19":
-    x = Convolution2D(512, 3, 3, activation='relu', name='conv5_4', border_mode='same')(x)
-x = pooling_func(x)
-
-model = Model(ip, x)
-weights = ""
-if K.image_dim_ordering() == "th":
-    if args.model == "vgg19":
-        weights = get_file('vgg19_weights_th_dim_ordering_th_kernels_notop.h5', TH_19_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
-    else:
-        weights = get_file('vgg16_weights_th_dim_ordering_th_kernels_notop.h5', THEANO_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
-else:
-    if args.model == "vgg19":
-        weights = get_file('vgg19_weights_tf_dim_ordering_tf_kernels_notop.h5', TF_19_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
-    else:
-        weights = get_file('vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5', TF_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
+feature_layers = ['conv1_1', 'conv2_1', 'conv3_1', 'conv4_1', 'conv5_1']
 
-print("Weights Path: ", weights)
+# build the network only up to the deepest layer the losses read from
+phase_start = time.time()
+x = ip
+for layer in vgg_layers(args.model, pool_type, [args.content_layer] + feature_layers):
+    x = layer(x)
 
-model.load_weights(weights)
+model = Model(ip, x)
+profiler.record('build_model', phase_start, time.time() - phase_start)
 
-if K.backend() == 'tensorflow' and K.image_dim_ordering() == "th":
-    warnings.warn('You are using the TensorFlow backend, yet you '
-                  'are using the Theano '
-                  'image dimension ordering convention '
-                  '(`image_dim_ordering="th"`). '
-                  'For best performance, set '
-                  '`image_dim_ordering="tf"` in '
-                  'your Keras config '
-                  'at ~/.keras/keras.json.')
-    convert_all_kernels_in_model(model)
+with profiler.phase('load_weights'):
+    load_vgg_weights(model, args.model)
 
 print('Model loaded.')
 
@@ -392,25 +447,41 @@ def gram_matrix(x):
     return gram
 
 
+# numpy version of gram_matrix, used for the precomputed style targets
+def gram_matrix_value(x):
+    assert x.ndim == 3
+    if K.image_dim_ordering() == "th":
+        features = x.reshape((x.shape[0], -1))
+    else:
+        features = x.reshape((-1, x.shape[-1])).T
+    return features.dot(features.T)
+
+
+# gram matrix of the (optionally masked) style features, `mask` is a
+# broadcastable mask tensor from style_mask_tensors
+def masked_gram_matrix(style, mask=None):
+    if mask is not None:
+        style = style * mask
+    return gram_matrix(style)
+
+
+# numpy version of masked_gram_matrix, used for the precomputed style targets,
+# `mask` is a 2D level of mask_pyramid
+def masked_gram_matrix_value(style, mask=None):
+    if mask is not None:
+        style = style * expand_mask(mask)
+    return gram_matrix_value(style)
+
+
 # the "style loss" is designed to maintain
 # the style of the reference image in the generated image.
 # It is based on the gram matrices (which capture style) of
 # feature maps from the style reference image
 # and from the generated image
-def style_loss(style, combination, mask_path=None, nb_channels=None):
-    assert K.ndim(style) == 3
+def style_loss(S, combination, mask=None):
     assert K.ndim(combination) == 3
 
-    if mask_path is not None:
-        style_mask = K.variable(load_mask(mask_path, nb_channels))
-
-        style = style * K.stop_gradient(style_mask)
-        combination = combination * K.stop_gradient(style_mask)
-
-        del style_mask
-
-    S = gram_matrix(style)
-    C = gram_matrix(combination)
+    C = masked_gram_matrix(combination, mask)
     channels = 3
     size = img_width * img_height
     return K.sum(K.square(S - C)) / (4. * (channels ** 2) * (size ** 2))
@@ -448,31 +519,94 @@ def total_variation_loss(x):
     return K.sum(K.pow(a + b, 1.25))
 
 
-# combine these loss functions into a single scalar
-loss = K.variable(0.)
-layer_features = outputs_dict[args.content_layer]  # 'conv5_2' or 'conv4_2'
-base_image_features = layer_features[0, :, :, :]
-combination_features = layer_features[nb_tensors - 1, :, :, :]
-loss += content_weight * content_loss(base_image_features,
-                                      combination_features)
 style_masks = []
 if style_masks_present:
     style_masks = mask_paths # If mask present, pass dictionary of masks to style loss
 else:
     style_masks = [None for _ in range(nb_style_images)] # If masks not present, pass None to the style loss
 
+# every style mask is read once, then kept per layer as a single channel
+style_mask_levels = [mask_pyramid(mask_path, feature_layers) if mask_path is not None else None
+                     for mask_path in style_masks]
+mask_channel_axis = 0 if K.image_dim_ordering() == "th" else -1
+style_mask_tensors = [dict((layer_name, K.stop_gradient(K.expand_dims(K.variable(level), mask_channel_axis)))
+                           for layer_name, level in levels.items()) if levels is not None else None
+                      for levels in style_mask_levels]
+
+
+# mask of style image j at layer_name from style_mask_levels or style_mask_tensors, or None
+def layer_mask(masks, j, layer_name):
+    return masks[j][layer_name] if masks[j] is not None else None
+
+
+combination_index = nb_tensors - 1
+
+# content features and style gram matrices the generated image is pulled towards
+phase_start = time.time()
+if precompute_targets:
+    content_fn = K.function([combination_image], [outputs_dict[args.content_layer]])
+    content_target = K.variable(content_fn([base_image])[0][0])
+
+    style_fn = K.function([combination_image], [outputs_dict[layer_name] for layer_name in feature_layers])
+    style_grams = dict([(layer_name, []) for layer_name in feature_layers])
+    for j, style_image in enumerate(style_reference_images):
+        grams = None
+        if gram_cache is not None:
+            cache_keys = [gram_cache.key(style_image_paths[j], layer_name, mask_path=style_masks[j],
+                                         size=(img_width, img_height), model=args.model, pool=pool_type,
+                                         dim_ordering=K.image_dim_ordering())
+                          for layer_name in feature_layers]
+            grams = [gram_cache.get(key) for key in cache_keys]
+            if any(gram is None for gram in grams):
+                grams = None
+
+        if grams is None:
+            style_outputs = style_fn([style_image])
+            grams = [masked_gram_matrix_value(style_features[0], layer_mask(style_mask_levels, j, layer_name))
+                     for layer_name, style_features in zip(feature_layers, style_outputs)]
+            if gram_cache is not None:
+                for key, gram in zip(cache_keys, grams):
+                    gram_cache.put(key, gram)
+
+        for layer_name, gram in zip(feature_layers, grams):
+            style_grams[layer_name].append(gram)
+
+    if blend_styles:
+        blended, style_weights = blend_style_targets([style_grams[layer_name] for layer_name in feature_layers],
+                                                     style_weights)
+        style_grams = dict(zip(feature_layers, blended))
+        nb_style_images = 1
+
+    style_targets = dict([(layer_name, [K.variable(gram) for gram in style_grams[layer_name]])
+                          for layer_name in feature_layers])
+
+    print('Style and content targets precomputed.')
+else:
+    content_target = outputs_dict[args.content_layer][0, :, :, :]
+    style_targets = dict([(layer_name, [masked_gram_matrix(outputs_dict[layer_name][j + 1, :, :, :],
+                                                           layer_mask(style_mask_tensors, j, layer_name))
+                                        for j in range(nb_style_images)])
+                          for layer_name in feature_layers])
+profiler.record('targets', phase_start, time.time() - phase_start)
+
+# combine these loss functions into a single scalar
+phase_start = time.time()
+loss = K.variable(0.)
+layer_features = outputs_dict[args.content_layer]  # 'conv5_2' or 'conv4_2'
+combination_features = layer_features[combination_index, :, :, :]
+loss += content_weight * content_loss(content_target,
+                                      combination_features)
+
 channel_index = 1 if K.image_dim_ordering() == "th" else -1
 
-feature_layers = ['conv1_1', 'conv2_1', 'conv3_1', 'conv4_1', 'conv5_1']
 for layer_name in feature_layers:
     layer_features = outputs_dict[layer_name]
-    shape = shape_dict[layer_name]
-    combination_features = layer_features[nb_tensors - 1, :, :, :]
+    combination_features = layer_features[combination_index, :, :, :]
 
-    style_reference_features = layer_features[1:nb_tensors - 1, :, :, :]
     sl = []
     for j in range(nb_style_images):
-        sl.append(style_loss(style_reference_features[j], combination_features, style_masks[j], shape))
+        sl.append(style_loss(style_targets[layer_name][j], combination_features,
+                             layer_mask(style_mask_tensors, j, layer_name)))
 
     for j in range(nb_style_images):
         loss += (style_weights[j] / len(feature_layers)) * sl[j]
@@ -487,51 +621,16 @@ if type(grads) in {list, tuple}:
     outputs += grads
 else:
     outputs.append(grads)
+profiler.record('build_loss', phase_start, time.time() - phase_start)
 
-f_outputs = K.function([combination_image], outputs)
+with profiler.phase('compile'):
+    f_outputs = K.function([combination_image], outputs)
+f_outputs = profiler.wrap('evaluate', f_outputs)  # the first call includes the backend's lazy setup
 
 
-def eval_loss_and_grads(x):
-    if K.image_dim_ordering() == 'th':
-        x = x.reshape((1, 3, img_width, img_height))
-    else:
-        x = x.reshape((1, img_width, img_height, 3))
-    outs = f_outputs([x])
-    loss_value = outs[0]
-    if len(outs[1:]) == 1:
-        grad_values = outs[1].flatten().astype('float64')
-    else:
-        grad_values = np.array(outs[1:]).flatten().astype('float64')
-    return loss_value, grad_values
-
-
-# this Evaluator class makes it possible
-# to compute loss and gradients in one pass
-# while retrieving them via two separate functions,
-# "loss" and "grads". This is done because scipy.optimize
-# requires separate functions for loss and gradients,
-# but computing them separately would be inefficient.
-class Evaluator(object):
-    def __init__(self):
-        self.loss_value = None
-        self.grads_values = None
-
-    def loss(self, x):
-        assert self.loss_value is None
-        loss_value, grad_values = eval_loss_and_grads(x)
-        self.loss_value = loss_value
-        self.grad_values = grad_values
-        return self.loss_value
-
-    def grads(self, x):
-        assert self.loss_value is not None
-        grad_values = np.copy(self.grad_values)
-        self.loss_value = None
-        self.grad_values = None
-        return grad_values
-
-
-evaluator = Evaluator()
+# computes loss and gradients in one pass and hands them to the optimizer
+# through "loss" and "grads", reusing the same buffers on every evaluation
+evaluator = BufferedEvaluator(f_outputs, K.int_shape(combination_image), dtype=optimizer_dtype)
 
 # run scipy-based optimization (L-BFGS) over the pixels of the generated image
 # so as to minimize the neural style loss
@@ -548,18 +647,15 @@ else:
     print("Using initial image : ", args.init_image)
     x = preprocess_image(args.init_image, read_mode=read_mode)
 
+profile_forward(profiler, [combination_image], loss, [x])
+
 # We require original image if we are to preserve color in YCbCr mode
 if preserve_color:
     content = imread(base_image_path, mode="YCbCr")
     content = imresize(content, (img_width, img_height))
 
     if color_mask_present:
-        if K.image_dim_ordering() == "th":
-            color_mask_shape = (None, None, img_width, img_height)
-        else:
-            color_mask_shape = (None, img_width, img_height, None)
-
-        color_mask = load_mask(args.color_mask, color_mask_shape, return_mask_img=True)
+        color_mask = load_mask(args.color_mask, img_width, img_height)
     else:
         color_mask = None
 else:
@@ -567,14 +663,41 @@ else:
 
 num_iter = args.num_iter
 prev_min_val = -1
+start_time = time.time()
 
-improvement_threshold = float(args.min_improvement)
 
-for i in range(num_iter):
-    print("Starting iteration %d of %d" % ((i + 1), num_iter))
-    start_time = time.time()
+# deprocesses, color transforms, rescales and writes the generated image of
+# iteration i, run by the image writer on a copy of x
+def save_image(x, i):
+    phase_start = time.time()
+    img = deprocess_image(x)
 
-    x, min_val, info = fmin_l_bfgs_b(evaluator.loss, x.flatten(), fprime=evaluator.grads, maxfun=20)
+    if preserve_color and content is not None:
+        img = original_color_transform(content, img, mask=color_mask)
+
+    if not rescale_image:
+        img_ht = int(img_width * aspect_ratio)
+        img = imresize(img, (img_width, img_ht), interp=args.rescale_method)
+
+    if rescale_image:
+        img = imresize(img, (img_WIDTH, img_HEIGHT), interp=args.rescale_method)
+    profiler.record('postprocess', phase_start, time.time() - phase_start, n=i)
+
+    if i is None:
+        fname = result_prefix + '_final.png'  # the best image of the run
+    else:
+        fname = result_prefix + '_at_iteration_%d.png' % i
+    with profiler.phase('encode', n=i):
+        imsave(fname, img)
+    print('Image saved as', fname)
+
+
+writer = AsyncImageWriter(save_image, nb_threads=args.save_threads)
+
+
+# called by the optimizer after each iteration of `evals_per_iter` evaluations
+def save_iteration(x, min_val, i):
+    global prev_min_val, start_time
 
     if prev_min_val == -1:
         prev_min_val = min_val
@@ -583,29 +706,27 @@ for i in range(num_iter):
 
     print('Current loss value:', min_val, " Improvement : %0.3f" % improvement, "%")
     prev_min_val = min_val
-    # save current generated image
-    img = deprocess_image(x.copy())
 
-    if preserve_color and content is not None:
-        img = original_color_transform(content, img, mask=color_mask)
+    if args.save_every > 0 and i % args.save_every == 0:
+        writer.submit(x, i)
 
-    if not rescale_image:
-        img_ht = int(img_width * aspect_ratio)
-        print("Rescaling Image to (%d, %d)" % (img_width, img_ht))
-        img = imresize(img, (img_width, img_ht), interp=args.rescale_method)
+    end_time = time.time()
+    print('Iteration %d completed in %ds' % (i, end_time - start_time))
+    profiler.record('iteration', start_time, end_time - start_time, n=i, loss=float(min_val))
+    start_time = end_time
 
-    if rescale_image:
-        print("Rescaling Image to (%d, %d)" % (img_WIDTH, img_HEIGHT))
-        img = imresize(img, (img_WIDTH, img_HEIGHT), interp=args.rescale_method)
 
-    fname = result_prefix + '_at_iteration_%d.png' % (i + 1)
-    imsave(fname, img)
-    end_time = time.time()
-    print('Image saved as', fname)
-    print('Iteration %d completed in %ds' % (i + 1, end_time - start_time))
+print("Starting %d iterations of %d evaluations" % (num_iter, args.evals_per_iter))
+checkpoint = Checkpoint(args.checkpoint_dir) if args.checkpoint_dir is not None else None
+driver = LBFGSDriver(evaluator.loss, evaluator.grads, num_iter * args.evals_per_iter, save_every=args.evals_per_iter,
+                     dtype=optimizer_dtype, checkpoint=checkpoint, stopping=stopping)
+x, min_val, nb_evals = driver.run(x, callback=save_iteration, resume=resume)
+
+if x is not None:
+    # the best checkpoint, which need not be the last iterate saved under _at_iteration_<i>.png
+    writer.submit(x, None)
+writer.close()
 
-    if improvement_threshold is not 0.0:
-        if improvement < improvement_threshold and improvement is not 0.0:
-            print("Improvement (%f) is less than improvement threshold (%f). Early stopping script." % (
-                improvement, improvement_threshold))
-            exit()
\ No newline at end of file
+if result_cache is not None and x is not None and writer.nb_failed == 0:
+    result_cache.put(result_key, result_prefix + '_final.png', driver.nb_checkpoints)
+profiler.close()
@@ -0,0 +1,325 @@
+import numpy as np
+import scipy.interpolate
+import scipy.ndimage
+from numpy.lib.stride_tricks import as_strided
+
+"""
+PatchMatch over feature maps, for the MRF losses.
+
+A PatchMatcher keeps a nearest-neighbour field (NNF) from the patches of an
+input feature map to the patches of a target (style) feature map and
+improves it incrementally with propagation and random search, so it can be
+updated cheaply every time the input changes a little.
+"""
+
+
+def _calc_patch_grid_dims(shape, patch_size, patch_stride):
+    x_rows, x_cols = shape[:2]
+    num_rows = 1 + (x_rows - patch_size) // patch_stride
+    num_cols = 1 + (x_cols - patch_size) // patch_stride
+    return num_rows, num_cols
+
+
+def make_patch_grid(x, patch_size, patch_stride=1):
+    '''x shape: (rows, cols, num_channels)
+    output shape: (rows, cols, channels, patch_row, patch_col)
+
+    The grid is a read-only view of `x`: overlapping patches share its
+    memory, so it is copied only by the code that needs them contiguous.
+    '''
+    num_rows, num_cols = _calc_patch_grid_dims(x.shape, patch_size, patch_stride)
+    row_stride, col_stride, channel_stride = x.strides
+    return as_strided(x, shape=(num_rows, num_cols, x.shape[-1], patch_size, patch_size),
+                      strides=(row_stride * patch_stride, col_stride * patch_stride, channel_stride,
+                               row_stride, col_stride),
+                      writeable=False)
+
+
+def combine_patches_grid(in_patches, out_shape, patch_stride=1):
+    '''Reconstruct an image from these `patches`
+    input shape: (rows, cols, channels, patch_row, patch_col)
+    output shape: `out_shape` (rows, cols, channels)
+
+    Overlap-add: every pixel is the mean of the patch pixels that cover it
+    (0 where no patch does). The patches are added one patch offset at a
+    time, each a strided slice over the whole grid, so the Python loop runs
+    patch_size ** 2 times whatever the size of the image.
+    '''
+    num_rows, num_cols = in_patches.shape[:2]
+    patch_size = in_patches.shape[-1]
+    dtype = np.result_type(in_patches.dtype, np.float32)
+    recon = np.zeros(out_shape, dtype=dtype)
+    counts = np.zeros(tuple(out_shape[:2]) + (1,), dtype=dtype)
+    row_end, col_end = patch_stride * (num_rows - 1) + 1, patch_stride * (num_cols - 1) + 1
+    for i in range(patch_size):
+        for j in range(patch_size):
+            window = (slice(i, i + row_end, patch_stride), slice(j, j + col_end, patch_stride))
+            recon[window] += in_patches[:, :, :, i, j]
+            counts[window] += 1
+    recon /= np.maximum(counts, 1)
+    return recon
+
+
+class PatchMatcher(object):
+    '''A matcher of image patches inspired by the PatchMatch algorithm.
+    image shape: (rows, cols, channels)
+    '''
+    def __init__(self, input_shape, target_img, patch_size=1, patch_stride=1, jump_size=0.5,
+            num_propagation_steps=5, num_random_steps=5, random_max_radius=1.0, random_scale=0.5,
+            chunk_size=1024):
+        self.input_shape = input_shape
+        self.patch_size = patch_size
+        self.patch_stride = patch_stride
+        self.jump_size = jump_size
+        self.num_propagation_steps = num_propagation_steps
+        self.num_random_steps = num_random_steps
+        self.random_max_radius = random_max_radius
+        self.random_scale = random_scale
+        self.num_input_rows, self.num_input_cols = _calc_patch_grid_dims(input_shape, patch_size, patch_stride)
+        self.target_patches = make_patch_grid(target_img, patch_size, patch_stride)
+        target_rows, target_cols = self.target_patches.shape[:2]
+        # the normalized target patches as the rows of a matrix, in row-major grid order
+        self.target_matrix = self.normalize_patches(
+            np.array(self.target_patches.reshape((target_rows * target_cols, -1)), dtype='float32'))
+        self.target_dims = np.array([target_rows, target_cols]).reshape((2, 1, 1))
+        # the NNF holds the (row, col) of the matched target patch of every input patch, in int16
+        # when the candidate positions (up to twice the target size before clipping) fit
+        self.coord_dtype = 'int16' if 2 * max(target_rows, target_cols) <= np.iinfo('int16').max else 'int32'
+        self.coords = np.stack([np.random.randint(0, target_rows, (self.num_input_rows, self.num_input_cols)),
+                                np.random.randint(0, target_cols, (self.num_input_rows, self.num_input_cols))])
+        self.coords = self.coords.astype(self.coord_dtype)
+        # cosine similarities are >= -1, so any candidate replaces the unscored random start
+        self.similarity = np.full((self.num_input_rows, self.num_input_cols), -1.0, dtype='float32')
+        # propagation moves exactly one patch per step
+        self.delta_row = np.array([1, 0], dtype=self.coord_dtype).reshape((2, 1, 1))
+        self.delta_col = np.array([0, 1], dtype=self.coord_dtype).reshape((2, 1, 1))
+
+        # buffers reused by every update: the similarities are computed `chunk_size`
+        # patches at a time, so no temporary is larger than chunk_size target patches
+        num_patches = self.num_input_rows * self.num_input_cols
+        self.chunk_size = max(min(chunk_size, num_patches), 1)
+        self._input_matrix = np.empty((num_patches, self.target_matrix.shape[1]), dtype='float32')
+        self._chunk = np.empty((self.chunk_size, self.target_matrix.shape[1]), dtype='float32')
+        self._candidates = np.empty_like(self.coords)
+        self._candidate_indices = np.empty((self.num_input_rows, self.num_input_cols), dtype='int32')
+        self._candidate_similarity = np.empty_like(self.similarity)
+        self._improved = np.empty(self.similarity.shape, dtype=bool)
+
+    def update(self, input_img, reverse_propagation=False):
+        input_patches = self.get_patches_for(input_img)
+        self._input_matrix.reshape(input_patches.shape)[...] = input_patches
+        self.update_with_patches(self.normalize_patches(self._input_matrix), reverse_propagation=reverse_propagation)
+
+    def update_with_patches(self, input_patches, reverse_propagation=False):
+        '''Improve the matches of the rows of the normalized input patch matrix `input_patches`.'''
+        self._propagate(input_patches, reverse_propagation=reverse_propagation)
+        self._random_update(input_patches)
+
+    def get_patches_for(self, img):
+        return make_patch_grid(img, self.patch_size, self.patch_stride)
+
+    def normalize_patches(self, patches):
+        '''Scale the rows of the patch matrix `patches` to unit length, in place.'''
+        norm = np.sqrt(np.einsum('ij,ij->i', patches, patches))
+        norm += 1e-8  # ReLU feature maps have all-zero patches
+        patches /= norm[:, np.newaxis]
+        return patches
+
+    def _propagate(self, input_patches, reverse_propagation=False):
+        if reverse_propagation:
+            roll_direction = 1
+        else:
+            roll_direction = -1
+        for step_i in range(self.num_propagation_steps):
+            # the match of the neighbouring patch along each axis, moved by one patch; the
+            # column candidates already see the matches improved by the row candidates
+            for axis, delta in ((1, self.delta_row), (2, self.delta_col)):
+                new_coords = self._roll_coords(roll_direction, axis)
+                new_coords += delta * roll_direction
+                self.eval_state(self.clip_coords(new_coords), input_patches)
+
+    def _roll_coords(self, shift, axis):
+        '''np.roll(self.coords, shift, axis) for a shift of +-1, into the candidate buffer.'''
+        src, dst = np.moveaxis(self.coords, axis, 0), np.moveaxis(self._candidates, axis, 0)
+        if shift > 0:
+            dst[1:], dst[0] = src[:-1], src[-1]
+        else:
+            dst[:-1], dst[-1] = src[1:], src[0]
+        return self._candidates
+
+    def _random_update(self, input_patches):
+        # random_max_radius is a fraction of the target, the search radius shrinks by random_scale every step
+        max_radius = self.random_max_radius * self.target_dims
+        for alpha in range(1, self.num_random_steps + 1):
+            radius = max_radius * self.random_scale ** alpha
+            if np.all(radius < 1):
+                break  # no move of a whole patch is left
+            offsets = np.round(np.random.uniform(-1.0, 1.0, self.coords.shape) * radius)
+            # a move of more than the target size lands on its edge after clipping anyway; bounding
+            # it keeps the candidates within the range coord_dtype was chosen for
+            np.clip(offsets, -self.target_dims, self.target_dims, out=offsets)
+            new_coords = self._candidates
+            np.add(self.coords, offsets, out=new_coords, casting='unsafe')
+            self.eval_state(self.clip_coords(new_coords), input_patches)
+
+    def eval_state(self, new_coords, input_patches):
+        '''Replace the matches that `new_coords` improve on, in place.'''
+        new_similarity = self.patch_similarity(input_patches, new_coords)
+        np.greater(new_similarity, self.similarity, out=self._improved)
+        np.copyto(self.similarity, new_similarity, where=self._improved)
+        np.copyto(self.coords, new_coords, where=self._improved)
+        return self.coords, self.similarity
+
+    def patch_similarity(self, source, coords):
+        '''Check the similarity of the patches specified in coords.
+
+        `source` is the normalized input patch matrix; the dot products are
+        computed by chunks of patches through preallocated buffers, and the
+        returned array is overwritten by the next call.
+        '''
+        indices = self._candidate_indices
+        np.multiply(coords[0], int(self.target_dims[1, 0, 0]), out=indices, dtype='int32')
+        np.add(indices, coords[1], out=indices)
+        indices, similarity = indices.ravel(), self._candidate_similarity.ravel()
+        for start in range(0, len(indices), self.chunk_size):
+            end = min(start + self.chunk_size, len(indices))
+            target_vals = self._chunk[:end - start]
+            np.take(self.target_matrix, indices[start:end], axis=0, out=target_vals, mode='clip')
+            np.einsum('ij,ij->i', target_vals, source[start:end], out=similarity[start:end])
+        return self._candidate_similarity
+
+    def clip_coords(self, coords):
+        '''Clip target patch positions to the target patch grid, in place.'''
+        return np.clip(coords, 0, self.target_dims - 1, out=coords)
+
+    def lookup_coords(self, x, coords):
+        return x[coords[0], coords[1]]
+
+    def patch_indices(self):
+        '''Index of the matched target patch of every input patch, with both patch grids in row-major order.'''
+        return (self.coords[0].astype('int32') * int(self.target_dims[1, 0, 0]) + self.coords[1]).ravel()
+
+    def get_reconstruction(self, patches=None, combined=None):
+        if combined is not None:
+            patches = make_patch_grid(combined, self.patch_size, self.patch_stride)
+        if patches is None:
+            patches = self.target_patches
+        patches = self.lookup_coords(patches, self.coords)
+        recon = combine_patches_grid(patches, self.input_shape, self.patch_stride)
+        return recon
+
+    def scale(self, new_shape, new_target_img):
+        '''Create a new matcher of the given shape and replace its
+        state with a scaled up version of the current matcher's state.
+        '''
+        new_matcher = PatchMatcher(new_shape, new_target_img, patch_size=self.patch_size,
+                patch_stride=self.patch_stride, jump_size=self.jump_size,
+                num_propagation_steps=self.num_propagation_steps,
+                num_random_steps=self.num_random_steps,
+                random_max_radius=self.random_max_radius,
+                random_scale=self.random_scale, chunk_size=self.chunk_size)
+        # the matched positions are resampled to the new input grid and rescaled to the new target grid
+        ratio = (new_matcher.target_dims - 1) / np.maximum(self.target_dims - 1, 1).astype('float64')
+        coords = congrid(self.coords, new_matcher.coords.shape, method='neighbour') * ratio
+        np.copyto(new_matcher.coords, new_matcher.clip_coords(np.round(coords)), casting='unsafe')
+        np.copyto(new_matcher.similarity, congrid(self.similarity, new_matcher.similarity.shape, method='neighbour'))
+        return new_matcher
+
+
+def congrid(a, newdims, method='linear', centre=False, minusone=False):
+    '''Arbitrary resampling of source array to new dimension sizes.
+    Currently only supports maintaining the same number of dimensions.
+    To use 1-D arrays, first promote them to shape (x,1).
+    Uses the same parameters and creates the same co-ordinate lookup points
+    as IDL''s congrid routine, which apparently originally came from a VAX/VMS
+    routine of the same name.
+    method:
+    neighbour - closest value from original data
+    nearest and linear - uses n x 1-D interpolations using
+                         scipy.interpolate.interp1d
+    (see Numerical Recipes for validity of use of n 1-D interpolations)
+    spline - uses ndimage.map_coordinates
+    centre:
+    True - interpolation points are at the centres of the bins
+    False - points are at the front edge of the bin
+    minusone:
+    For example- inarray.shape = (i,j) & new dimensions = (x,y)
+    False - inarray is resampled by factors of (i/x) * (j/y)
+    True - inarray is resampled by(i-1)/(x-1) * (j-1)/(y-1)
+    This prevents extrapolation one element beyond bounds of input array.
+    '''
+    if not a.dtype in [np.float64, np.float32]:
+        a = np.cast[float](a)
+
+    m1 = np.cast[int](minusone)
+    ofs = np.cast[int](centre) * 0.5
+    old = np.array( a.shape )
+    ndims = len( a.shape )
+    if len( newdims ) != ndims:
+        print ("[congrid] dimensions error. "
+              "This routine currently only support "
+              "rebinning to the same number of dimensions.")
+        return None
+    newdims = np.asarray( newdims, dtype=float )
+    dimlist = []
+
+    if method == 'neighbour':
+        for i in range( ndims ):
+            base = np.indices(newdims.astype(int))[i]
+            dimlist.append( (old[i] - m1) / (newdims[i] - m1) \
+                            * (base + ofs) - ofs )
+        cd = np.array( dimlist ).round().astype(int)
+        newa = a[tuple( cd )]
+        return newa
+
+    elif method in ['nearest','linear']:
+        # calculate new dims
+        for i in range( ndims ):
+            base = np.arange( newdims[i] )
+            dimlist.append( (old[i] - m1) / (newdims[i] - m1) \
+                            * (base + ofs) - ofs )
+        # specify old dims
+        olddims = [np.arange(i, dtype = np.float) for i in list( a.shape )]
+
+        # first interpolation - for ndims = any
+        mint = scipy.interpolate.interp1d( olddims[-1], a, kind=method )
+        newa = mint( dimlist[-1] )
+
+        trorder = [ndims - 1] + range( ndims - 1 )
+        for i in range( ndims - 2, -1, -1 ):
+            newa = newa.transpose( trorder )
+
+            mint = scipy.interpolate.interp1d( olddims[i], newa, kind=method )
+            newa = mint( dimlist[i] )
+
+        if ndims > 1:
+            # need one more transpose to return to original dimensions
+            newa = newa.transpose( trorder )
+
+        return newa
+    elif method in ['spline']:
+        oslices = [ slice(0,j) for j in old ]
+        oldcoords = np.ogrid[oslices]
+        nslices = [ slice(0,j) for j in list(newdims) ]
+        newcoords = np.mgrid[nslices]
+
+        newcoords_dims = [i for i in range(np.rank(newcoords))]
+        #make first index last
+        newcoords_dims.append(newcoords_dims.pop(0))
+        newcoords_tr = newcoords.transpose(newcoords_dims)
+        # makes a view that affects newcoords
+
+        newcoords_tr += ofs
+
+        deltas = (np.asarray(old) - m1) / (newdims - m1)
+        newcoords_tr *= deltas
+
+        newcoords_tr -= ofs
+
+        newa = scipy.ndimage.map_coordinates(a, newcoords)
+        return newa
+    else:
+        print("Congrid error: Unrecognized interpolation type.\n",
+              "Currently only \'neighbour\', \'nearest\',\'linear\',",
+              "and \'spline\' are supported.")
+        return None
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Profiler(object):
+    '''Times the phases of a run and streams them to a file as they end.
+
+    With trace_format='jsonl' every phase is one JSON object per line:
+        {"phase": "evaluate", "start": 12.5, "seconds": 0.84, "thread": "MainThread", "n": 3}
+    where "start" counts seconds from the creation of the profiler, whose
+    Unix time is in the "unix_time" of the first phase, "start". With
+    'chrome' the file is a Chrome trace (chrome://tracing or Perfetto) in
+    the JSON array format, which stays loadable when the run is killed.
+
+    A profiler without a path records nothing, and `phase`/`wrap` cost next
+    to nothing in that case.
+    '''
+    def __init__(self, path=None, trace_format='jsonl'):
+        assert trace_format in ('jsonl', 'chrome'), "The profile format must be 'jsonl' or 'chrome'"
+        self.enabled = path is not None
+        self.trace_format = trace_format
+        self.origin = time.time()
+        self._lock = threading.Lock()
+        self._file = None
+        self._nb_events = 0
+
+        if self.enabled:
+            self._file = open(path, 'w')
+            if trace_format == 'chrome':
+                self._file.write('[\n')
+            self.record('start', self.origin, 0., unix_time=self.origin)
+
+    @contextmanager
+    def phase(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.time() - start, **args)
+
+    def record(self, name, start, seconds, **args):
+        '''Record a phase that began at `start` (time.time()) and lasted `seconds`.'''
+        if not self.enabled:
+            return
+
+        thread = threading.current_thread()
+        if self.trace_format == 'chrome':
+            event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                     'ts': (start - self.origin) * 1e6, 'dur': seconds * 1e6, 'args': args}
+        else:
+            event = dict(args, phase=name, start=start - self.origin, seconds=seconds, thread=thread.name)
+
+        with self._lock:
+            if self.trace_format == 'chrome' and self._nb_events:
+                self._file.write(',\n')
+            self._file.write(json.dumps(event))
+            if self.trace_format == 'jsonl':
+                self._file.write('\n')
+            self._file.flush()
+            self._nb_events += 1
+
+    def wrap(self, name, function):
+        '''`function` with every call recorded as a `name` phase, numbered by "n".'''
+        if not self.enabled:
+            return function
+
+        counter = [0]
+
+        def timed(*args, **kwargs):
+            counter[0] += 1
+            with self.phase(name, n=counter[0]):
+                return function(*args, **kwargs)
+        return timed
+
+    def close(self):
+        if self._file is None:
+            return
+        with self._lock:
+            if self.trace_format == 'chrome':
+                self._file.write('\n]\n')
+            self._file.close()
+            self._file = None
+        self.enabled = False
+
+
+def profile_forward(profiler, inputs, loss, values, repeats=3):
+    '''Time the forward pass alone.
+
+    The compiled loss/gradient function runs both passes in one backend
+    call, so a loss-only function is compiled and timed `repeats` times on
+    `values`; an evaluation minus a "forward" phase approximates the
+    backward pass.
+    '''
+    if not profiler.enabled:
+        return
+
+    from keras import backend as K
+
+    with profiler.phase('compile', function='loss only'):
+        f_loss = K.function(inputs, [loss])
+    for i in range(repeats):
+        with profiler.phase('forward', n=i + 1):
+            f_loss(values)
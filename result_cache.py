@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+from disk_cache import DiskCache
+
+# arguments that change where and how the results are written, or how fast
+# they are computed, but not the final image
+OUTPUT_ARGS = {'result_prefix', 'save_every', 'save_threads', 'profile', 'profile_format', 'checkpoint_dir',
+               'resume', 'gram_cache_dir', 'gram_cache_size', 'result_cache_dir', 'result_cache_size',
+               'import_result'}
+
+
+class ResultCache(DiskCache):
+    '''Content-addressed on-disk cache of final stylized images.
+
+    The key of a run hashes the bytes of its input images and every other
+    setting of its configuration (model, pool_type, content_layer,
+    init_image, loss weights, ...), so the same request made by different
+    users with different file names and result prefixes is served from one
+    entry. An entry is `<key>.png` plus `<key>.json` with the iteration the
+    image was saved at; once the cache grows past `max_bytes` the least
+    recently used entries are deleted.
+
+    Runs starting from noise are cached like any other: a hit returns the
+    image of the first run rather than a new random one.
+    '''
+    extension = '.png'
+    companion_extensions = ('.json',)
+
+    def _digest_paths(self, value):
+        # arguments that may be image paths (e.g. init_image, style_masks) are
+        # replaced by the digests of the files they name
+        if isinstance(value, (list, tuple)):
+            return [self._digest_paths(v) for v in value]
+        if isinstance(value, str) and os.path.isfile(value):
+            return 'sha1:' + self.file_digest(value)
+        return value
+
+    def key(self, config, script=''):
+        '''Cache key of a run of `script` with the argparse namespace or job dict `config`.'''
+        if not isinstance(config, dict):
+            config = vars(config)
+        settings = dict((name, self._digest_paths(value)) for name, value in config.items()
+                        if name not in OUTPUT_ARGS)
+
+        sha = hashlib.sha1()
+        sha.update(script.encode('utf-8'))
+        sha.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        return sha.hexdigest()
+
+    def restore(self, key, result_prefix, suffix=None):
+        '''Copy the cached image to `result_prefix` + `suffix`, or to `result_prefix`_at_iteration_<i>.png
+        without a suffix; returns that path, or None.'''
+        image_path, meta_path = self._path(key, '.png'), self._path(key, '.json')
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if suffix is not None:
+                fname = result_prefix + suffix
+            else:
+                fname = result_prefix + '_at_iteration_%d.png' % meta['iteration']
+            shutil.copyfile(image_path, fname)
+        except (IOError, OSError, ValueError, KeyError):
+            return None  # missing, evicted meanwhile or partially written
+
+        os.utime(image_path, None)  # mark as recently used
+        return fname
+
+    def put(self, key, image_path, iteration):
+        '''Store the final image `image_path`, saved at `iteration`.'''
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        os.close(fd)
+        shutil.copyfile(image_path, tmp_path)
+        os.rename(tmp_path, self._path(key, '.png'))
+
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'iteration': iteration}, f)
+        os.rename(tmp_path, self._path(key, '.json'))
+
+        self.evict()
+
+    def import_result(self, key, image_path, default_iteration):
+        '''Store an image made before the cache existed, by a run whose configuration gave `key`.
+
+        The iteration is read from an "_at_iteration_<i>.png" name when possible.
+        '''
+        match = re.search(r'_at_iteration_(\d+)\.png$', image_path)
+        self.put(key, image_path, int(match.group(1)) if match else default_iteration)
@@ -0,0 +1,45 @@
+import time
+
+
+class StoppingPolicy(object):
+    '''When to end a run before its iteration budget is used up.
+
+    - min_improvement: stop once the loss improved by less than this many
+      percent over the last `window` iterations (0 disables it).
+    - target_loss: stop once the loss is at or below this value.
+    - max_seconds: wall-clock budget counted from the creation of the policy,
+      checked before every evaluation by LBFGSDriver, which then saves its
+      last iterate as a final checkpoint.
+    '''
+    def __init__(self, min_improvement=0.0, window=1, target_loss=None, max_seconds=None):
+        self.min_improvement = min_improvement
+        self.window = max(window, 1)
+        self.target_loss = target_loss
+        self.deadline = time.time() + max_seconds if max_seconds is not None else None
+        self.history = []
+
+    def reset(self):
+        '''Forget the loss history, e.g. when the next run optimizes another scale. The deadline stays.'''
+        self.history = []
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def update(self, loss):
+        '''Record the loss of an iteration; returns why to stop, or None to go on.'''
+        self.history.append(loss)
+
+        if self.target_loss is not None and loss <= self.target_loss:
+            return "Loss (%g) reached the target loss (%g)" % (loss, self.target_loss)
+
+        if self.min_improvement > 0 and len(self.history) > self.window:
+            prev_loss = self.history[-1 - self.window]
+            improvement = (prev_loss - loss) / prev_loss * 100
+            if improvement < self.min_improvement:
+                return "Improvement over the last %d iterations (%f%%) is less than %f%%" % (
+                    self.window, improvement, self.min_improvement)
+
+        if self.expired():
+            return "Wall-clock budget used up"
+        return None
+
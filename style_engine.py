@@ -0,0 +1,729 @@
+from scipy.misc import imread, imresize, imsave
+import numpy as np
+import h5py
+import threading
+import time
+import warnings
+
+from keras.models import Model
+from keras.layers import Input
+from keras.layers.convolutional import Convolution2D, AveragePooling2D, MaxPooling2D
+from keras import backend as K
+from keras.utils.data_utils import get_file
+from keras.utils.layer_utils import convert_all_kernels_in_model
+
+from checkpoint import AsyncImageWriter
+from disk_cache import file_digest
+from gram_cache import GramCache
+from optimizer import BatchEvaluator, BufferedEvaluator, LBFGSDriver
+
+"""
+Reusable pieces of main.py for long-running processes.
+
+The VGG weights are loaded once and the compiled loss/gradient functions are
+cached per (image shape, layer set, loss type), with the targets and the loss
+weights fed in at call time.
+"""
+
+THEANO_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg16_weights_th_dim_ordering_th_kernels_notop.h5'
+TF_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5'
+
+TH_19_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg19_weights_th_dim_ordering_th_kernels_notop.h5'
+TF_19_WEIGHTS_PATH_NO_TOP = 'https://github.com/fchollet/deep-learning-models/releases/download/v0.1/vgg19_weights_tf_dim_ordering_tf_kernels_notop.h5'
+
+# (filters, number of convolutions) of each block
+VGG_BLOCKS = {
+    'vgg16': [(64, 2), (128, 2), (256, 3), (512, 3), (512, 3)],
+    'vgg19': [(64, 2), (128, 2), (256, 4), (512, 4), (512, 4)],
+}
+
+FEATURE_LAYERS = ['conv1_1', 'conv2_1', 'conv3_1', 'conv4_1', 'conv5_1']
+
+# settings of a stylization job, named after the arguments of main.py
+DEFAULT_JOB = {
+    'img_size': 400,
+    'content_weight': 0.025,
+    'style_weight': [1.],
+    'style_scale': 1.0,
+    'tv_weight': 8.5e-5,
+    'num_iter': 10,
+    'content_loss_type': 0,
+    'content_layer': 'conv5_2',
+    'init_image': 'content',
+    'blend_styles': False,
+    'evals_per_iter': 20,
+    'float32_optimizer': False,
+    'save_every': 1,
+    'save_threads': 1,
+    'preview_size': None,
+}
+
+
+def get_weights_path(model_name):
+    if K.image_dim_ordering() == "th":
+        if model_name == "vgg19":
+            return get_file('vgg19_weights_th_dim_ordering_th_kernels_notop.h5', TH_19_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
+        return get_file('vgg16_weights_th_dim_ordering_th_kernels_notop.h5', THEANO_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
+    else:
+        if model_name == "vgg19":
+            return get_file('vgg19_weights_tf_dim_ordering_tf_kernels_notop.h5', TF_19_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
+        return get_file('vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5', TF_WEIGHTS_PATH_NO_TOP, cache_subdir='models')
+
+
+def image_shape(img_width, img_height, nb_images=1):
+    if K.image_dim_ordering() == "th":
+        return (nb_images, 3, img_width, img_height)
+    return (nb_images, img_width, img_height, 3)
+
+
+def image_dims(image_path, img_size):
+    '''Width and height main.py resizes `image_path` to.'''
+    img = imread(image_path, mode="RGB")
+    aspect_ratio = float(img.shape[1]) / img.shape[0]
+    return img_size, int(img_size * aspect_ratio), aspect_ratio
+
+
+def array_dims(x):
+    '''Width and height of a preprocessed image batch.'''
+    if K.image_dim_ordering() == "th":
+        return x.shape[2], x.shape[3]
+    return x.shape[1], x.shape[2]
+
+
+# util function to open, resize and format pictures into appropriate tensors
+def preprocess_image(image_path, img_width, img_height):
+    img = imread(image_path, mode="RGB")  # Prevents crashes due to PNG images (ARGB)
+    return preprocess_array(imresize(img, (img_width, img_height)))
+
+
+def preprocess_array(img):
+    '''preprocess_image of an RGB array already at the right size.'''
+    img = img.astype('float32')
+
+    # RGB -> BGR
+    img = img[:, :, ::-1]
+
+    img[:, :, 0] -= 103.939
+    img[:, :, 1] -= 116.779
+    img[:, :, 2] -= 123.68
+
+    if K.image_dim_ordering() == "th":
+        img = img.transpose((2, 0, 1)).astype('float32')
+
+    img = np.expand_dims(img, axis=0)
+    return img
+
+
+# util function to convert a tensor into a valid image
+def deprocess_image(x, img_width, img_height):
+    if K.image_dim_ordering() == "th":
+        x = x.reshape((3, img_width, img_height))
+        x = x.transpose((1, 2, 0))
+    else:
+        x = x.reshape((img_width, img_height, 3))
+
+    x[:, :, 0] += 103.939
+    x[:, :, 1] += 116.779
+    x[:, :, 2] += 123.68
+
+    # BGR -> RGB
+    x = x[:, :, ::-1]
+
+    x = np.clip(x, 0, 255).astype('uint8')
+    return x
+
+
+def resize_image(x, img_width, img_height, new_width, new_height):
+    '''Resize a preprocessed image, e.g. a result to warm start the next size up.'''
+    img = deprocess_image(np.array(x, copy=True), img_width, img_height)
+    return preprocess_array(imresize(img, (new_width, new_height), interp="bicubic"))
+
+
+def pyramid_sizes(img_size, preview_size=None):
+    '''Image sizes from `preview_size` doubling up to `img_size`; just `img_size` without a preview.'''
+    sizes = []
+    size = preview_size
+    while size is not None and size < img_size:
+        sizes.append(size)
+        size *= 2
+    return sizes + [img_size]
+
+
+def split_iterations(num_iter, nb_levels):
+    '''Spread `num_iter` over the levels, the remainder going to the coarsest (cheapest) ones.
+
+    Every level gets at least one iteration.
+    '''
+    return [max(num_iter // nb_levels + (1 if level < num_iter % nb_levels else 0), 1) for level in range(nb_levels)]
+
+
+# the gram matrix of an image tensor (feature-wise outer product)
+def gram_matrix(x):
+    assert K.ndim(x) == 3
+    if K.image_dim_ordering() == "th":
+        features = K.batch_flatten(x)
+    else:
+        features = K.batch_flatten(K.permute_dimensions(x, (2, 0, 1)))
+    gram = K.dot(features, K.transpose(features))
+    return gram
+
+
+# numpy version of gram_matrix, used for the precomputed style targets
+def gram_matrix_value(x):
+    assert x.ndim == 3
+    if K.image_dim_ordering() == "th":
+        features = x.reshape((x.shape[0], -1))
+    else:
+        features = x.reshape((-1, x.shape[-1])).T
+    return features.dot(features.T)
+
+
+def style_loss(style_gram, combination, img_width, img_height):
+    combo_gram = gram_matrix(combination)
+    channels = 3
+    size = img_width * img_height
+    return K.sum(K.square(style_gram - combo_gram)) / (4. * (channels ** 2) * (size ** 2))
+
+
+def content_loss(base, combination, img_width, img_height, content_loss_type=0):
+    channel_dim = 0 if K.image_dim_ordering() == "th" else -1
+
+    channels = K.cast(K.shape(base)[channel_dim], K.floatx())
+    size = img_width * img_height
+
+    if content_loss_type == 1:
+        multiplier = 1 / (2. * K.sqrt(channels) * size ** 0.5)
+    elif content_loss_type == 2:
+        multiplier = 1 / (channels * size)
+    else:
+        multiplier = 1.
+
+    return multiplier * K.sum(K.square(combination - base))
+
+
+def total_variation_loss(x, img_width, img_height):
+    assert K.ndim(x) == 4
+    if K.image_dim_ordering() == 'th':
+        a = K.square(x[:, :, :img_width - 1, :img_height - 1] - x[:, :, 1:, :img_height - 1])
+        b = K.square(x[:, :, :img_width - 1, :img_height - 1] - x[:, :, :img_width - 1, 1:])
+    else:
+        a = K.square(x[:, :img_width - 1, :img_height - 1, :] - x[:, 1:, :img_height - 1, :])
+        b = K.square(x[:, :img_width - 1, :img_height - 1, :] - x[:, :img_width - 1, 1:, :])
+    return K.sum(K.pow(a + b, 1.25))
+
+
+def vgg_layers(model_name='vgg16', pool_type='max', output_layers=None):
+    '''Layers of the convolutional part of VGG, in order.
+
+    With `output_layers`, the list stops at the deepest of them, so nothing
+    after the last layer a loss reads is built or evaluated.
+    '''
+    assert model_name in VGG_BLOCKS, "Model must be one of %s" % sorted(VGG_BLOCKS)
+    assert pool_type in ["ave", "max"], 'Pooling argument is wrong. Needs to be either "ave" or "max".'
+
+    names = []
+    for block_i, (filters, nb_convs) in enumerate(VGG_BLOCKS[model_name]):
+        names += ['conv%d_%d' % (block_i + 1, conv_i + 1) for conv_i in range(nb_convs)]
+        names.append('pool%d' % (block_i + 1))
+
+    if output_layers is not None:
+        missing = set(output_layers) - set(names)
+        assert not missing, "Unknown %s layers: %s" % (model_name, sorted(missing))
+        names = names[:max(names.index(name) for name in output_layers) + 1]
+
+    layers = []
+    for name in names:
+        if name.startswith('pool'):
+            if pool_type == "ave":
+                layers.append(AveragePooling2D((2, 2), strides=(2, 2), name=name))
+            else:
+                layers.append(MaxPooling2D((2, 2), strides=(2, 2), name=name))
+        else:
+            filters = VGG_BLOCKS[model_name][int(name[4]) - 1][0]
+            layers.append(Convolution2D(filters, 3, 3, activation='relu', name=name, border_mode='same'))
+    return layers
+
+
+def _decode(names):
+    return [name.decode('utf8') if isinstance(name, bytes) else name for name in names]
+
+
+def load_vgg_weights(model, model_name='vgg16'):
+    '''Load the pretrained weights of the layers present in `model` only.
+
+    The layers of the weight file are matched to the layers of `model` in
+    order (their names differ), and the datasets of layers that were not
+    built are never read.
+    '''
+    weights = get_weights_path(model_name)
+    print("Weights Path: ", weights)
+
+    weighted_layers = [layer for layer in model.layers if layer.weights]
+    with h5py.File(weights, mode='r') as f:
+        groups = [f[name] for name in _decode(f.attrs['layer_names'])]
+        groups = [g for g in groups if len(g.attrs['weight_names'])]
+        assert len(weighted_layers) <= len(groups), "Model is deeper than the weights in %s" % weights
+
+        for layer, g in zip(weighted_layers, groups):
+            layer.set_weights([g[name][()] for name in _decode(g.attrs['weight_names'])])
+
+    if K.backend() == 'tensorflow' and K.image_dim_ordering() == "th":
+        warnings.warn('You are using the TensorFlow backend, yet you '
+                      'are using the Theano '
+                      'image dimension ordering convention '
+                      '(`image_dim_ordering="th"`). '
+                      'For best performance, set '
+                      '`image_dim_ordering="tf"` in '
+                      'your Keras config '
+                      'at ~/.keras/keras.json.')
+        convert_all_kernels_in_model(model)
+
+
+class VGGFeatures(object):
+    '''The convolutional part of VGG, with its weights loaded once.
+
+    Calling it on an image tensor of any size returns a dict of the outputs
+    of every layer up to the deepest requested one, all sharing the same weights.
+    '''
+    def __init__(self, model_name='vgg16', pool_type='max', output_layers=None):
+        self.model_name = model_name
+        self.pool_type = pool_type
+        self.layers = vgg_layers(model_name, pool_type, output_layers)
+        self.layer_names = [layer.name for layer in self.layers]
+
+        if K.image_dim_ordering() == "th":
+            ip = Input(shape=(3, None, None))
+        else:
+            ip = Input(shape=(None, None, 3))
+
+        x = ip
+        for layer in self.layers:
+            x = layer(x)
+        self.model = Model(ip, x)
+        load_vgg_weights(self.model, model_name)
+
+        print('Model loaded.')
+
+    def __call__(self, image_tensor, batch_shape=None, output_layers=None):
+        if output_layers is None:
+            layers = self.layers
+        else:
+            layers = self.layers[:max(self.layer_names.index(name) for name in output_layers) + 1]
+
+        x = Input(tensor=image_tensor, batch_shape=batch_shape)
+        outputs = {}
+        for layer in layers:
+            x = layer(x)
+            outputs[layer.name] = x
+        return outputs
+
+
+class StyleLossFunction(object):
+    '''Compiled loss and gradients of the gram matrix style transfer objective
+    for one image shape, layer set and content loss type.
+
+    The content target, the style gram matrices and all loss weights are
+    placeholders, so the same function serves every job of that shape.
+
+    With `nb_images` > 1 the combination image is a batch of that many
+    images, each with its own content target and content and TV losses
+    against the shared style targets. The function then returns the vector
+    of per-image losses, and the gradients of their sum, i.e. of every image
+    against its own loss, from one forward and backward pass.
+    '''
+    def __init__(self, features, img_width, img_height, content_layer=DEFAULT_JOB['content_layer'],
+                 feature_layers=FEATURE_LAYERS, content_loss_type=0, nb_style_images=1, nb_images=1):
+        self.img_width = img_width
+        self.img_height = img_height
+        self.feature_layers = list(feature_layers)
+        self.nb_style_images = nb_style_images
+        self.nb_images = nb_images
+
+        shape = image_shape(img_width, img_height, nb_images)
+        self.combination_image = K.placeholder(shape)
+        output_layers = [content_layer] + self.feature_layers
+        outputs = features(self.combination_image, batch_shape=shape, output_layers=output_layers)
+
+        # the targets are computed one style image (or a batch of content images) at a time
+        target_shape = (None,) + shape[1:]
+        self.target_image = K.placeholder(target_shape)
+        target_outputs = features(self.target_image, batch_shape=target_shape, output_layers=output_layers)
+        self.content_fn = K.function([self.target_image], [target_outputs[content_layer]])
+        self.style_fn = K.function([self.target_image],
+                                   [target_outputs[layer_name] for layer_name in self.feature_layers])
+
+        self.content_target = K.placeholder(ndim=3 if nb_images == 1 else 4)
+        self.style_targets = [[K.placeholder(ndim=2) for _ in range(nb_style_images)] for _ in self.feature_layers]
+        self.content_weight = K.placeholder(shape=())
+        self.style_weights = [K.placeholder(shape=()) for _ in range(nb_style_images)]
+        self.tv_weight = K.placeholder(shape=())
+
+        losses = []
+        for k in range(nb_images):
+            content_target = self.content_target if nb_images == 1 else self.content_target[k]
+            combination_features = outputs[content_layer][k, :, :, :]
+            loss = self.content_weight * content_loss(content_target, combination_features,
+                                                      img_width, img_height, content_loss_type)
+
+            for layer_name, layer_targets in zip(self.feature_layers, self.style_targets):
+                combination_features = outputs[layer_name][k, :, :, :]
+                for j in range(nb_style_images):
+                    sl = style_loss(layer_targets[j], combination_features, img_width, img_height)
+                    loss += (self.style_weights[j] / len(self.feature_layers)) * sl
+
+            loss += self.tv_weight * total_variation_loss(self.combination_image[k:k + 1], img_width, img_height)
+            losses.append(loss)
+
+        if nb_images == 1:
+            loss = losses[0]
+            grads = K.gradients(loss, self.combination_image)
+        else:
+            loss = K.concatenate([K.reshape(image_loss, (1,)) for image_loss in losses])
+            grads = K.gradients(K.sum(loss), self.combination_image)
+
+        outputs = [loss]
+        if type(grads) in {list, tuple}:
+            outputs += grads
+        else:
+            outputs.append(grads)
+
+        inputs = [self.combination_image, self.content_target]
+        for layer_targets in self.style_targets:
+            inputs += layer_targets
+        inputs += [self.content_weight] + self.style_weights + [self.tv_weight]
+
+        self.f_outputs = K.function(inputs, outputs)
+
+    def content_features(self, image):
+        return self.content_fn([image])[0][0]
+
+    def batch_content_features(self, images):
+        '''Content targets of a batch of `nb_images` images, in the order of the batch.'''
+        return self.content_fn([images])[0]
+
+    def style_grams(self, image):
+        return [gram_matrix_value(style_features[0]) for style_features in self.style_fn([image])]
+
+    def target_inputs(self, content_target, style_targets, content_weight, style_weights, tv_weight):
+        '''Inputs of `f_outputs` after the image, in order.
+
+        `style_targets` is indexed [layer][style image] like `feature_layers`.
+        '''
+        inputs = [content_target]
+        for layer_targets in style_targets:
+            inputs += list(layer_targets)
+        inputs += [content_weight] + list(style_weights) + [tv_weight]
+        return inputs
+
+    def evaluator(self, content_target, style_targets, content_weight, style_weights, tv_weight, dtype='float64'):
+        '''BufferedEvaluator of the loss against these targets and weights.
+
+        With `nb_images` > 1 it is a BatchEvaluator, whose `evaluator(i)` is
+        the Evaluator of image i.
+        '''
+        extra_inputs = self.target_inputs(content_target, style_targets, content_weight, style_weights, tv_weight)
+        shape = image_shape(self.img_width, self.img_height, self.nb_images)
+        if self.nb_images > 1:
+            return BatchEvaluator(self.f_outputs, shape, dtype=dtype, extra_inputs=extra_inputs)
+        return BufferedEvaluator(self.f_outputs, shape, dtype=dtype, extra_inputs=extra_inputs)
+
+    def __call__(self, x, content_target, style_targets, content_weight, style_weights, tv_weight):
+        '''Loss and flattened float64 gradients at `x`.'''
+        inputs = [x.reshape(image_shape(self.img_width, self.img_height, self.nb_images))]
+        inputs += self.target_inputs(content_target, style_targets, content_weight, style_weights, tv_weight)
+
+        outs = self.f_outputs(inputs)
+        return outs[0], outs[1].flatten().astype('float64')
+
+
+def style_weights_for(job):
+    '''Per style image weights, spread evenly when their count does not match.'''
+    nb_style_images = len(job['style_image_paths'])
+    if nb_style_images != len(job['style_weight']):
+        weight_sum = sum(job['style_weight']) * job['style_scale']
+        return [weight_sum / nb_style_images for _ in range(nb_style_images)]
+    return [weight * job['style_scale'] for weight in job['style_weight']]
+
+
+def blend_style_targets(style_targets, style_weights):
+    '''Collapse the gram matrices of several styles into their weighted mean.
+
+    sum_j w_j |G - G_j|^2 = W |G - sum_j w_j G_j / W|^2 + const with W = sum_j w_j,
+    so the returned single style per layer, weighted by W, has the same gradients.
+    '''
+    style_weight_sum = sum(style_weights)
+    blended = []
+    for layer_targets in style_targets:
+        mean_gram = sum(weight * gram for weight, gram in zip(style_weights, layer_targets))
+        blended.append([mean_gram / style_weight_sum])
+    return blended, [style_weight_sum]
+
+
+def initial_image(init_image, base_image, img_width, img_height):
+    '''Starting point of the optimization: "content", "gray", "noise" or an image path.'''
+    if "content" in init_image or "gray" in init_image:
+        return base_image.copy()
+    elif "noise" in init_image:
+        x = np.random.uniform(0, 255, (1, img_width, img_height, 3)) - 128.
+
+        if K.image_dim_ordering() == "th":
+            x = x.transpose((0, 3, 1, 2))
+        return x
+    else:
+        print("Using initial image : ", init_image)
+        return preprocess_image(init_image, img_width, img_height)
+
+
+class Stylizer(object):
+    '''Runs stylization jobs back to back with one set of VGG weights.
+
+    A job is a dict with `base_image_path`, `style_image_paths` and
+    `result_prefix`, plus any of the settings in DEFAULT_JOB.
+    '''
+    def __init__(self, model_name='vgg16', pool_type='max', gram_cache_dir=None, gram_cache_size=1024):
+        self.features = VGGFeatures(model_name, pool_type)
+        self.loss_functions = {}
+        self._last_style_targets = (None, None)  # jobs in a row (e.g. a sweep) often share their styles
+
+        self.gram_cache = None
+        if gram_cache_dir is not None:
+            self.gram_cache = GramCache(gram_cache_dir, gram_cache_size * 1024 ** 2)
+
+    def loss_function(self, img_width, img_height, content_layer, feature_layers, content_loss_type,
+                      nb_style_images, nb_images=1):
+        key = (img_width, img_height, content_layer, tuple(feature_layers), content_loss_type, nb_style_images,
+               nb_images)
+        if key not in self.loss_functions:
+            start_time = time.time()
+            self.loss_functions[key] = StyleLossFunction(self.features, img_width, img_height, content_layer,
+                                                         feature_layers, content_loss_type, nb_style_images,
+                                                         nb_images)
+            print('Compiled loss function for %s in %0.2fs' % (str(key), time.time() - start_time))
+        return self.loss_functions[key]
+
+    def style_targets(self, f, style_image_paths):
+        '''Gram matrices indexed [layer][style image], read from the gram cache when possible.'''
+        # keyed by the style image bytes, so a style rewritten at the same path is not served stale
+        key = (f.img_width, f.img_height, tuple(f.feature_layers),
+               tuple(file_digest(path) for path in style_image_paths))
+        if self._last_style_targets[0] == key:
+            return self._last_style_targets[1]
+
+        targets = [[] for _ in f.feature_layers]
+        for style_path in style_image_paths:
+            grams = None
+            if self.gram_cache is not None:
+                cache_keys = [self.gram_cache.key(style_path, layer_name, size=(f.img_width, f.img_height),
+                                                  model=self.features.model_name, pool=self.features.pool_type,
+                                                  dim_ordering=K.image_dim_ordering())
+                              for layer_name in f.feature_layers]
+                grams = [self.gram_cache.get(key) for key in cache_keys]
+                if any(gram is None for gram in grams):
+                    grams = None
+
+            if grams is None:
+                grams = f.style_grams(preprocess_image(style_path, f.img_width, f.img_height))
+                if self.gram_cache is not None:
+                    for key, gram in zip(cache_keys, grams):
+                        self.gram_cache.put(key, gram)
+
+            for layer_targets, gram in zip(targets, grams):
+                layer_targets.append(gram)
+
+        self._last_style_targets = (key, targets)
+        return targets
+
+    def stylize(self, job):
+        '''Run one job and return the paths of the images it saved.'''
+        return self.run(job)['images']
+
+    def optimize(self, job, base_image, x=None, callback=None):
+        '''Stylize the preprocessed `base_image` (its size is the size of the result).
+
+        The optimization starts from `x`, or from the job's init_image if it
+        is None, and `callback(x, loss, i)` is called after every iteration.
+        Returns the best image, its loss and the number of evaluations.
+        '''
+        settings = dict(DEFAULT_JOB)
+        settings.update(job)
+        job = settings
+
+        img_width, img_height = array_dims(base_image)
+        style_weights = style_weights_for(job)
+        nb_style_images = 1 if job['blend_styles'] else len(style_weights)
+
+        f = self.loss_function(img_width, img_height, job['content_layer'], FEATURE_LAYERS,
+                               job['content_loss_type'], nb_style_images)
+
+        content_target = f.content_features(base_image)
+        style_targets = self.style_targets(f, job['style_image_paths'])
+        if job['blend_styles']:
+            style_targets, style_weights = blend_style_targets(style_targets, style_weights)
+
+        dtype = 'float32' if job['float32_optimizer'] else 'float64'
+        evaluator = f.evaluator(content_target, style_targets, job['content_weight'], style_weights,
+                                job['tv_weight'], dtype=dtype)
+
+        if x is None:
+            x = initial_image(job['init_image'], base_image, img_width, img_height)
+
+        driver = LBFGSDriver(evaluator.loss, evaluator.grads, job['num_iter'] * job['evals_per_iter'],
+                             save_every=job['evals_per_iter'], dtype=dtype)
+        return driver.run(x, callback=callback)
+
+    def run(self, job):
+        '''Run one job; returns the saved `images`, the `final_image`, the final `loss`, `nb_evals` and `seconds`.
+
+        `final_image` is the path of the final image, or None if it or any
+        other image of the job failed to save.
+
+        With a `preview_size`, the job is first solved at that size and the
+        result saved at once as <result_prefix>_preview_<size>.png, then
+        upsampled as the starting point of the next size up, doubling until
+        `img_size`; `num_iter` is shared between the sizes.
+        '''
+        start_time = time.time()
+        settings = dict(DEFAULT_JOB)
+        settings.update(job)
+        job = settings
+
+        saved_paths = []
+        sizes = pyramid_sizes(job['img_size'], job['preview_size'])
+        iterations = split_iterations(job['num_iter'], len(sizes))
+        timer = {'start': time.time(), 'iteration': 0}
+
+        x = None
+        total_evals = 0
+        nb_failed = 0
+        final_image = None
+        for level, (size, num_iter) in enumerate(zip(sizes, iterations)):
+            img_width, img_height, aspect_ratio = image_dims(job['base_image_path'], size)
+            base_image = preprocess_image(job['base_image_path'], img_width, img_height)
+            if x is not None:
+                x = resize_image(x, prev_width, prev_height, img_width, img_height)
+            final_level = level == len(sizes) - 1
+
+            def save_image(x, i):
+                img = deprocess_image(x, img_width, img_height)
+                img = imresize(img, (img_width, int(img_width * aspect_ratio)), interp="bilinear")
+
+                if final_level:
+                    fname = job['result_prefix'] + '_at_iteration_%d.png' % i
+                else:
+                    fname = job['result_prefix'] + '_preview_%d.png' % img_width
+                imsave(fname, img)
+                saved_paths.append(fname)
+                print('Image saved as', fname)
+
+            writer = AsyncImageWriter(save_image, nb_threads=job['save_threads'] if final_level else 0)
+
+            def save_iteration(x, min_val, i):
+                print('Current loss value:', min_val)
+                if final_level and job['save_every'] > 0 and i % job['save_every'] == 0:
+                    writer.submit(x, i)
+
+                end_time = time.time()
+                print('Iteration %d completed in %ds' % (i, end_time - timer['start']))
+                timer['start'] = end_time
+                timer['iteration'] = i
+
+            timer['iteration'] = 0
+            x, min_val, nb_evals = self.optimize(dict(job, num_iter=num_iter), base_image, x,
+                                                 callback=save_iteration)
+            total_evals += nb_evals
+            prev_width, prev_height = img_width, img_height
+
+            i = timer['iteration']
+            if not final_level or job['save_every'] <= 0 or i % job['save_every'] != 0:
+                writer.submit(x, i)  # the preview, or the final image
+            writer.close()
+            nb_failed += writer.nb_failed
+            if final_level:
+                final_image = job['result_prefix'] + '_at_iteration_%d.png' % i
+
+        return {'images': saved_paths, 'final_image': final_image if nb_failed == 0 else None, 'loss': min_val,
+                'nb_evals': total_evals, 'seconds': time.time() - start_time}
+
+    def stylize_batch(self, job, base_image_paths, result_prefixes):
+        '''Stylize several content images of the same size in one batched graph.
+
+        `job` holds the style images and settings shared by every image;
+        `base_image_paths` and `result_prefixes` take the place of its
+        `base_image_path` and `result_prefix`. Each image runs its own L-BFGS
+        (and stops on its own) on a thread, and BatchEvaluator gathers their
+        evaluations into one backend call. Returns the paths of the saved
+        images, per content image.
+        '''
+        settings = dict(DEFAULT_JOB)
+        settings.update(job)
+        job = settings
+
+        nb_images = len(base_image_paths)
+        assert nb_images == len(result_prefixes), "Every content image needs a result prefix"
+        dims = [image_dims(path, job['img_size']) for path in base_image_paths]
+        img_width, img_height, _ = dims[0]
+        assert all(d[:2] == (img_width, img_height) for d in dims), \
+            "The images of a batch must have the same size; group them by image_dims first"
+
+        style_weights = style_weights_for(job)
+        nb_style_images = 1 if job['blend_styles'] else len(style_weights)
+
+        f = self.loss_function(img_width, img_height, job['content_layer'], FEATURE_LAYERS,
+                               job['content_loss_type'], nb_style_images, nb_images)
+
+        base_images = np.concatenate([preprocess_image(path, img_width, img_height) for path in base_image_paths])
+        content_targets = f.batch_content_features(base_images)
+        style_targets = self.style_targets(f, job['style_image_paths'])
+        if job['blend_styles']:
+            style_targets, style_weights = blend_style_targets(style_targets, style_weights)
+
+        dtype = 'float32' if job['float32_optimizer'] else 'float64'
+        evaluator = f.evaluator(content_targets, style_targets, job['content_weight'], style_weights,
+                                job['tv_weight'], dtype=dtype)
+
+        saved_paths = [[] for _ in range(nb_images)]
+
+        def save_image(x, key):
+            k, i = key
+            img = deprocess_image(x, img_width, img_height)
+            img = imresize(img, (img_width, int(img_width * dims[k][2])), interp="bilinear")
+
+            fname = result_prefixes[k] + '_at_iteration_%d.png' % i
+            imsave(fname, img)
+            saved_paths[k].append(fname)
+            print('Image saved as', fname)
+
+        writer = AsyncImageWriter(save_image, nb_threads=job['save_threads'])
+        errors = []
+
+        def optimize(k):
+            def save_iteration(x, min_val, i):
+                print('Image %d: loss %s at iteration %d' % (k, min_val, i))
+                if job['save_every'] > 0 and i % job['save_every'] == 0:
+                    writer.submit(x, (k, i))
+
+            try:
+                driver = LBFGSDriver(evaluator(k).loss, evaluator(k).grads, job['num_iter'] * job['evals_per_iter'],
+                                     save_every=job['evals_per_iter'], dtype=dtype)
+                x = initial_image(job['init_image'], base_images[k:k + 1], img_width, img_height)
+                x, _, _ = driver.run(x, callback=save_iteration)
+                if job['save_every'] <= 0 or driver.nb_checkpoints % job['save_every'] != 0:
+                    writer.submit(x, (k, driver.nb_checkpoints))  # the final image
+            except Exception as e:
+                errors.append(e)
+            finally:
+                evaluator.finish(k)
+
+        start_time = time.time()
+        threads = [threading.Thread(target=optimize, args=(k,)) for k in range(nb_images)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+
+        if errors:
+            raise errors[0]
+        print('Stylized %d images in %ds with %d batched evaluations' % (nb_images, time.time() - start_time,
+                                                                        evaluator.nb_calls))
+        return saved_paths
@@ -0,0 +1,166 @@
+import argparse
+import glob
+import json
+import os
+import socket
+import time
+import traceback
+
+from result_cache import ResultCache
+from style_engine import DEFAULT_JOB, Stylizer
+
+"""
+Resident stylization worker.
+
+Loads the VGG weights once and keeps the compiled loss functions around, then
+serves jobs back to back, either from a spool directory or a UNIX socket.
+
+A job is a JSON object with the names of main.py's arguments, e.g.
+    {"base_image_path": "content_images/dog.jpg",
+     "style_image_paths": ["style_images/waves.jpg"],
+     "result_prefix": "output_images/waves_dog",
+     "num_iter": 10}
+
+With "preview_size": 128 in a job, the image is solved at 128 px first and
+saved as <result_prefix>_preview_128.png within seconds, then refined at
+twice the size, warm started from the upsampled preview, up to image_size.
+
+Spool directory: drop `<name>.json` files in the directory. The worker renames
+a job to `<name>.json.running` while it works on it and writes the result to
+`<name>.json.done` (or the traceback to `<name>.json.failed`).
+
+UNIX socket: send one job per connection as a single line of JSON; the worker
+replies with one line of JSON containing either "images" or "error".
+
+With --result_cache_dir, a job identical to an earlier one (same image bytes
+and settings) gets the cached final image copied to its result prefix, and
+"cached": true in its result, without running the optimizer.
+"""
+
+parser = argparse.ArgumentParser(description='Resident neural style transfer worker.')
+parser.add_argument("--spool_dir", type=str, default=None,
+                    help="Directory polled for .json job files")
+
+parser.add_argument("--socket", dest="socket_path", type=str, default=None,
+                    help="Path of a UNIX socket to accept jobs on")
+
+parser.add_argument("--poll_interval", type=float, default=1.0,
+                    help="Seconds between scans of the spool directory")
+
+parser.add_argument("--model", default="vgg16", type=str,
+                    help="Choices are 'vgg16' and 'vgg19'")
+
+parser.add_argument("--pool_type", dest="pool", default="max", type=str,
+                    help='Pooling type. Can be "ave" for average pooling or "max" for max pooling')
+
+parser.add_argument("--gram_cache_dir", dest="gram_cache_dir", default=None, type=str,
+                    help="Directory of the on-disk cache of style gram matrices (disabled if not set)")
+
+parser.add_argument("--gram_cache_size", dest="gram_cache_size", default=1024, type=int,
+                    help="Maximum size of the style gram matrix cache in MB")
+
+parser.add_argument("--result_cache_dir", dest="result_cache_dir", default=None, type=str,
+                    help="Directory of the on-disk cache of final images (disabled if not set)")
+
+parser.add_argument("--result_cache_size", dest="result_cache_size", default=4096, type=int,
+                    help="Maximum size of the result cache in MB")
+
+
+def run_job(stylizer, job, result_cache=None):
+    start_time = time.time()
+    try:
+        if result_cache is not None:
+            # the defaults are part of the key, so that leaving a setting out or spelling it out is the same job
+            config = dict(DEFAULT_JOB, model=stylizer.features.model_name, pool=stylizer.features.pool_type)
+            config.update(job)
+            key = result_cache.key(config, 'stylize_worker')
+            cached_path = result_cache.restore(key, job['result_prefix'])
+            if cached_path is not None:
+                return {'images': [cached_path], 'seconds': time.time() - start_time, 'cached': True}
+
+        result = stylizer.run(job)
+        if result_cache is not None and result['final_image'] is not None:
+            # only once every image of the job was written
+            result_cache.import_result(key, result['final_image'], config['num_iter'])
+    except Exception:
+        return {'error': traceback.format_exc()}
+    return {'images': result['images'], 'seconds': time.time() - start_time}
+
+
+def serve_spool(stylizer, spool_dir, poll_interval, result_cache=None):
+    print('Watching spool directory', spool_dir)
+    while True:
+        job_paths = sorted(glob.glob(os.path.join(spool_dir, '*.json')))
+        if not job_paths:
+            time.sleep(poll_interval)
+            continue
+
+        for job_path in job_paths:
+            running_path = job_path + '.running'
+            try:
+                os.rename(job_path, running_path)  # claim the job
+            except OSError:
+                continue  # taken by another worker
+
+            try:
+                with open(running_path) as f:
+                    job = json.load(f)
+            except ValueError:
+                result = {'error': traceback.format_exc()}
+            else:
+                result = run_job(stylizer, job, result_cache)
+
+            suffix = '.failed' if 'error' in result else '.done'
+            with open(job_path + suffix, 'w') as f:
+                json.dump(result, f)
+            os.remove(running_path)
+            print('Job %s%s' % (os.path.basename(job_path), suffix))
+
+
+def serve_socket(stylizer, socket_path, result_cache=None):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(8)
+    print('Listening on', socket_path)
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            stream = conn.makefile('rw')
+            try:
+                line = stream.readline()
+                try:
+                    job = json.loads(line)
+                except ValueError:
+                    result = {'error': traceback.format_exc()}
+                else:
+                    result = run_job(stylizer, job, result_cache)
+                stream.write(json.dumps(result) + '\n')
+                stream.flush()
+            except socket.error:
+                traceback.print_exc()
+            finally:
+                stream.close()
+                conn.close()
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    assert (args.spool_dir is None) != (args.socket_path is None), "Give exactly one of --spool_dir and --socket"
+
+    stylizer = Stylizer(args.model, args.pool, args.gram_cache_dir, args.gram_cache_size)
+
+    result_cache = None
+    if args.result_cache_dir is not None:
+        result_cache = ResultCache(args.result_cache_dir, args.result_cache_size * 1024 ** 2)
+
+    if args.spool_dir is not None:
+        serve_spool(stylizer, args.spool_dir, args.poll_interval, result_cache)
+    else:
+        serve_socket(stylizer, args.socket_path, result_cache)
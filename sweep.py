@@ -0,0 +1,209 @@
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import time
+
+from scipy.misc import imread, imresize, imsave
+import numpy as np
+
+"""
+Hyperparameter sweep over the loss weights of main.py.
+
+Every combination of --content_weight, --style_weight, --tv_weight and
+--style_scale values is run as one job of style_engine.Stylizer, whose
+compiled loss takes all the weights as inputs: VGG, its weights, the loss
+function and the style targets are built once (per process) and reused by
+every setting of the grid.
+
+    python sweep.py content_images/dog.jpg style_images/waves.jpg sweeps/waves_dog \
+        --content_weight 0.01 0.025 0.1 --tv_weight 1e-5 8.5e-5 --processes 2
+
+writes every result image to sweeps/waves_dog/, a contact sheet of the final
+images in grid order (contact_sheet.png) and a metrics table (metrics.csv).
+"""
+
+parser = argparse.ArgumentParser(description='Hyperparameter sweep of neural style transfer.')
+parser.add_argument('base_image_path', metavar='base', type=str,
+                    help='Path to the image to transform.')
+
+parser.add_argument('style_image_paths', metavar='ref', nargs='+', type=str,
+                    help='Path to the style reference image.')
+
+parser.add_argument('output_dir', type=str,
+                    help='Directory of the results, the contact sheet and the metrics table.')
+
+parser.add_argument("--content_weight", nargs='+', default=[0.025], type=float,
+                    help="Content weights to try")
+
+parser.add_argument("--style_weight", nargs='+', default=[1.], type=float,
+                    help="Style weights to try (one weight shared by every style image)")
+
+parser.add_argument("--tv_weight", nargs='+', default=[8.5e-5], type=float,
+                    help="Total variation weights to try")
+
+parser.add_argument("--style_scale", nargs='+', default=[1.0], type=float,
+                    help="Style scales to try")
+
+parser.add_argument("--image_size", dest="img_size", default=400, type=int,
+                    help='Output Image size')
+
+parser.add_argument("--num_iter", dest="num_iter", default=10, type=int,
+                    help="Number of iterations of every setting")
+
+parser.add_argument("--content_loss_type", default=0, type=int,
+                    help='Can be one of 0, 1 or 2. Readme contains the required information of each mode.')
+
+parser.add_argument("--content_layer", dest="content_layer", default="conv5_2", type=str,
+                    help="Optional 'conv4_2'")
+
+parser.add_argument("--init_image", dest="init_image", default="content", type=str,
+                    help="Initial image used to generate the final image. Options are 'content', 'noise', or 'gray'")
+
+parser.add_argument("--float32_optimizer", dest="float32_optimizer", default="False", type=str,
+                    help="Run L-BFGS in float32 instead of scipy's float64 L-BFGS-B")
+
+parser.add_argument("--model", default="vgg16", type=str,
+                    help="Choices are 'vgg16' and 'vgg19'")
+
+parser.add_argument("--pool_type", dest="pool", default="max", type=str,
+                    help='Pooling type. Can be "ave" for average pooling or "max" for max pooling')
+
+parser.add_argument("--processes", default=1, type=int,
+                    help="Worker processes, each with its own model (1 runs the grid sequentially in this process)")
+
+parser.add_argument("--gram_cache_dir", dest="gram_cache_dir", default=None, type=str,
+                    help="Directory of the on-disk cache of style gram matrices, shared by the workers")
+
+parser.add_argument("--thumbnail_size", default=200, type=int,
+                    help="Width of the images of the contact sheet")
+
+
+def str_to_bool(v):
+    return v.lower() in ("true", "yes", "t", "1")
+
+
+def grid(args):
+    '''Settings of the sweep, the last parameter varying fastest.'''
+    names = ['content_weight', 'style_weight', 'tv_weight', 'style_scale']
+    values = [args.content_weight, args.style_weight, args.tv_weight, args.style_scale]
+    return [dict(zip(names, setting)) for setting in itertools.product(*values)]
+
+
+def sweep_jobs(args):
+    base_job = {
+        'base_image_path': args.base_image_path,
+        'style_image_paths': args.style_image_paths,
+        'img_size': args.img_size,
+        'num_iter': args.num_iter,
+        'content_loss_type': args.content_loss_type,
+        'content_layer': args.content_layer,
+        'init_image': args.init_image,
+        'float32_optimizer': str_to_bool(args.float32_optimizer),
+        'save_every': 0,  # the final image only
+    }
+
+    jobs = []
+    for n, setting in enumerate(grid(args)):
+        job = dict(base_job, **setting)
+        job['style_weight'] = [setting['style_weight']]
+        job['result_prefix'] = os.path.join(args.output_dir, 'setting_%03d' % n)
+        jobs.append((n, setting, job))
+    return jobs
+
+
+# one Stylizer per worker process, built by the pool initializer
+_stylizer = None
+
+
+def _init_worker(model_name, pool_type, gram_cache_dir):
+    global _stylizer
+    from style_engine import Stylizer
+    _stylizer = Stylizer(model_name, pool_type, gram_cache_dir)
+
+
+def _run(item):
+    n, setting, job = item
+    result = _stylizer.run(job)
+    return dict(setting, setting=n, loss=float(result['loss']), nb_evals=result['nb_evals'],
+                seconds=result['seconds'], image=result['final_image'])
+
+
+def contact_sheet(image_paths, thumbnail_width, nb_columns):
+    '''The images side by side in rows of `nb_columns`, resized to `thumbnail_width`.
+
+    A None path (an image that failed to save) leaves its cell blank.
+    '''
+    thumbnails = []
+    for path in image_paths:
+        if path is None:
+            thumbnails.append(None)
+            continue
+        img = imread(path, mode="RGB")
+        height = int(round(img.shape[0] * thumbnail_width / float(img.shape[1])))
+        thumbnails.append(imresize(img, (height, thumbnail_width)))
+
+    cell_height = max([thumbnail.shape[0] for thumbnail in thumbnails if thumbnail is not None] or [1])
+    nb_rows = (len(thumbnails) + nb_columns - 1) // nb_columns
+    sheet = np.full((nb_rows * cell_height, nb_columns * thumbnail_width, 3), 255, dtype='uint8')
+    for n, thumbnail in enumerate(thumbnails):
+        if thumbnail is None:
+            continue
+        row, column = divmod(n, nb_columns)
+        top, left = row * cell_height, column * thumbnail_width
+        sheet[top:top + thumbnail.shape[0], left:left + thumbnail_width] = thumbnail
+    return sheet
+
+
+def write_metrics(path, results):
+    columns = ['setting', 'content_weight', 'style_weight', 'tv_weight', 'style_scale',
+               'loss', 'nb_evals', 'seconds', 'image']
+    with open(path, 'w') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+    print("\n%7s %14s %12s %12s %11s %14s %8s %8s" % ("setting", "content_weight", "style_weight", "tv_weight",
+                                                      "style_scale", "loss", "evals", "seconds"))
+    for result in results:
+        print("%7d %14g %12g %12g %11g %14.6g %8d %8.1f" % (
+            result['setting'], result['content_weight'], result['style_weight'], result['tv_weight'],
+            result['style_scale'], result['loss'], result['nb_evals'], result['seconds']))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    jobs = sweep_jobs(args)
+    print('Sweeping %d settings' % len(jobs))
+    start_time = time.time()
+
+    if args.processes > 1:
+        # spawned workers, so that no backend session is shared through fork
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(args.processes, _init_worker, (args.model, args.pool, args.gram_cache_dir))
+        try:
+            results = pool.map(_run, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(args.model, args.pool, args.gram_cache_dir)
+        results = [_run(job) for job in jobs]
+
+    print('Swept %d settings in %ds' % (len(results), time.time() - start_time))
+
+    # one column per value of the fastest varying parameter that has several
+    swept = [values for values in (args.content_weight, args.style_weight, args.tv_weight, args.style_scale)
+             if len(values) > 1]
+    nb_columns = len(swept[-1]) if swept else 1
+    sheet_path = os.path.join(args.output_dir, 'contact_sheet.png')
+    imsave(sheet_path, contact_sheet([result['image'] for result in results], args.thumbnail_size, nb_columns))
+    print('Contact sheet saved as', sheet_path)
+
+    write_metrics(os.path.join(args.output_dir, 'metrics.csv'), results)
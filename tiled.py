@@ -0,0 +1,203 @@
+import argparse
+import multiprocessing
+import os
+import time
+
+from scipy.misc import imsave
+import numpy as np
+
+"""
+Tiled high resolution style transfer.
+
+main.py holds the VGG activations of the whole image at once, which does not
+fit in memory past about 1000 px. Here the content image is cut into
+overlapping tiles of --tile_size px, every tile is stylized on its own by a
+worker process and the tiles are blended back with linear feathering across
+their overlaps. The style targets are the gram matrices of the whole style
+image (resized to the tile size), so every tile is pulled towards the same
+statistics. All tiles have the same size, so each worker compiles the loss
+function once, and its memory is bounded by the tile size whatever the size
+of the output.
+
+    python tiled.py content_images/dog.jpg style_images/waves.jpg output_images/dog_2k \
+        --image_size 2048 --tile_size 512 --overlap 64 --processes 2
+"""
+
+parser = argparse.ArgumentParser(description='Tiled high resolution neural style transfer.')
+parser.add_argument('base_image_path', metavar='base', type=str,
+                    help='Path to the image to transform.')
+
+parser.add_argument('style_image_paths', metavar='ref', nargs='+', type=str,
+                    help='Path to the style reference image.')
+
+parser.add_argument('result_prefix', metavar='res_prefix', type=str,
+                    help='Prefix for the saved results.')
+
+parser.add_argument("--image_size", dest="img_size", default=2048, type=int,
+                    help='Output Image size')
+
+parser.add_argument("--tile_size", default=512, type=int,
+                    help='Width and height of the tiles')
+
+parser.add_argument("--overlap", default=64, type=int,
+                    help='Minimum overlap of neighbouring tiles in px, blended across')
+
+parser.add_argument("--processes", default=1, type=int,
+                    help="Worker processes, each with its own model (1 stylizes the tiles in this process)")
+
+parser.add_argument("--content_weight", dest="content_weight", default=0.025, type=float,
+                    help="Weight of content")
+
+parser.add_argument("--style_weight", dest="style_weight", nargs='+', default=[1], type=float,
+                    help="Weight of style, can be multiple for multiple styles")
+
+parser.add_argument("--total_variation_weight", dest="tv_weight", default=8.5e-5, type=float,
+                    help="Total Variation in the Weights")
+
+parser.add_argument("--style_scale", dest="style_scale", default=1.0, type=float,
+                    help="Scale the weightage of the style")
+
+parser.add_argument("--num_iter", dest="num_iter", default=10, type=int,
+                    help="Number of iterations of every tile")
+
+parser.add_argument("--content_loss_type", default=0, type=int,
+                    help='Can be one of 0, 1 or 2. Readme contains the required information of each mode.')
+
+parser.add_argument("--content_layer", dest="content_layer", default="conv5_2", type=str,
+                    help="Optional 'conv4_2'")
+
+parser.add_argument("--init_image", dest="init_image", default="content", type=str,
+                    help="Initial image of every tile. Options are 'content', 'noise', or 'gray'")
+
+parser.add_argument("--float32_optimizer", dest="float32_optimizer", default="False", type=str,
+                    help="Run L-BFGS in float32 instead of scipy's float64 L-BFGS-B")
+
+parser.add_argument("--model", default="vgg16", type=str,
+                    help="Choices are 'vgg16' and 'vgg19'")
+
+parser.add_argument("--pool_type", dest="pool", default="max", type=str,
+                    help='Pooling type. Can be "ave" for average pooling or "max" for max pooling')
+
+parser.add_argument("--gram_cache_dir", dest="gram_cache_dir", default=None, type=str,
+                    help="Directory of the on-disk cache of style gram matrices, shared by the workers")
+
+
+def str_to_bool(v):
+    return v.lower() in ("true", "yes", "t", "1")
+
+
+def tile_starts(length, tile, overlap):
+    '''Offsets of tiles of size `tile` covering [0, length) with at least `overlap` in common.'''
+    if length <= tile:
+        return [0]
+    step = max(tile - overlap, 1)
+    starts = list(range(0, length - tile, step))
+    return starts + [length - tile]  # the last tile is flush with the edge, so every tile has the same size
+
+
+def feather(length, start, size, overlap):
+    '''Blending weights along one axis of a tile: ramps over the overlaps with its neighbours.'''
+    weights = np.ones(size, dtype='float32')
+    ramp = (np.arange(overlap, dtype='float32') + 1) / (overlap + 1)
+    if overlap > 0 and start > 0:
+        weights[:overlap] = ramp
+    if overlap > 0 and start + size < length:
+        weights[-overlap:] = np.minimum(weights[-overlap:], ramp[::-1])
+    return weights
+
+
+def channels_last(x):
+    from keras import backend as K
+    return x.transpose((0, 2, 3, 1)) if K.image_dim_ordering() == "th" else x
+
+
+def backend_layout(x):
+    from keras import backend as K
+    return x.transpose((0, 3, 1, 2)) if K.image_dim_ordering() == "th" else x
+
+
+# one Stylizer per worker process, built by the pool initializer
+_stylizer = None
+_job = None
+
+
+def _init_worker(model_name, pool_type, gram_cache_dir, job):
+    global _stylizer, _job
+    from style_engine import Stylizer
+    _stylizer = Stylizer(model_name, pool_type, gram_cache_dir)
+    _job = job
+
+
+def _stylize_tile(item):
+    n, top, left, tile = item
+    start_time = time.time()
+    x, loss, nb_evals = _stylizer.optimize(_job, backend_layout(tile))
+    x = channels_last(x.reshape(backend_layout(tile).shape)).astype('float32')
+    return n, top, left, x, float(loss), time.time() - start_time
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    assert args.tile_size > 2 * args.overlap, "Tiles must be larger than twice the overlap"
+
+    from style_engine import image_dims, preprocess_image, deprocess_image
+
+    img_width, img_height, _ = image_dims(args.base_image_path, args.img_size)
+    content = channels_last(preprocess_image(args.base_image_path, img_width, img_height))[0]
+
+    tile_width, tile_height = min(args.tile_size, img_width), min(args.tile_size, img_height)
+    tiles = []
+    for top in tile_starts(img_width, tile_width, args.overlap):
+        for left in tile_starts(img_height, tile_height, args.overlap):
+            tile = content[top:top + tile_width, left:left + tile_height][np.newaxis].copy()
+            tiles.append((len(tiles), top, left, tile))
+    print('Stylizing %dx%d px as %d tiles of %dx%d px' % (img_width, img_height, len(tiles),
+                                                          tile_width, tile_height))
+
+    job = {
+        'style_image_paths': args.style_image_paths,
+        'content_weight': args.content_weight,
+        'style_weight': args.style_weight,
+        'style_scale': args.style_scale,
+        'tv_weight': args.tv_weight,
+        'num_iter': args.num_iter,
+        'content_loss_type': args.content_loss_type,
+        'content_layer': args.content_layer,
+        'init_image': args.init_image,
+        'float32_optimizer': str_to_bool(args.float32_optimizer),
+    }
+
+    # weighted sum of the tiles and sum of the weights, normalized once all tiles are in
+    blended = np.zeros(content.shape, dtype='float32')
+    weight_sum = np.zeros(content.shape[:2] + (1,), dtype='float32')
+    start_time = time.time()
+
+    def blend(result):
+        n, top, left, x, loss, seconds = result
+        weights = np.outer(feather(img_width, top, tile_width, args.overlap),
+                           feather(img_height, left, tile_height, args.overlap))[:, :, np.newaxis]
+        blended[top:top + tile_width, left:left + tile_height] += weights * x[0]
+        weight_sum[top:top + tile_width, left:left + tile_height] += weights
+        print('Tile %d/%d at (%d, %d): loss %g in %ds' % (n + 1, len(tiles), top, left, loss, seconds))
+
+    if args.processes > 1:
+        # spawned workers, so that no backend session is shared through fork
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(args.processes, _init_worker, (args.model, args.pool, args.gram_cache_dir, job))
+        try:
+            for result in pool.imap_unordered(_stylize_tile, tiles):
+                blend(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(args.model, args.pool, args.gram_cache_dir, job)
+        for tile in tiles:
+            blend(_stylize_tile(tile))
+
+    blended /= weight_sum
+    img = deprocess_image(backend_layout(blended[np.newaxis]), img_width, img_height)
+    fname = args.result_prefix + '_tiled.png'
+    imsave(fname, img)
+    print('Image saved as', fname)
+    print('Stylized %d tiles in %ds' % (len(tiles), time.time() - start_time))